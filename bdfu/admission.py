@@ -0,0 +1,161 @@
+"""
+Admission control for uploads.
+
+An AdmissionController limits the number of uploads in progress at once, both
+in total and for each user, and the rate at which each user may send bytes.
+Uploads over a limit are refused with AdmissionError before any of their body
+is read so that one busy user cannot starve the others. See the
+UPLOAD_CONCURRENCY, USER_UPLOAD_CONCURRENCY, USER_UPLOAD_RATE and
+USER_UPLOAD_BURST configuration settings.
+
+Limits apply within one process. When a server runs several worker processes,
+each enforces them separately.
+
+"""
+import math
+import threading
+import time
+
+# The number of token buckets kept before full ones, which are the same as
+# new ones, are dropped
+_MAX_IDLE_BUCKETS = 1024
+
+class AdmissionError(Exception):
+    """Raised when an upload may not start. status is the HTTP status with
+    which to refuse it: 503 if the server as a whole is busy or 429 if the
+    user has too many uploads in progress or has sent too much. retry_after
+    is the number of seconds after which the upload may be retried.
+
+    """
+    def __init__(self, status, retry_after, message):
+        super(AdmissionError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionController(object):
+    """Admit uploads subject to limits. max_uploads is the number which may
+    be in progress at once and max_user_uploads the number for any one user.
+    If rate is not None, each user may send on average that many bytes per
+    second with bursts of up to burst bytes, which defaults to ten seconds'
+    worth. Any limit which is None is not enforced.
+
+    """
+    def __init__(self, max_uploads=None, max_user_uploads=None, rate=None, burst=None,
+                 clock=time.time):
+        self.max_uploads = max_uploads
+        self.max_user_uploads = max_user_uploads
+        self.rate = rate
+        self.burst = burst if burst is not None or rate is None else rate * 10
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._uploads = 0
+        self._user_uploads = {}
+        self._buckets = {}
+        self.admitted = self.refused = 0
+
+    def admit(self, username, length=None):
+        """Admit an upload by username of length bytes, which may be None if
+        it is not known, and return an Admission. The Admission must be
+        released once the upload has finished; it is a context manager which
+        does so. Raises AdmissionError if the upload must wait.
+
+        Known lengths are taken from the user's bucket now. Others are taken
+        by Admission.charge() once known. A bucket may be overdrawn by an
+        upload larger than burst, in which case the user must wait for it to
+        refill.
+
+        """
+        username = '%s' % (username,)
+        with self._lock:
+            try:
+                self._check(username, length)
+            except AdmissionError:
+                self.refused += 1
+                raise
+            self._uploads += 1
+            self._user_uploads[username] = self._user_uploads.get(username, 0) + 1
+            if length is not None:
+                self._take(username, length)
+            self.admitted += 1
+        return Admission(self, username)
+
+    def stats(self):
+        """Return a dictionary of admission statistics."""
+        with self._lock:
+            return dict(
+                uploads=self._uploads, users=len(self._user_uploads),
+                admitted=self.admitted, refused=self.refused,
+            )
+
+    def _check(self, username, length):
+        # Called with the lock held
+        if self.max_uploads is not None and self._uploads >= self.max_uploads:
+            raise AdmissionError(503, 1, 'Too many uploads in progress')
+        if (self.max_user_uploads is not None and
+                self._user_uploads.get(username, 0) >= self.max_user_uploads):
+            raise AdmissionError(429, 1, 'Too many uploads in progress for user')
+        if self.rate is not None:
+            tokens = self._refill(username)
+            wanted = min(length or 0, self.burst)
+            if tokens <= 0 or tokens < wanted:
+                wait = (wanted - tokens) / float(self.rate)
+                raise AdmissionError(429, max(int(math.ceil(wait)), 1), 'Upload rate exceeded')
+
+    def _refill(self, username):
+        # Called with the lock held. Returns the tokens now in the bucket.
+        now = self.clock()
+        tokens, updated = self._buckets.get(username, (self.burst, now))
+        tokens = min(tokens + (now - updated) * self.rate, self.burst)
+        self._buckets[username] = (tokens, now)
+        return tokens
+
+    def _take(self, username, nbytes):
+        # Called with the lock held
+        if self.rate is None:
+            return
+        tokens = self._refill(username)
+        self._buckets[username] = (tokens - nbytes, self.clock())
+
+        if len(self._buckets) > _MAX_IDLE_BUCKETS:
+            for other in list(self._buckets):
+                if self._refill(other) >= self.burst:
+                    del self._buckets[other]
+
+    def _release(self, username):
+        with self._lock:
+            self._uploads -= 1
+            count = self._user_uploads[username] - 1
+            if count == 0:
+                del self._user_uploads[username]
+            else:
+                self._user_uploads[username] = count
+
+    def _charge(self, username, nbytes):
+        with self._lock:
+            self._take(username, nbytes)
+
+class Admission(object):
+    """An upload admitted by an AdmissionController."""
+    def __init__(self, controller, username):
+        self._controller = controller
+        self._username = username
+        self._released = False
+
+    def charge(self, nbytes):
+        """Take nbytes, sent by an upload whose length was not known when it
+        was admitted, from the user's bucket.
+
+        """
+        self._controller._charge(self._username, nbytes)
+
+    def release(self):
+        """Note that the upload has finished."""
+        if not self._released:
+            self._released = True
+            self._controller._release(self._username)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
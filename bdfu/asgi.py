@@ -0,0 +1,264 @@
+"""
+An asyncio-native ASGI application for handling authenticated uploads.
+
+This is an alternative to the WSGI application in bdfu.webapp for servers
+which must handle many concurrent, slow clients. Rather than tying up a thread
+per connection, request bodies are received on the event loop and written to
+disk by a small pool of threads. It requires Python 3.5 or later and an ASGI
+server such as uvicorn:
+
+    $ BDFU_SETTINGS=/path/to/config.cfg uvicorn bdfu.asgi:app
+
+The application is exported as "app" and is configured from the file named by
+the BDFU_SETTINGS environment variable in the same way as the WSGI
+application. Only raw uploads, i.e. "PUT /upload", are supported. Bodies may
+be compressed with a Content-Encoding of "gzip" or "zstd". In addition
+to JWT_SECRET_KEY and STORAGE_DIR, the following configuration values may be
+set:
+
+    * ASGI_IO_THREADS: number of threads used for disk writes (default: 4).
+    * TOKEN_CACHE_SIZE: maximum number of verified tokens to remember
+      (default: 1024).
+    * STORAGE_SHARD_LEVELS, STORAGE_DEDUP, STORAGE_INDEX, STORAGE_DURABILITY,
+      STORAGE_SYNC_WINDOW, STORAGE_WRITERS, STORAGE_QUEUE_SIZE,
+      STORAGE_QUEUE_TIMEOUT, STORAGE_COMPRESSION, QUOTA, USER_QUOTAS: as for
+      the WSGI application.
+
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+from bdfu.auth import InvalidTokenError, TokenCache, decode_user_token, get_quota
+from bdfu.compression import (
+    DecompressionError, UnsupportedCodecError, decompressor, parse_content_encoding,
+)
+from bdfu.storage import (
+    STORAGE_SETTINGS, DigestMismatchError, QuotaExceededError, Storage, parse_digest_header,
+)
+from bdfu.writebehind import StorageBusyError, WriteBehindStorage
+
+#: Number of bytes of a request body buffered before they are written to the
+#: spooled file.
+CHUNK_SIZE = 64 * 1024
+
+class UploadApplication(object):
+    """An ASGI application which accepts raw file uploads. Takes a mapping of
+    configuration values.
+
+    """
+    def __init__(self, config):
+        self.config = config
+        self.token_cache = TokenCache(config.get('TOKEN_CACHE_SIZE', 1024))
+        self._storage = None
+        self._storage_settings = None
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        if scope['path'] != '/upload':
+            await _send_json(send, 404, dict(error='Not Found'))
+            return
+        if scope['method'] != 'PUT':
+            await _send_json(send, 405, dict(error='Method Not Allowed'),
+                             headers=[(b'allow', b'PUT')])
+            return
+
+        await self._upload(scope, receive, send)
+
+    async def _upload(self, scope, receive, send):
+        headers = dict(scope['headers'])
+
+        # Authenticate before reading any of the body. Responses mirror those
+        # of Flask-JWT in the WSGI application.
+        auth = headers.get(b'authorization', b'').decode('latin-1').split()
+        if len(auth) == 0:
+            await _send_json(
+                send, 401, _jwt_error(401, 'Authorization Required', 'Authorization header was missing'),
+                headers=[(b'www-authenticate', b'JWT realm="Login Required"')])
+            return
+        if len(auth) != 2 or auth[0].lower() != 'bearer':
+            await _send_json(send, 400, _jwt_error(400, 'Invalid JWT header', 'Unsupported authorization type'))
+            return
+        try:
+            payload = decode_user_token(
+                auth[1], self.config['JWT_SECRET_KEY'], cache=self.token_cache)
+        except InvalidTokenError as e:
+            await _send_json(send, 400, _jwt_error(400, 'Invalid JWT', str(e)))
+            return
+        username, quota = payload['user'], get_quota(payload, self.config)
+
+        length = headers.get(b'content-length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                await _send_json(send, 400, dict(error='Bad content length'))
+                return
+
+        sha256 = None
+        for header in (b'content-digest', b'digest'):
+            if header in headers:
+                try:
+                    sha256 = parse_digest_header(headers[header].decode('latin-1'))
+                except ValueError:
+                    await _send_json(send, 400, dict(error='Bad digest'))
+                    return
+                if sha256 is not None:
+                    break
+
+        # A compressed body is decompressed as it is received. Its length
+        # once decompressed is not known in advance.
+        try:
+            codec = parse_content_encoding(headers.get(b'content-encoding', b'').decode('latin-1'))
+        except UnsupportedCodecError:
+            await _send_json(send, 415, dict(error='Unsupported content encoding'))
+            return
+        decoder = decompressor(codec) if codec is not None else None
+        decoded_length = length if decoder is None else None
+
+        # Receive the body into a spooled file in storage, buffering up to
+        # CHUNK_SIZE bytes at a time so that there is one disk write per chunk
+        # rather than one per network read.
+        loop = asyncio.get_event_loop()
+        storage, executor = self._get_storage(), self._get_executor()
+
+        # With write-behind storage, refuse uploads while it is overloaded
+        if isinstance(storage, WriteBehindStorage) and storage.full():
+            await _send_storage_busy(send)
+            return
+
+        # Refuse bodies which cannot fit within the user's quota before
+        # receiving them, or as soon as they are found not to.
+        allowance = None
+        if quota is not None:
+            usage = await loop.run_in_executor(executor, storage.usage, username)
+            allowance = quota - usage
+            if decoded_length is not None and decoded_length > allowance:
+                await _send_quota_exceeded(send, QuotaExceededError(quota, usage))
+                return
+
+        fobj = await loop.run_in_executor(executor, storage.spool, username, decoded_length)
+        try:
+            received, buf, more_body, wire = 0, bytearray(), True, 0
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body = message.get('body', b'')
+                wire += len(body)
+                more_body = message.get('more_body', False)
+
+                # A compressed body is decompressed CHUNK_SIZE bytes at a
+                # time so that a little data cannot expand to fill memory.
+                while True:
+                    try:
+                        if decoder is not None:
+                            body = decoder.decompress(body, CHUNK_SIZE)
+                            if not body and not more_body:
+                                decoder.check_finished()
+                    except DecompressionError:
+                        await _send_json(send, 400, dict(error='Bad compressed data'))
+                        return
+                    drained = decoder is None or not body
+                    buf.extend(body)
+                    if allowance is not None and received + len(buf) > allowance:
+                        await _send_quota_exceeded(send, QuotaExceededError(quota, usage))
+                        return
+                    if len(buf) >= CHUNK_SIZE or (drained and not more_body):
+                        received += len(buf)
+                        await loop.run_in_executor(executor, fobj.write, bytes(buf))
+                        del buf[:]
+                    if drained:
+                        break
+                    body = b''
+
+            if length is not None and wire != length:
+                await _send_json(send, 400, dict(error='Incomplete request body'))
+                return
+
+            try:
+                stored = await loop.run_in_executor(
+                    executor, lambda: storage.store(username, fobj, sha256=sha256, quota=quota))
+            except DigestMismatchError as e:
+                await _send_json(send, 400, dict(
+                    error='Digest mismatch', expected=e.expected, sha256=e.actual))
+                return
+            except QuotaExceededError as e:
+                await _send_quota_exceeded(send, e)
+                return
+            except StorageBusyError:
+                await _send_storage_busy(send)
+                return
+        finally:
+            await loop.run_in_executor(executor, storage.discard, fobj)
+
+        await _send_json(send, 201, dict(id=stored.id, sha256=stored.sha256))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_storage(self):
+        settings = tuple(self.config.get(k) for k in STORAGE_SETTINGS)
+        if self._storage is None or self._storage_settings != settings:
+            self._storage = Storage.from_config(self.config)
+            self._storage_settings = settings
+        return self._storage
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.config.get('ASGI_IO_THREADS', 4))
+        return self._executor
+
+def load_config(path):
+    """Load configuration from a Python file in the same manner as Flask. Only
+    upper-case names are kept.
+
+    """
+    namespace = dict(__file__=path)
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), namespace)
+    return dict((k, v) for k, v in namespace.items() if k.isupper())
+
+def _jwt_error(status_code, error, description):
+    return dict(status_code=status_code, error=error, description=description)
+
+async def _send_quota_exceeded(send, e):
+    await _send_json(send, 413, dict(error='Quota exceeded', quota=e.quota, usage=e.usage))
+
+async def _send_storage_busy(send):
+    await _send_json(send, 503, dict(error='Storage busy'), headers=[(b'retry-after', b'1')])
+
+async def _send_json(send, status, body, headers=()):
+    body = json.dumps(body).encode('utf8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+        ] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+# Configure the application from the environment. As for the WSGI application,
+# it's a soft-failure if such a variable is not set.
+app = UploadApplication(
+    load_config(os.environ['BDFU_SETTINGS']) if 'BDFU_SETTINGS' in os.environ else {}
+)
@@ -1,17 +1,157 @@
 """
 User authentication.
 
-"""
+Tokens are signed with HMAC-SHA256 directly. PyJWT is imported only when a
+token is decoded so that making tokens, e.g. with "bdfu gen-token", does not
+pay for importing it.
 
-import jwt
+"""
+import base64
 import datetime
+from collections import OrderedDict
+import hashlib
+import hmac
+from itertools import islice
+import json
+import threading
+import time
+
+class InvalidTokenError(Exception):
+    """Raised when a token cannot be verified."""
 
-def make_user_token(username, secret, expires_in=30):
+def make_user_token(username, secret, expires_in=30, quota=None):
     """Given a username and server secret, generate an authorization token for
-    the given user.
+    the given user. If quota is not None, the token limits the total size of
+    the user's files to that many bytes.
+
+    """
+    return _token_signer(secret, expires_in, quota)([username])[0][1]
+
+def make_user_tokens(usernames, secret, expires_in=30, quota=None, processes=None,
+                     batch_size=10000):
+    """Generate a token for each of an iterable of usernames as
+    make_user_token() would and yield (username, token) pairs in the same
+    order. All of the tokens have the same expiry time. If processes is
+    greater than one, the tokens are generated by a pool of that many
+    processes in batches of batch_size users.
+
+    This is much quicker than calling make_user_token() for each user since
+    the time is read, the header encoded and the signing key prepared once
+    only.
+
+    """
+    signer = _token_signer(secret, expires_in, quota)
+    batches = _batches(usernames, batch_size)
+
+    if processes is None or processes <= 1:
+        for batch in batches:
+            for pair in signer(batch):
+                yield pair
+        return
+
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+        for pairs in pool.imap(signer, batches):
+            for pair in pairs:
+                yield pair
+    finally:
+        pool.terminate()
+        pool.join()
+
+class TokenCache(object):
+    """A bounded, thread-safe, least-recently-used cache of verified token
+    payloads. Each entry is dropped once the time given when it was added,
+    usually the token's "exp" claim, has passed. Counts of hits, misses,
+    evictions and expirations are kept and returned by stats().
+
+    """
+    def __init__(self, maxsize=1024, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        """Return the payload cached for key or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at = entry
+            if expires_at <= self.clock():
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # Re-inserting marks the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload, expires_at):
+        """Cache payload for key until the time expires_at."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (payload, expires_at)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+                expirations=self.expirations, size=len(self._entries),
+                maxsize=self.maxsize,
+            )
+
+def verify_user_token(token, secret, cache=None):
+    """Verify a token generated by make_user_token() and return the username
+    it was issued for. Raises InvalidTokenError if the token has a bad
+    signature, has expired, is not yet valid or does not name a user.
+
+    If cache is a TokenCache, previously verified tokens are looked up in it
+    rather than being verified again.
+
+    """
+    return decode_user_token(token, secret, cache)['user']
+
+def decode_user_token(token, secret, cache=None):
+    """As verify_user_token() but return the token's whole payload."""
+    key = (secret, token)
+    payload = cache.get(key) if cache is not None else None
+    if payload is None:
+        import jwt
+        try:
+            payload = jwt.decode(token, secret, algorithms=['HS256'])
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        if cache is not None and 'exp' in payload:
+            cache.put(key, payload, payload['exp'])
+
+    if payload.get('user') is None:
+        raise InvalidTokenError('Token does not name a user')
+    return payload
+
+def get_quota(payload, config):
+    """Return the quota in bytes for the user a token payload was issued for
+    or None if they have no quota. A "quota" claim in the token takes
+    precedence over the USER_QUOTAS mapping from user name to quota in config
+    which in turn takes precedence over the QUOTA setting.
 
     """
-    return _jwt_token(dict(user=username), secret, expires_in=expires_in).decode('ascii')
+    if payload.get('quota') is not None:
+        return int(payload['quota'])
+    user_quotas = config.get('USER_QUOTAS') or {}
+    quota = user_quotas.get(payload.get('user'), config.get('QUOTA'))
+    return int(quota) if quota is not None else None
 
 def _to_numeric(dt):
     """Convert a datetime instance to a numeric date as per JWT spec."""
@@ -57,6 +197,61 @@ def _jwt_token(payload, secret, expires_in=30, with_times=True, **kwargs):
         if 'exp' not in headers:
             headers['exp'] = ext_payload['exp']
 
+    import jwt
     return jwt.encode(payload, secret, headers=headers, **kwargs)
 
+def _token_signer(secret, expires_in, quota):
+    """Return a _TokenSigner for tokens expiring expires_in seconds from now.
+
+    """
+    if secret is None:
+        raise ValueError('Bad secret')
+    now = _to_numeric(datetime.datetime.utcnow())
+    return _TokenSigner(secret, now + int(expires_in), now, quota)
+
+class _TokenSigner(object):
+    """Sign tokens for lists of users with the same claims besides "user".
+    Instances may be sent to other processes.
+
+    """
+    def __init__(self, secret, exp, nbf, quota):
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf8')
+        self._secret = secret
+
+        # Keys are sorted with "user" last so that only it need be encoded
+        # for each token
+        header = dict(typ='JWT', alg='HS256', exp=exp)
+        self._header = _b64_json(header) + b'.'
+        claims = json.dumps(dict(exp=exp, nbf=nbf), sort_keys=True, separators=(',', ':'))
+        if quota is not None:
+            claims = claims[:-1] + ',"quota":{0}}}'.format(int(quota))
+        self._claims_prefix = claims[:-1] + ',"user":'
+
+    def __call__(self, usernames):
+        key = hmac.new(self._secret, digestmod=hashlib.sha256)
+        pairs = []
+        for username in usernames:
+            claims = self._claims_prefix + json.dumps(username) + '}'
+            signing_input = self._header + _b64(claims.encode('utf8'))
+            mac = key.copy()
+            mac.update(signing_input)
+            token = signing_input + b'.' + _b64(mac.digest())
+            pairs.append((username, token.decode('ascii')))
+        return pairs
+
+def _b64(data):
+    """Encode bytes as unpadded URL-safe base64 as per the JWT spec."""
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+def _b64_json(value):
+    return _b64(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf8'))
 
+def _batches(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
@@ -0,0 +1,74 @@
+"""
+Content-defined chunking.
+
+Files are split into chunks at positions chosen by the data itself rather than
+at fixed offsets. Inserting or removing bytes in one part of a file therefore
+only changes the chunks around the edit; the rest are the same as before and
+need not be uploaded again. See Client.upload(dedup=True).
+
+Boundaries are found with a "gear" rolling hash as used by FastCDC. The same
+data is always split in the same way whoever splits it. The hash is computed in
+pure Python which limits chunking to a few megabytes per second. This is worth
+it when the network is the bottleneck.
+
+"""
+import hashlib
+import struct
+
+#: Default smallest chunk size in bytes. No boundary is looked for before this.
+MIN_CHUNK_SIZE = 256 * 1024
+
+#: Default size of chunk which boundaries are chosen to give on average, not
+#: counting the MIN_CHUNK_SIZE bytes skipped at the start of each chunk.
+AVG_CHUNK_SIZE = 1024 * 1024
+
+#: Default largest chunk size in bytes.
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+_MASK64 = (1 << 64) - 1
+
+# A fixed table of pseudo-random 64-bit values, one for each byte value. It
+# must never change or previously uploaded chunks would no longer match.
+_GEAR = [
+    struct.unpack('>Q', hashlib.sha256(struct.pack('B', i)).digest()[:8])[0]
+    for i in range(256)
+]
+
+def iter_chunks(fobj, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE,
+                max_size=MAX_CHUNK_SIZE):
+    """Read the file-like object fobj to its end and yield its contents as
+    successive chunks of bytes. Every chunk but the last is between min_size
+    and max_size bytes long.
+
+    """
+    # A boundary is placed after a byte if the hash is below threshold. Each
+    # hash is equally likely so this happens once every avg_size bytes or so.
+    threshold = (1 << 64) // avg_size
+
+    buf, eof = bytearray(), False
+    while not eof:
+        data = fobj.read(max_size)
+        eof = len(data) == 0
+        buf.extend(data)
+
+        # A boundary can only be placed once max_size bytes are available or
+        # there is no more data.
+        while len(buf) >= max_size or (eof and len(buf) > 0):
+            n = _cut_point(buf, min_size, threshold, max_size)
+            yield bytes(buf[:n])
+            del buf[:n]
+
+def _cut_point(buf, min_size, threshold, max_size):
+    """Return the length of the chunk at the start of buf."""
+    end = min(len(buf), max_size)
+    if end <= min_size:
+        return end
+
+    # Shifting the hash left each byte means that its top bits depend on the
+    # last 64 bytes only.
+    gear, mask, h = _GEAR, _MASK64, 0
+    for i, b in enumerate(buf[min_size:end], min_size + 1):
+        h = ((h << 1) + gear[b]) & mask
+        if h < threshold:
+            return i
+    return end
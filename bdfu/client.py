@@ -2,12 +2,37 @@
 Client library.
 
 """
+import base64
+from collections import namedtuple
+import hashlib
+import os
+import threading
+import time
+
 import requests
 
-from future import standard_library
-standard_library.install_aliases()
+from bdfu.chunking import iter_chunks
+from bdfu.compression import compressor
+
+try:
+    from urllib.parse import urljoin
+except ImportError:  # Python 2
+    from urlparse import urljoin
+
+#: Default number of bytes read from a file at a time. This bounds the memory
+#: used by an upload and is also the size of each request for resumable and
+#: parallel uploads.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+#: Default maximum number of connections kept open to the server.
+POOL_SIZE = 16
 
-from urllib.parse import urljoin
+#: Statuses with which a busy server refuses requests which may be retried.
+RETRY_STATUSES = (429, 503)
+
+#: The result of uploading one file with Client.upload_many(). Exactly one of
+#: id and error is not None.
+UploadResult = namedtuple('UploadResult', 'id error')
 
 class ClientError(Exception):
     def __init__(self, response):
@@ -17,29 +42,452 @@ class ClientError(Exception):
     def __str__(self):
         return self.message
 
+class DigestMismatchError(ClientError):
+    """Raised when the server reports a different SHA-256 digest for an
+    uploaded file than the one computed as it was sent.
+
+    """
+    def __init__(self, response, expected):
+        ClientError.__init__(self, response)
+        self.expected = expected
+        self.message = 'Digest mismatch: sent {0}, server has {1}'.format(
+            expected, response.json().get('sha256'))
+
 class Client(object):
     """A file upload client. Takes the API endpoint URL and authorization
     token.
 
+    Requests are made through a requests.Session so that connections to the
+    server are kept alive and reused. A session may be passed in; otherwise
+    one is created which pools up to pool_size connections.
+
+    Uploads refused because the server is busy (429 Too Many Requests or 503
+    Service Unavailable) are retried, up to the retries given to upload(),
+    after the delay the server asks for with Retry-After. If it does not ask
+    for one, the delay starts at backoff seconds and doubles with each retry.
+    No delay is longer than max_backoff seconds.
+
     """
-    def __init__(self, endpoint, token):
+    def __init__(self, endpoint, token, session=None, pool_size=POOL_SIZE, backoff=0.5,
+                 max_backoff=30):
         self.endpoint = endpoint
         self.token = token
+        self.backoff = backoff
+        self.max_backoff = max_backoff
         self._auth_headers = { 'Authorization': 'Bearer ' + str(self.token) }
 
-    def upload(self, fobj):
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def upload(self, fobj, resumable=False, parallel=None, chunk_size=CHUNK_SIZE, retries=5,
+               dedup=False, encoding=None):
         """Upload the contents of the file-like object fobj to the server and
         return the uuid corresponding to it. Raises ClientError on failure.
 
+        The file is streamed as the raw request body so memory use does not
+        depend on its size. If fobj is not seekable, e.g. it is a pipe, it is
+        read chunk_size bytes at a time and sent with chunked transfer
+        encoding. The server must support chunked requests in this case.
+
+        If resumable is True, the file is sent in chunks of chunk_size bytes
+        via an upload session. Should the connection fail, the upload resumes
+        from wherever the server says it got to. Up to retries consecutive
+        failures are tolerated. In this mode fobj must be seekable.
+
+        If parallel is an integer, the file is split into parts of chunk_size
+        bytes which are sent over that many concurrent connections. Each part
+        is retried up to retries times. Again, fobj must be seekable.
+
+        If dedup is True, the file is split into content-defined chunks (see
+        bdfu.chunking) and only those chunks which the server does not already
+        have are sent. The server then assembles the file from its chunks.
+        This greatly reduces the data sent when uploading a file which differs
+        little from one uploaded before. Chunks are sent over parallel
+        connections if parallel is given and each is retried up to retries
+        times. The file is read twice, once to find its chunks and once to send
+        them, so fobj must be seekable. The chunk_size and resumable arguments
+        are ignored.
+
+        If encoding is "gzip" or "zstd", the file is compressed with that codec
+        as it is sent and the server decompresses it as it is received. This
+        cannot be combined with resumable, parallel or dedup uploads, which
+        raise ValueError.
+
+        In every case the SHA-256 digest of the file is computed as it is read
+        and compared with that of the stored file. DigestMismatchError is
+        raised if they differ. Requests refused because the server is busy are
+        retried up to retries times unless fobj is not seekable.
+
+        """
+        if encoding is not None and (dedup or parallel is not None or resumable):
+            raise ValueError('Compressed uploads cannot be resumable, parallel or deduplicated')
+        if dedup:
+            return self._upload_dedup(fobj, parallel or 1, retries)
+        if parallel is not None:
+            return self._upload_parallel(fobj, parallel, chunk_size, retries)
+        if resumable:
+            return self._upload_resumable(fobj, chunk_size, retries)
+
+        # If we know the length of the file, requests will stream it with an
+        # appropriate Content-Length. Otherwise we send chunks as we read them.
+        # A compressed body's length is not known until it has been sent.
+        length = _remaining_length(fobj)
+        start = fobj.tell() if length is not None else None
+        headers = self._auth_headers
+        if encoding is not None:
+            headers = dict(headers)
+            headers['Content-Encoding'] = encoding
+
+        # The body is read afresh for each attempt
+        readers = []
+        def body():
+            if len(readers) > 0:
+                fobj.seek(start)
+            reader = _HashingReader(fobj, length)
+            readers.append(reader)
+            if encoding is not None:
+                return _iter_compressed(reader, chunk_size, encoding)
+            if length is None:
+                return _iter_chunks(reader, chunk_size)
+            return reader
+
+        r = self._request(
+            'PUT', urljoin(self.endpoint, 'upload'), retries if start is not None else 0,
+            body=body, headers=headers,
+        )
+        reader = readers[-1]
+
+        if r.status_code != 201:
+            raise ClientError(r)
+        _check_digest(r, reader.hash)
+
+        return r.json()['id']
+
+    def upload_batch(self, fobjs):
+        """Upload the contents of each of a sequence of file-like objects in a
+        single request and return a list of the corresponding uuids. Raises
+        ClientError on failure. This is intended for many small files: the
+        request body is built in memory.
+
         """
-        r = requests.post(
-            urljoin(self.endpoint, 'upload'),
-            files=dict(file=fobj),
+        r = self.session.post(
+            urljoin(self.endpoint, 'batch'),
+            files=[('file', fobj) for fobj in fobjs],
             headers=self._auth_headers,
         )
 
         if r.status_code != 201:
             raise ClientError(r)
 
+        return r.json()['ids']
+
+    def upload_many(self, files, concurrency=1, **kwargs):
+        """Upload each of an iterable of files and return a list of
+        UploadResult tuples in the same order. Each file may be a file-like
+        object or a path to open. Up to concurrency files are uploaded at
+        once. Remaining keyword arguments are passed to upload().
+
+        Errors uploading an individual file do not stop the others; they are
+        reported as the error of the corresponding result.
+
+        """
+        def upload_one(f):
+            try:
+                if hasattr(f, 'read'):
+                    return UploadResult(self.upload(f, **kwargs), None)
+                with open(f, 'rb') as fobj:
+                    return UploadResult(self.upload(fobj, **kwargs), None)
+            except (ClientError, requests.RequestException, IOError, OSError) as e:
+                return UploadResult(None, e)
+
+        if concurrency <= 1:
+            return [upload_one(f) for f in files]
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(concurrency)
+        try:
+            return pool.map(upload_one, files)
+        finally:
+            pool.terminate()
+
+    def _upload_resumable(self, fobj, chunk_size, retries):
+        r = self.session.post(urljoin(self.endpoint, 'uploads'), headers=self._auth_headers)
+        if r.status_code != 201:
+            raise ClientError(r)
+        session_url = urljoin(self.endpoint, 'uploads/' + r.json()['id'])
+
+        # An offset of None means that we do not know how much the server has
+        # received and must ask it before sending more. Data is hashed the
+        # first time it is read; hashed is the number of bytes hashed so far.
+        start, offset, failures = fobj.tell(), 0, 0
+        file_hash, hashed = hashlib.sha256(), 0
+        while True:
+            try:
+                if offset is None:
+                    offset = self._session_offset(session_url)
+
+                fobj.seek(start + offset)
+                chunk = fobj.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+                if offset + len(chunk) > hashed:
+                    file_hash.update(chunk[hashed - offset:])
+                    hashed = offset + len(chunk)
+
+                headers = dict(self._auth_headers)
+                headers['Upload-Offset'] = str(offset)
+                r = self._request('PATCH', session_url, retries, data=chunk, headers=headers)
+            except requests.ConnectionError:
+                failures += 1
+                if failures > retries:
+                    raise
+                offset = None
+                continue
+
+            # On success, or if the server disagrees with us (409), carry on
+            # from the offset the server reports.
+            if r.status_code not in (200, 409):
+                raise ClientError(r)
+            offset, failures = r.json()['offset'], 0
+
+        r = self.session.post(session_url, headers=_digest_headers(self._auth_headers, file_hash))
+        if r.status_code != 201:
+            raise ClientError(r)
+        _check_digest(r, file_hash)
+
         return r.json()['id']
 
+    def _upload_parallel(self, fobj, parallel, chunk_size, retries):
+        start = fobj.tell()
+        fobj.seek(0, os.SEEK_END)
+        length = fobj.tell() - start
+
+        r = self.session.post(urljoin(self.endpoint, 'uploads'), headers=self._auth_headers)
+        if r.status_code != 201:
+            raise ClientError(r)
+        session_url = urljoin(self.endpoint, 'uploads/' + r.json()['id'])
+
+        # Parts are read from fobj one at a time, in order, but sent
+        # concurrently. Reading in order lets the file be hashed as it is read.
+        # At most parallel parts are held in memory at once.
+        fobj_lock = threading.Lock()
+        offsets = iter(range(0, length, chunk_size))
+        file_hash = hashlib.sha256()
+        def send_part(_):
+            with fobj_lock:
+                offset = next(offsets)
+                fobj.seek(start + offset)
+                part = fobj.read(chunk_size)
+                file_hash.update(part)
+
+            for attempt in range(retries + 1):
+                try:
+                    r = self._request(
+                        'PUT', session_url + '/' + str(offset), retries, data=part,
+                        headers=self._auth_headers
+                    )
+                    break
+                except requests.ConnectionError:
+                    if attempt == retries:
+                        raise
+
+            if r.status_code != 200:
+                raise ClientError(r)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(parallel)
+        try:
+            for _ in pool.imap_unordered(send_part, range(0, length, chunk_size)):
+                pass
+        finally:
+            pool.terminate()
+
+        headers = _digest_headers(self._auth_headers, file_hash)
+        headers['Upload-Length'] = str(length)
+        r = self.session.post(session_url, headers=headers)
+        if r.status_code != 201:
+            raise ClientError(r)
+        _check_digest(r, file_hash)
+
+        return r.json()['id']
+
+    def _upload_dedup(self, fobj, parallel, retries):
+        # Find the chunks of the file, remembering where each is so that it
+        # can be read again if it needs to be sent.
+        start = fobj.tell()
+        chunks, offset, file_hash = [], 0, hashlib.sha256()
+        for chunk in iter_chunks(fobj):
+            file_hash.update(chunk)
+            chunks.append((offset, len(chunk), hashlib.sha256(chunk).hexdigest()))
+            offset += len(chunk)
+        digests = [sha256 for _, _, sha256 in chunks]
+
+        r = self.session.post(
+            urljoin(self.endpoint, 'chunks/missing'),
+            json=dict(chunks=digests), headers=self._auth_headers
+        )
+        if r.status_code != 200:
+            raise ClientError(r)
+        missing = set(r.json()['missing'])
+
+        # Send each missing chunk once even if it appears more than once
+        to_send, seen = [], set()
+        for chunk in chunks:
+            if chunk[2] in missing and chunk[2] not in seen:
+                seen.add(chunk[2])
+                to_send.append(chunk)
+
+        fobj_lock = threading.Lock()
+        def send_chunk(chunk):
+            offset, length, sha256 = chunk
+            with fobj_lock:
+                fobj.seek(start + offset)
+                data = fobj.read(length)
+
+            for attempt in range(retries + 1):
+                try:
+                    r = self._request(
+                        'PUT', urljoin(self.endpoint, 'chunks/' + sha256), retries, data=data,
+                        headers=self._auth_headers
+                    )
+                    break
+                except requests.ConnectionError:
+                    if attempt == retries:
+                        raise
+
+            if r.status_code != 201:
+                raise ClientError(r)
+
+        if parallel <= 1:
+            for chunk in to_send:
+                send_chunk(chunk)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(parallel)
+            try:
+                for _ in pool.imap_unordered(send_chunk, to_send):
+                    pass
+            finally:
+                pool.terminate()
+
+        r = self.session.post(
+            urljoin(self.endpoint, 'chunks/assemble'), json=dict(chunks=digests),
+            headers=_digest_headers(self._auth_headers, file_hash)
+        )
+        if r.status_code != 201:
+            raise ClientError(r)
+        _check_digest(r, file_hash)
+
+        return r.json()['id']
+
+    def _request(self, method, url, retries, body=None, **kwargs):
+        """Make a request with the session method named by method, e.g.
+        "PUT", retrying up to retries times if the server is busy, and return
+        the last response. If body is not
+        None, it is called to make the request body for each attempt.
+
+        """
+        for attempt in range(retries + 1):
+            if body is not None:
+                kwargs['data'] = body()
+            r = getattr(self.session, method.lower())(url, **kwargs)
+            if r.status_code not in RETRY_STATUSES or attempt == retries:
+                return r
+            time.sleep(self._retry_delay(r, attempt))
+
+    def _retry_delay(self, response, attempt):
+        """Return the number of seconds to wait before retrying a request
+        refused with response.
+
+        """
+        try:
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            # Absent or an HTTP date, which is not worth parsing
+            delay = self.backoff * 2 ** attempt
+        return min(max(delay, 0), self.max_backoff)
+
+    def _session_offset(self, session_url):
+        """Return the number of bytes of an upload session which the server
+        has received.
+
+        """
+        r = self.session.get(session_url, headers=self._auth_headers)
+        if r.status_code != 200:
+            raise ClientError(r)
+        return r.json()['offset']
+
+class _HashingReader(object):
+    """A file-like object which reads from fobj and computes the SHA-256
+    digest of the data read. If length is not None it is the number of bytes
+    which remain to be read and is exposed as len for the benefit of requests.
+
+    """
+    def __init__(self, fobj, length=None):
+        self._fobj = fobj
+        self.hash = hashlib.sha256()
+        if length is not None:
+            self.len = length
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def __iter__(self):
+        return _iter_chunks(self, CHUNK_SIZE)
+
+def _digest_headers(headers, file_hash):
+    """Return a copy of headers with a Digest header for file_hash added."""
+    headers = dict(headers)
+    headers['Digest'] = 'sha-256=' + base64.b64encode(file_hash.digest()).decode('ascii')
+    return headers
+
+def _check_digest(response, file_hash):
+    """Raise DigestMismatchError if the server's reported digest for an
+    uploaded file differs from file_hash. Servers which do not report a digest
+    are trusted.
+
+    """
+    sha256 = response.json().get('sha256')
+    if sha256 is not None and sha256 != file_hash.hexdigest():
+        raise DigestMismatchError(response, file_hash.hexdigest())
+
+def _remaining_length(fobj):
+    """Return the number of bytes between the current position of fobj and its
+    end or None if fobj is not seekable.
+
+    """
+    try:
+        pos = fobj.tell()
+        fobj.seek(0, os.SEEK_END)
+        end = fobj.tell()
+        fobj.seek(pos)
+    except (AttributeError, IOError, OSError):
+        return None
+    return end - pos
+
+def _iter_chunks(fobj, chunk_size):
+    """Yield successive chunks of at most chunk_size bytes from fobj."""
+    while True:
+        chunk = fobj.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+def _iter_compressed(fobj, chunk_size, codec):
+    """Yield the contents of fobj compressed with codec, reading chunk_size
+    bytes at a time.
+
+    """
+    c = compressor(codec)
+    for chunk in _iter_chunks(fobj, chunk_size):
+        compressed = c.compress(chunk)
+        if compressed:
+            yield compressed
+    yield c.flush()
@@ -0,0 +1,212 @@
+"""
+Streaming compression.
+
+Data is compressed and decompressed incrementally so that files are never held
+in memory. Two codecs are supported: "gzip", using zlib from the standard
+library, and "zstd", which requires the optional zstandard package:
+
+    $ pip install bdfu[zstd]
+
+The same codec names are used for Content-Encoding headers and for the
+STORAGE_COMPRESSION setting. Files stored compressed are named with the
+codec's suffix from SUFFIXES.
+
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError: # pragma: no cover
+    zstandard = None
+
+#: Names of the supported codecs.
+CODECS = ('gzip', 'zstd')
+
+#: File name suffixes for files compressed with each codec.
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Content-Encoding values and the codecs they name
+_ENCODINGS = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}
+
+# Window bits telling zlib to read and write gzip rather than zlib streams
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Bytes of zstd input decompressed at a time. Unlike zlib, zstd cannot be told
+# to stop once it has produced some amount of output so its input is fed to it
+# in pieces small enough that even highly compressed data cannot expand to fill
+# memory. A block of up to 128KiB may be encoded in four bytes.
+_ZSTD_PIECE_SIZE = 64
+
+# Exceptions raised by the codecs for bad data
+_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+class UnsupportedCodecError(ValueError):
+    """Raised when a codec is unknown or its module is not installed."""
+
+class DecompressionError(ValueError):
+    """Raised when compressed data is corrupt or truncated."""
+
+def available(codec):
+    """Return True if codec is known and can be used."""
+    return codec == 'gzip' or (codec == 'zstd' and zstandard is not None)
+
+def parse_content_encoding(value):
+    """Return the codec named by the value of a Content-Encoding header or
+    None if it is "identity". Raises UnsupportedCodecError if the encoding
+    is not supported. Several encodings applied in turn are not.
+
+    """
+    value = value.strip().lower()
+    if value in ('', 'identity'):
+        return None
+    codec = _ENCODINGS.get(value)
+    if codec is None or not available(codec):
+        raise UnsupportedCodecError('Unsupported content encoding: {0}'.format(value))
+    return codec
+
+def compressor(codec, level=None):
+    """Return an object with compress() and flush() methods, as for
+    zlib.compressobj(), which compresses data with codec.
+
+    """
+    _check_available(codec)
+    if codec == 'gzip':
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, _GZIP_WBITS)
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+def decompressor(codec):
+    """Return an object with a decompress() method which decompresses data
+    compressed with codec. Several compressed streams one after another, as
+    made by appending to a compressed file, are decompressed as one.
+
+    decompress(data, max_length) returns at most max_length bytes, keeping the
+    rest of the input for later calls which may pass no more data. Those
+    should be made until one returns nothing. Since a little compressed data
+    may expand enormously, callers which do not trust the data should always
+    give a max_length.
+
+    """
+    _check_available(codec)
+    return _Decompressor(codec)
+
+class CompressingWriter(object):
+    """A file-like object which compresses data written to it with codec and
+    writes the result to fobj. close() must be called to finish the
+    compressed stream; it does not close fobj.
+
+    """
+    def __init__(self, fobj, codec):
+        self._fobj = fobj
+        self._compressor = compressor(codec)
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._fobj.write(compressed)
+        return len(data)
+
+    def close(self):
+        if self._compressor is not None:
+            self._fobj.write(self._compressor.flush())
+            self._compressor = None
+
+class DecompressingReader(object):
+    """A file-like object which reads data compressed with codec from fobj
+    and returns it decompressed.
+
+    """
+    def __init__(self, fobj, codec, chunk_size=64 * 1024):
+        self._fobj = fobj
+        self._decompressor = decompressor(codec)
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            max_length = 0 if size < 0 else size - len(self._buf)
+            data = self._decompressor.decompress(b'', max_length)
+            if not data:
+                compressed = self._fobj.read(self._chunk_size)
+                if not compressed:
+                    self._eof = True
+                    self._decompressor.check_finished()
+                    break
+                data = self._decompressor.decompress(compressed, max_length)
+            self._buf.extend(data)
+
+        if size < 0:
+            size = len(self._buf)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+class _Decompressor(object):
+    def __init__(self, codec):
+        self._codec = codec
+        self._obj = self._new()
+        self._input, self._offset = b'', 0
+        self._output = b''
+
+    def decompress(self, data, max_length=0):
+        """Decompress data following any input left over from earlier calls.
+        If max_length is not zero, return at most that many bytes.
+
+        """
+        if data:
+            self._input, self._offset = self._input[self._offset:] + data, 0
+
+        output, size = [self._output], len(self._output)
+        try:
+            while self._offset < len(self._input) and (max_length == 0 or size < max_length):
+                if getattr(self._obj, 'eof', False):
+                    # Another stream follows the one just finished
+                    self._obj = self._new()
+                if self._codec == 'gzip':
+                    data = self._decompress_gzip(max_length and max_length - size)
+                else:
+                    data = self._decompress_zstd()
+                output.append(data)
+                size += len(data)
+        except _ERRORS as e:
+            raise DecompressionError(str(e))
+
+        # zstd may produce more than was asked for; keep it for next time
+        output = b''.join(output)
+        if max_length and size > max_length:
+            output, self._output = output[:max_length], output[max_length:]
+        else:
+            self._output = b''
+        return output
+
+    def _decompress_gzip(self, max_length):
+        data = self._obj.decompress(self._input, max_length)
+        # Input is left unconsumed if the output reached max_length or
+        # follows the end of the stream
+        self._input, self._offset = self._obj.unconsumed_tail or self._obj.unused_data, 0
+        return data
+
+    def _decompress_zstd(self):
+        piece = self._input[self._offset:self._offset + _ZSTD_PIECE_SIZE]
+        data = self._obj.decompress(piece)
+        self._offset += len(piece)
+        if self._obj.eof:
+            self._offset -= len(self._obj.unused_data)
+        return data
+
+    def check_finished(self):
+        """Raise DecompressionError if the data seen so far ends part way
+        through a compressed stream.
+
+        """
+        if not getattr(self._obj, 'eof', True):
+            raise DecompressionError('Compressed data is truncated')
+
+    def _new(self):
+        if self._codec == 'gzip':
+            return zlib.decompressobj(_GZIP_WBITS)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+def _check_available(codec):
+    if not available(codec):
+        raise UnsupportedCodecError('Unsupported codec: {0}'.format(codec))
@@ -0,0 +1,169 @@
+"""
+SQLite index of stored files.
+
+The index records the id, owner, size on disk, upload time and digest of every
+file written to a Storage so that questions such as "how much has this user
+uploaded this week?" can be answered without walking the storage directory.
+Compressed files count the bytes stored rather than the size of their
+contents. See the STORAGE_INDEX configuration setting.
+
+The database is opened in WAL mode so that several worker processes may write
+to it while others read. Writes are batched so that each one does not need its
+own transaction. A record may therefore take up to flush_interval seconds to
+appear. Records not yet written when a process dies are lost but "bdfu index
+rebuild" can recreate the index from the files themselves.
+
+"""
+import sqlite3
+import threading
+import time
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS uploads (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        uploaded REAL NOT NULL,
+        sha256 TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS uploads_username_uploaded ON uploads (username, uploaded)',
+)
+
+class Index(object):
+    """An index of stored files kept in the SQLite database at path. Records
+    are written in batches of up to batch_size or once the oldest has waited
+    flush_interval seconds, whichever is sooner.
+
+    """
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Connections may not be shared between threads
+        self._local = threading.local()
+
+        # Pending changes as (sql, parameters) pairs in the order made
+        self._pending = []
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._flusher = None
+
+        with self._connection() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def record(self, username, stored, uploaded=None):
+        """Record the StoredFile stored as uploaded by username at the time
+        uploaded, which defaults to now.
+
+        """
+        if uploaded is None:
+            uploaded = time.time()
+        self._add(
+            'INSERT OR REPLACE INTO uploads (id, username, size, uploaded, sha256) VALUES (?, ?, ?, ?, ?)',
+            (stored.id, '%s' % (username,), stored.size, uploaded, stored.sha256)
+        )
+
+    def remove(self, file_id):
+        """Remove the record of a file."""
+        self._add('DELETE FROM uploads WHERE id = ?', (file_id,))
+
+    def usage(self, username=None, since=None):
+        """Return a dict mapping user names to a (count, bytes) pair giving
+        the number of files each has uploaded and their total size. If
+        username is not None, only that user is included. If since is not
+        None, only files uploaded at or after that time are counted.
+
+        """
+        self.flush()
+        sql = 'SELECT username, COUNT(*), SUM(size) FROM uploads WHERE 1'
+        params = []
+        if username is not None:
+            sql += ' AND username = ?'
+            params.append('%s' % (username,))
+        if since is not None:
+            sql += ' AND uploaded >= ?'
+            params.append(since)
+        sql += ' GROUP BY username'
+
+        rows = self._connection().execute(sql, params).fetchall()
+        return dict((user, (count, size)) for user, count, size in rows)
+
+    def rebuild(self, storage):
+        """Replace the contents of the index with records of every file in
+        storage. The upload time of each file is taken to be its modification
+        time. Returns the number of files indexed.
+
+        """
+        self.flush()
+        count = 0
+        with self._connection() as conn:
+            conn.execute('DELETE FROM uploads')
+
+            batch = []
+            for username, stored, mtime in storage.iter_files():
+                batch.append((stored.id, username, stored.size, mtime, stored.sha256))
+                count += 1
+
+                if len(batch) >= self.batch_size:
+                    conn.executemany('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)', batch)
+                    del batch[:]
+            conn.executemany('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)', batch)
+
+        return count
+
+    def flush(self):
+        """Write any pending records to the database."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._pending_since = None
+            if len(pending) == 0:
+                return
+
+            # Changes are written in one transaction while holding the lock so
+            # that they are applied in the order they were made.
+            with self._connection() as conn:
+                for sql, params in pending:
+                    conn.execute(sql, params)
+
+    def close(self):
+        """Write any pending records and close this thread's connection."""
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _add(self, sql, params):
+        with self._lock:
+            self._pending.append((sql, params))
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            full = len(self._pending) >= self.batch_size
+            stale = time.time() - self._pending_since >= self.flush_interval
+
+            # Records left in a partial batch are written by a background
+            # thread. It is started here so that it runs in the process which
+            # makes the records.
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+        if full or stale:
+            self.flush()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,260 @@
+"""
+Metrics in the Prometheus text format.
+
+A Registry keeps counters and histograms in memory. Updating one takes a lock
+and a dictionary lookup so metrics may be recorded on every request. See the
+METRICS_ENABLED configuration setting.
+
+Servers such as "bdfu serve" run several worker processes, each with its own
+Registry. If a registry is given a directory, its values are written there as
+a snapshot every interval seconds by a background thread and collect() adds
+together the snapshots of every process. Snapshots of processes which have
+exited are kept so that counters do not go backwards. The directory should
+therefore be emptied before the server starts.
+
+"""
+import bisect
+from collections import OrderedDict
+import errno
+import json
+import os
+import threading
+import time
+import uuid
+
+#: Default upper bounds of histogram buckets in seconds.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0,
+)
+
+#: Content type of the text returned by Registry.render().
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SNAPSHOT_PREFIX = 'metrics-'
+
+class Registry(object):
+    """A set of named counters and histograms. Each metric must be declared
+    with counter() or histogram() before it is updated. Values are kept
+    separately for each distinct set of labels.
+
+    """
+    def __init__(self, directory=None, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self._metrics = OrderedDict()
+        self._values = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._snapshot_name = None
+        self._writer = None
+
+    def counter(self, name, help):
+        """Declare a counter."""
+        self._metrics[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Declare a histogram with the given bucket upper bounds."""
+        self._metrics[name] = ('histogram', help, tuple(sorted(buckets)))
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_process()
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record value in a histogram."""
+        buckets = self._metrics[name][2]
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_process()
+            counts = self._values.get(key)
+            if counts is None:
+                # A count for each bucket, then +Inf, then the sum of values
+                counts = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, name, **labels):
+        """Return a context manager which records the time spent within it
+        in a histogram.
+
+        """
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """Return the values of this process's metrics as a list of
+        (name, labels, value) tuples. labels is a tuple of (name, value)
+        pairs. Histogram values are lists of bucket counts followed by the
+        sum.
+
+        """
+        with self._lock:
+            self._check_process()
+            return [(name, labels, _copy_value(value))
+                    for (name, labels), value in self._values.items()]
+
+    def collect(self):
+        """Return values as for snapshot() but added together with those
+        written by other processes to directory, if any.
+
+        """
+        values = dict(((name, labels), value) for name, labels, value in self.snapshot())
+        if self.directory is None:
+            return _as_list(values)
+
+        own = self.write()
+        for filename in os.listdir(self.directory):
+            if filename == own or not (filename.startswith(SNAPSHOT_PREFIX) and
+                                       filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    other = json.load(f)
+            except (IOError, OSError, ValueError):
+                # Being replaced or not a snapshot
+                continue
+            for name, labels, value in other:
+                if name not in self._metrics:
+                    continue
+                key = (name, tuple(tuple(pair) for pair in labels))
+                values[key] = _add_values(values.get(key), value)
+        return _as_list(values)
+
+    def render(self):
+        """Return collected values in the Prometheus text format."""
+        by_name = OrderedDict((name, []) for name in self._metrics)
+        for name, labels, value in sorted(self.collect(), key=lambda s: s[:2]):
+            if name in by_name:
+                by_name[name].append((labels, value))
+
+        lines = []
+        for name, samples in by_name.items():
+            kind, help, buckets = self._metrics[name]
+            lines.append('# HELP {0} {1}'.format(name, _escape(help, False)))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in samples:
+                if kind == 'counter':
+                    lines.append('{0}{1} {2}'.format(name, _format_labels(labels), _format(value)))
+                    continue
+                total = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-1]):
+                    total += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _format_labels(labels + (('le', _format(bound)),)), total))
+                lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), _format(value[-1])))
+                lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Write a snapshot of this process's values to directory and return
+        its file name.
+
+        """
+        values = self.snapshot()
+        with self._lock:
+            name = self._snapshot_name
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        path = os.path.join(self.directory, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(values, f)
+        os.rename(tmp_path, path)
+        return name
+
+    def _check_process(self):
+        # Called with the lock held. A process forked from this one starts
+        # afresh since its parent's values are already counted by the parent.
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        if self._pid is not None:
+            self._values = {}
+        self._pid = pid
+        self._snapshot_name = '{0}{1}-{2}.json'.format(SNAPSHOT_PREFIX, pid, uuid.uuid4().hex[:8])
+
+        # Snapshots are written by a background thread started here so that
+        # it runs in the process whose values it writes.
+        if self.directory is not None:
+            self._writer = threading.Thread(target=self._write_periodically)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _write_periodically(self):
+        pid = os.getpid()
+        while pid == os.getpid():
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except (IOError, OSError):
+                pass
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._registry.observe(self._name, time.time() - self._start, **self._labels)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def timer(registry, name, **labels):
+    """Return registry.time(name, **labels) or, if registry is None, a
+    context manager which does nothing.
+
+    """
+    if registry is None:
+        return _NullTimer()
+    return registry.time(name, **labels)
+
+def _label_key(labels):
+    return tuple(sorted((k, '%s' % (v,)) for k, v in labels.items()))
+
+def _copy_value(value):
+    return list(value) if isinstance(value, list) else value
+
+def _add_values(a, b):
+    if a is None:
+        return _copy_value(b)
+    if isinstance(a, list):
+        return [x + y for x, y in zip(a, b)]
+    return a + b
+
+def _as_list(values):
+    return [(name, labels, value) for (name, labels), value in values.items()]
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '{0:.1f}'.format(value)
+    return repr(value)
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v, True)) for k, v in labels) + '}'
+
+def _escape(value, quotes):
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
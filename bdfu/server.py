@@ -0,0 +1,289 @@
+"""
+A simple multi-process, multi-threaded WSGI server.
+
+This is used by "bdfu serve" so that small deployments can handle concurrent
+uploads without setting up a separate web server. A master process binds the
+listening socket and forks a number of worker processes which share it. Each
+worker handles requests with a fixed-size pool of threads.
+
+The master responds to the following signals:
+
+    * SIGTERM, SIGINT: stop accepting connections, let workers finish the
+      requests they have already accepted and exit.
+    * SIGHUP: reload configuration, start a fresh set of workers and
+      gracefully stop the old ones.
+
+Workers which die unexpectedly are replaced.
+
+"""
+from __future__ import print_function
+
+import os
+import signal
+import threading
+import time
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+try:
+    import queue
+except ImportError: # pragma: no cover
+    import Queue as queue
+
+class ChunkedReader(object):
+    """A file-like object which decodes a body sent with chunked transfer
+    encoding from the underlying file-like object rfile.
+
+    """
+    def __init__(self, rfile):
+        self._rfile = rfile
+        self._remaining = 0
+        self._done = False
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while not self._done and size != 0:
+            if self._remaining == 0:
+                self._next_chunk()
+                continue
+
+            n = self._remaining if size < 0 else min(size, self._remaining)
+            data = self._rfile.read(n)
+            if len(data) == 0:
+                raise IOError('Unexpected end of chunked request body')
+            chunks.append(data)
+
+            self._remaining -= len(data)
+            if size > 0:
+                size -= len(data)
+            if self._remaining == 0:
+                # Each chunk's data is followed by CRLF
+                self._rfile.readline(65537)
+
+        return b''.join(chunks)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        line = []
+        while size < 0 or len(line) < size:
+            c = self.read(1)
+            line.append(c)
+            if c in (b'\n', b''):
+                break
+        return b''.join(line)
+
+    def _next_chunk(self):
+        line = self._rfile.readline(65537)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError('Bad chunk size in chunked request body')
+
+        if size == 0:
+            # Skip any trailers up to the terminating blank line
+            while self._rfile.readline(65537).strip():
+                pass
+            self._done = True
+
+        self._remaining = size
+
+class RequestHandler(WSGIRequestHandler):
+    """A request handler which supports chunked request bodies and marks the
+    environment as multithreaded.
+
+    """
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        environ = self.get_environ()
+        stdin = self.rfile
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            stdin = ChunkedReader(self.rfile)
+            environ['wsgi.input_terminated'] = True
+
+        handler = ServerHandler(
+            stdin, self.wfile, self.get_stderr(), environ, multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server which handles requests with a fixed-size pool of threads.
+    Accepted connections wait in a bounded queue for a free thread.
+
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class=RequestHandler, threads=8):
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.threads = threads
+        self._requests = queue.Queue(threads)
+        self._workers = []
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads are started here rather than in __init__ so that they are
+        # created in the process which serves requests.
+        self._workers = [
+            threading.Thread(target=self._work) for _ in range(self.threads)
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        """Close the listening socket and wait for requests already accepted
+        to be handled.
+
+        """
+        WSGIServer.server_close(self)
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+def serve(app, host, port, workers=1, threads=8, reload=None):
+    """Serve the WSGI application app on the given host and port until
+    terminated by a signal. If workers is greater than one and the platform
+    supports it, that many worker processes are forked. The optional reload
+    callable is called in the master process on SIGHUP before new workers are
+    started.
+
+    """
+    server = PooledWSGIServer((host, port), threads=threads)
+    server.set_app(app)
+    print('Serving on http://{0.server_name}:{0.server_port}/'.format(server))
+
+    if workers <= 1 or not hasattr(os, 'fork'):
+        _run_worker(server)
+    else:
+        _Master(server, workers, reload).run()
+
+def _run_worker(server):
+    """Serve requests in this process until SIGTERM or SIGINT."""
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever() returns and so must be
+        # called from another thread.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+class _Master(object):
+    """Fork and supervise worker processes which share a listening socket."""
+    def __init__(self, server, workers, reload=None):
+        self.server = server
+        self.workers = workers
+        self.reload = reload
+        self._children = set()
+        self._stopping = False
+        self._reloading = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        self._spawn(self.workers)
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                if self.reload is not None:
+                    self.reload()
+                old_children = set(self._children)
+                self._spawn(self.workers)
+                self._stop(old_children)
+
+            # Replace any workers which have died unexpectedly
+            died = self._reap()
+            if len(died) > 0:
+                self._spawn(len(died))
+
+            time.sleep(0.2)
+
+        children = set(self._children)
+        self._stop(children)
+        while len(children) > 0:
+            try:
+                pid, _ = os.wait()
+            except OSError:
+                break
+            children.discard(pid)
+        self.server.server_close()
+
+    def _spawn(self, n):
+        for _ in range(n):
+            pid = os.fork()
+            if pid == 0:
+                # In the worker. Reloading is the master's business.
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                try:
+                    _run_worker(self.server)
+                finally:
+                    os._exit(0)
+            self._children.add(pid)
+
+    def _stop(self, children):
+        """Ask the given workers to stop. They are no longer supervised."""
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self._children -= children
+
+    def _reap(self):
+        """Collect exited children and return the set of those which were
+        supervised.
+
+        """
+        died = set()
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            if pid in self._children:
+                self._children.discard(pid)
+                died.add(pid)
+        return died
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
@@ -2,19 +2,1500 @@
 File storage backend.
 
 """
+import base64
+import binascii
+from collections import namedtuple
+import errno
+import hashlib
+import io
+import mmap
 import os
-from shutil import copyfileobj
+import re
+import stat
+import threading
+import time
 import uuid
 
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+from bdfu.compression import (
+    SUFFIXES, CompressingWriter, DecompressingReader, UnsupportedCodecError, available,
+)
+from bdfu.index import Index
+from bdfu.metrics import timer
+
+#: Size of the buffer used to copy files which cannot be copied by the kernel.
+#: One buffer is kept per thread and reused.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+#: Name of the per-user directory holding partially uploaded files. File ids
+#: are hex strings so this can never clash with a stored file.
+PARTIAL_DIR = '.partial'
+
+#: Name of the per-user directory holding chunks uploaded for assembly into
+#: files by Storage.assemble().
+CHUNK_DIR = '.chunks'
+
+#: Name of the directory within the storage directory holding the contents of
+#: files when deduplication is enabled. Tokens must not be issued to a user of
+#: this name.
+BLOB_DIR = '.blobs'
+
+#: Name of the per-user file holding the number of bytes the user has stored.
+USAGE_FILE = '.usage'
+
+#: Prefix for the names of files created by Storage.spool().
+SPOOL_PREFIX = 'spool-'
+
+#: Prefix for the names of files created by Storage.stage(). The rest of the
+#: name is the id the file will have once committed.
+STAGED_PREFIX = 'staged-'
+
+#: Suffix of the file kept alongside an upload session's partial file
+#: recording the number of bytes of it counted towards the user's usage.
+SESSION_CHARGE_SUFFIX = '.charged'
+
+#: Configuration keys which affect how a Storage is created by from_config().
+#: Applications may compare their values to decide whether an existing
+#: Storage can be reused.
+STORAGE_SETTINGS = (
+    'STORAGE_DIR', 'STORAGE_SHARD_LEVELS', 'STORAGE_DEDUP', 'STORAGE_INDEX',
+    'STORAGE_DURABILITY', 'STORAGE_SYNC_WINDOW', 'STORAGE_WRITERS',
+    'STORAGE_QUEUE_SIZE', 'STORAGE_QUEUE_TIMEOUT', 'STORAGE_COMPRESSION',
+)
+
+#: Values accepted for the durability argument of Storage.
+DURABILITY_MODES = ('none', 'file', 'group')
+
+#: Suffix of the file stored alongside each stored file recording the SHA-256
+#: digest of its contents. The file is in the format used by sha256sum.
+DIGEST_SUFFIX = '.sha256'
+
+#: The result of Storage.store(): the new file's id, its size in bytes and the
+#: hex SHA-256 digest of its contents.
+StoredFile = namedtuple('StoredFile', 'id size sha256')
+
+_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_ID_PREFIX_RE = re.compile(r'^[0-9a-f]{32}')
+_STORED_NAME_RE = re.compile(
+    r'^([0-9a-f]{32})(' + '|'.join(re.escape(s) for s in SUFFIXES.values()) + ')?$')
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class StorageError(Exception):
+    """Base class for errors raised by Storage."""
+
+class UnknownSessionError(StorageError):
+    """Raised when an upload session id does not name an open session."""
+
+class UnknownFileError(StorageError):
+    """Raised when a file id does not name a stored file."""
+
+class MissingChunksError(StorageError):
+    """Raised when a file is to be assembled from chunks which have not been
+    uploaded. The list of their digests is available as the missing
+    attribute.
+
+    """
+    def __init__(self, missing):
+        super(MissingChunksError, self).__init__(
+            '{0} chunk(s) missing'.format(len(missing)))
+        self.missing = missing
+
+class QuotaExceededError(StorageError):
+    """Raised when storing a file would take a user's usage over their quota.
+    The quota and usage in bytes are available as attributes.
+
+    """
+    def __init__(self, quota, usage):
+        super(QuotaExceededError, self).__init__(
+            'Quota of {0} byte(s) exceeded; {1} byte(s) used'.format(quota, usage))
+        self.quota = quota
+        self.usage = usage
+
+class DigestMismatchError(StorageError):
+    """Raised when the contents of a file do not have the expected digest. The
+    expected and actual hex digests are available as attributes.
+
+    """
+    def __init__(self, expected, actual):
+        super(DigestMismatchError, self).__init__(
+            'Digest mismatch: expected {0}, got {1}'.format(expected, actual))
+        self.expected = expected
+        self.actual = actual
+
 class Storage(object):
-    def __init__(self, destdir):
+    """Store files under destdir. Each user's files are kept in a directory
+    named after the user.
+
+    If shard_levels is zero, files are stored directly within the user's
+    directory as <user>/<id>. Otherwise they are spread across that many
+    levels of sub-directories named after successive pairs of hex digits of
+    the id. For example, with two levels a file is stored as
+    <user>/ab/cd/<id>. This keeps directories small for users with very many
+    files. The ids returned are the same whatever the layout.
+
+    If dedup is True, files with identical contents share disk blocks. The
+    first copy of some contents is kept as a "blob" in BLOB_DIR named after
+    its SHA-256 digest and each stored file is a hard link to it. The number
+    of links to a blob counts the files using it so that the blob can be
+    removed by delete() once the last of them has gone. Files stored before
+    dedup was enabled are not affected.
+
+    If index is not None, it is a bdfu.index.Index in which each file stored
+    or deleted is recorded.
+
+    The total size of each user's files is kept up to date as files are
+    stored and deleted. See usage(). Methods which store files take an
+    optional quota in bytes which the total may not exceed. Chunks and the
+    partial files of upload sessions count towards the total too until they
+    are pruned, committed or abandoned.
+
+    The durability argument says when stored files are flushed to disk. With
+    "none", they are left to the operating system and a crash may lose files
+    whose ids have already been returned. With "file", each file, its digest
+    and its directory are synced before the method storing it returns. With
+    "group", files stored by different threads within sync_window seconds of
+    each other are synced together by one of them while the others wait. This
+    is as safe as "file" but costs far fewer syncs under load. Usage counters
+    are not synced; see recount_usage().
+
+    If compression names a codec from bdfu.compression, new files are
+    compressed with it as they are written and stored with the codec's suffix
+    added to their path. See locate(). Digests and StoredFile sizes are those
+    of the uncompressed contents but usage, like the index, counts the bytes
+    stored.
+
+    If metrics is a bdfu.metrics.Registry, the time spent receiving, placing
+    and syncing each file is recorded in its "bdfu_storage_seconds"
+    histogram.
+
+    """
+    def __init__(self, destdir, shard_levels=0, dedup=False, index=None,
+                 durability='none', sync_window=0.002, compression=None, metrics=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability mode: {0!r}'.format(durability))
+        if compression is not None and not available(compression):
+            raise UnsupportedCodecError('Unsupported codec: {0}'.format(compression))
+
         self.destdir = destdir
+        self.shard_levels = shard_levels
+        self.dedup = dedup
+        self.index = index
+        self.durability = durability
+        self.compression = compression
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.histogram('bdfu_storage_seconds', 'Time spent storing files by stage.')
+        self._syncer = _GroupSyncer(sync_window) if durability == 'group' else None
+
+        # Directories known to exist. This saves checking for them on every
+        # write. Sets may safely be shared between threads.
+        self._known_dirs = set()
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """Create a Storage from a mapping of configuration values such as a
+        Flask app's config. STORAGE_DIR must be set. STORAGE_SHARD_LEVELS,
+        STORAGE_DEDUP, STORAGE_INDEX, STORAGE_DURABILITY, STORAGE_SYNC_WINDOW
+        and STORAGE_COMPRESSION are optional. metrics is passed to the new
+        Storage.
+
+        If STORAGE_WRITERS is non-zero, a bdfu.writebehind.WriteBehindStorage
+        with that many writer threads wrapping the Storage is returned
+        instead. STORAGE_QUEUE_SIZE and STORAGE_QUEUE_TIMEOUT are passed to
+        it as queue_size and timeout.
+
+        """
+        index = None
+        if config.get('STORAGE_INDEX') is not None:
+            index = Index(config['STORAGE_INDEX'])
+
+        storage = cls(
+            config['STORAGE_DIR'],
+            shard_levels=config.get('STORAGE_SHARD_LEVELS', 0),
+            dedup=config.get('STORAGE_DEDUP', False),
+            index=index,
+            durability=config.get('STORAGE_DURABILITY', 'none'),
+            sync_window=config.get('STORAGE_SYNC_WINDOW', 0.002),
+            compression=config.get('STORAGE_COMPRESSION'),
+            metrics=metrics,
+        )
+
+        if config.get('STORAGE_WRITERS', 0) > 0:
+            from bdfu.writebehind import WriteBehindStorage
+            storage = WriteBehindStorage(
+                storage, writers=config['STORAGE_WRITERS'],
+                queue_size=config.get('STORAGE_QUEUE_SIZE', 64),
+                timeout=config.get('STORAGE_QUEUE_TIMEOUT', 1.0),
+            )
+            storage.recover()
+
+        return storage
+
+    def path(self, username, file_id):
+        """Return the path to the stored file with the given id. A file stored
+        compressed has its codec's suffix added to this path.
+
+        """
+        parts = [file_id[2*i:2*i+2] for i in range(self.shard_levels)]
+        return os.path.join(self._user_dir(username), *(parts + [file_id]))
+
+    def locate(self, username, file_id):
+        """Return a (path, codec) pair giving where the stored file with the
+        given id is and the codec it is compressed with, or None if it is not.
+        Raises UnknownFileError if there is no such file.
+
+        """
+        if not _ID_RE.match(file_id):
+            raise UnknownFileError(file_id)
+        located = _find_compressed(self.path(username, file_id), self.compression)
+        if located is None:
+            raise UnknownFileError(file_id)
+        return located
+
+    def write(self, username, contents, length=None):
+        """Write the contents of the file-like object *contents* to a new file
+        for *username* and return its id.
+
+        If *length* is not None, exactly that many bytes are read from
+        *contents*. This allows *contents* to be a raw stream such as a WSGI
+        input which must not be read past its end. An IOError is raised, and
+        no file is created, if fewer bytes are available.
+
+        The file is written to the user's partial directory and renamed into
+        place once complete so a half-written file is never visible. If
+        *contents* is a file returned by spool() for the same user, it is
+        renamed into place directly rather than being copied.
+
+        """
+        return self._write_file(username, contents, length).id
+
+    def store(self, username, contents, length=None, sha256=None, quota=None):
+        """As write() but return a StoredFile describing the new file.
+
+        The SHA-256 digest of the contents is computed as they are written and
+        is stored alongside the file. If *sha256* is not None, it is the hex
+        digest the contents are expected to have. DigestMismatchError is
+        raised, and no file is created, if they do not.
+
+        If *quota* is not None, QuotaExceededError is raised, and no file is
+        created, if storing the file would take the user's usage over that
+        many bytes. Reading stops as soon as this is known.
+
+        """
+        return self._write_file(username, contents, length, sha256, quota)
+
+    def write_many(self, username, files):
+        """Write each file-like object from the iterable *files* to a new file
+        for *username* and return a list of their ids in the same order.
+        Files are read one after the other so *files* may be a generator
+        producing each file only once the previous one has been written.
+
+        """
+        return [stored.id for stored in self.store_many(username, files)]
+
+    def store_many(self, username, files, quota=None):
+        """As write_many() but return a list of StoredFile tuples. The
+        *quota* argument is as for store(). Files stored before it is exceeded
+        are kept.
+
+        """
+        return [self._write_file(username, contents, quota=quota) for contents in files]
+
+    def stage(self, username, contents, length=None, sha256=None, quota=None):
+        """As store() but leave the new file in *username*'s partial directory
+        to be moved into place later by commit_staged(). The returned
+        StoredFile gives the id it will have. The file counts towards the
+        user's usage from now on and is synced as for a stored file.
+
+        """
+        f, digest = self._receive(username, contents, length, sha256, quota)
+        try:
+            size = os.path.getsize(f.name)
+            self._update_usage(username, size, quota)
+            stored = StoredFile(uuid.uuid4().hex, digest.size, digest.hexdigest())
+            staged = self._staged_path(username, stored.id) + SUFFIXES.get(f.codec, '')
+            try:
+                os.rename(f.name, staged)
+            except Exception:
+                self._update_usage(username, -size)
+                raise
+        except Exception:
+            self.discard(f)
+            raise
+
+        self._sync([staged, os.path.dirname(staged)])
+        return stored
+
+    def commit_staged(self, username, file_id, sha256=None, size=None):
+        """Move a file staged by stage() into place and return a StoredFile
+        describing it. If *sha256* or *size* is None, the digest and size of
+        the contents are computed by reading the file. Returns None if there
+        is no such staged file, e.g. because it has already been committed.
+
+        """
+        located = _find_compressed(self._staged_path(username, file_id), self.compression)
+        if located is None:
+            return None
+        staged, codec = located
+
+        try:
+            if size is None and codec is None:
+                size = os.stat(staged).st_size
+            if sha256 is None or size is None:
+                digest = _hash_file(staged, codec)
+                sha256, size = digest.hexdigest(), digest.size
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        stored = StoredFile(file_id, size, sha256)
+        try:
+            self._place_file(username, staged, stored, codec)
+        except (IOError, OSError) as e:
+            # Another process recovering staged files may have got there first
+            if e.errno != errno.ENOENT or os.path.exists(staged):
+                raise
+            return None
+        return self._finish(username, stored, codec)
+
+    def iter_staged(self):
+        """Yield a (username, file_id) pair for each file staged by stage()
+        but not yet committed.
+
+        """
+        try:
+            usernames = sorted(os.listdir(self.destdir))
+        except OSError as e:
+            # Nothing has been stored yet
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for username in usernames:
+            if username == BLOB_DIR:
+                continue
+            try:
+                names = os.listdir(os.path.join(self._user_dir(username), PARTIAL_DIR))
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            for name in sorted(names):
+                if not name.startswith(STAGED_PREFIX):
+                    continue
+                match = _STORED_NAME_RE.match(name[len(STAGED_PREFIX):])
+                if match is not None:
+                    yield username, match.group(1)
+
+    def delete(self, username, file_id):
+        """Remove a stored file. Raises UnknownFileError if there is no such
+        file. If the file's contents are shared with other files, they are
+        only removed along with the last of them.
+
+        """
+        path, codec = self.locate(username, file_id)
+        base_path = self.path(username, file_id)
+
+        try:
+            sha256 = self.sha256(username, file_id)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            sha256 = None
+
+        try:
+            size = os.stat(path).st_size
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise UnknownFileError(file_id)
+        _unlink_if_exists(base_path + DIGEST_SUFFIX)
+        self._update_usage(username, -size)
+
+        if sha256 is not None:
+            self._release_blob(sha256, codec)
+        if self.index is not None:
+            self.index.remove(file_id)
+
+    def sha256(self, username, file_id):
+        """Return the hex SHA-256 digest recorded for a stored file."""
+        return _read_digest(self.path(username, file_id))
+
+    def usage(self, username):
+        """Return the total size in bytes of the files, chunks and session
+        data stored for *username*, as stored on disk. This is read from a
+        counter rather than computed.
+
+        """
+        try:
+            with open(os.path.join(self._user_dir(username), USAGE_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def recount_usage(self):
+        """Set every user's usage counter from the sizes of their files,
+        chunks and sessions. This is only needed for files stored before usage
+        was counted and should not be run while files are being stored or
+        deleted.
+
+        """
+        # Users whose files have all gone are reset to zero
+        totals = {}
+        for username in os.listdir(self.destdir):
+            if username != BLOB_DIR and os.path.isdir(self._user_dir(username)):
+                totals[username] = 0
+        for username, stored, _ in self.iter_files():
+            totals[username] += stored.size
+        for username in totals:
+            user_dir = self._user_dir(username)
+            for dirpath, _, filenames in os.walk(os.path.join(user_dir, CHUNK_DIR)):
+                for filename in filenames:
+                    totals[username] += os.path.getsize(os.path.join(dirpath, filename))
+            partial_dir = os.path.join(user_dir, PARTIAL_DIR)
+            if not os.path.isdir(partial_dir):
+                continue
+            for filename in os.listdir(partial_dir):
+                if _ID_RE.match(filename):
+                    path = os.path.join(partial_dir, filename)
+                    size = os.path.getsize(path)
+                    _write_count(path + SESSION_CHARGE_SUFFIX, size)
+                    totals[username] += size
+        for username in totals:
+            self._update_usage(username, totals[username] - self.usage(username))
+        return totals
+
+    def spool(self, username, length=None):
+        """Return a new, empty file in *username*'s partial directory which is
+        open for reading and writing. It may be used to receive an upload
+        which can then be passed to write() without copying. If it is not
+        written, it should be removed with discard().
+
+        If *length* is not None, disk space for that many bytes is allocated
+        up front. This fails early if the disk is full and lets the filesystem
+        keep the file contiguous. Space beyond the data written is released
+        once the file is finished. With compression, data written to the file
+        is compressed and no space is allocated.
+
+        """
+        return self._spool(username, length, self.compression)
+
+    def _spool(self, username, length=None, codec=None):
+        name = SPOOL_PREFIX + uuid.uuid4().hex
+        f = SpooledFile(open(os.path.join(self._partial_dir(username), name), 'w+b'), codec)
+        if length and codec is None:
+            try:
+                _preallocate(f, length)
+            except Exception:
+                self.discard(f)
+                raise
+        return f
+
+    def discard(self, fobj):
+        """Close a file returned by spool() and remove it if it has not been
+        written to storage.
+
+        """
+        fobj.close()
+        _unlink_if_exists(fobj.name)
+
+    def create_session(self, username):
+        """Start a new upload session for *username* and return its id. The
+        session is backed by an initially empty partial file which is
+        written to by write_session() and moved into place by
+        commit_session().
+
+        """
+        session_id = uuid.uuid4().hex
+        open(os.path.join(self._partial_dir(username), session_id), 'wb').close()
+        return session_id
+
+    def session_offset(self, username, session_id):
+        """Return the number of bytes received so far for a session."""
+        return os.path.getsize(self._session_path(username, session_id))
+
+    def write_session(self, username, session_id, offset, contents, length=None, quota=None):
+        """Write the contents of *contents* into a session's partial file
+        starting at byte *offset* and return the offset just past the last
+        byte written. The *length* argument is as for write(). Any data
+        received before an error is kept so that the upload may be resumed.
+        If *quota* is not None, QuotaExceededError is raised once the file
+        would no longer fit within it. Data written beyond the end of the
+        file counts towards the user's usage.
+
+        """
+        path = self._session_path(username, session_id)
+        limit = None
+        if quota is not None:
+            # Only data written past the end of the file adds to usage
+            limit = self._allowance(username, quota, length, offset - os.path.getsize(path))
+
+        try:
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                try:
+                    _copy(contents, f, length, limit=limit)
+                except _LimitExceeded:
+                    raise QuotaExceededError(quota, self.usage(username))
+                return f.tell()
+        finally:
+            self._charge_session(username, path)
+
+    def commit_session(self, username, session_id, sha256=None, quota=None):
+        """Close an upload session, turning its partial file into a stored
+        file. Returns a StoredFile describing it.
+
+        Since parts of a session may be written in any order, the digest is
+        computed by reading the partial file once here. If *sha256* is given
+        and does not match, DigestMismatchError is raised and the session is
+        left open. Likewise for QuotaExceededError if *quota* is given.
+
+        """
+        path = self._session_path(username, session_id)
+        digest = _hash_file(path)
+        _check_digest(sha256, digest)
+
+        # The stored file is charged in place of the session's data
+        self._charge_session(username, path, uncharge=True)
+        try:
+            if self.compression is None:
+                return self._commit(username, path, digest, quota)
+
+            # Parts may have been written in any order so the file can only
+            # be compressed once it is complete.
+            f = self.spool(username)
+            try:
+                with f:
+                    with open(path, 'rb') as src:
+                        _copy(src, f)
+                stored = self._commit(username, f.name, digest, quota, f.codec)
+            except Exception:
+                self.discard(f)
+                raise
+        except Exception:
+            self._charge_session(username, path)
+            raise
+        os.unlink(path)
+        return stored
+
+    def delete_session(self, username, session_id):
+        """Abandon an upload session, discarding any data received."""
+        path = self._session_path(username, session_id)
+        os.unlink(path)
+        self._charge_session(username, path, uncharge=True)
+
+    def missing_chunks(self, username, chunks):
+        """Return a list of those digests from the sequence chunks for which
+        *username* has not uploaded a chunk. Each is listed once, in order of
+        first appearance. Chunks which are present are marked as used so that
+        prune_chunks() keeps them.
+
+        """
+        missing, seen = [], set()
+        for sha256 in chunks:
+            if sha256 in seen:
+                continue
+            seen.add(sha256)
+            try:
+                os.utime(self._chunk_path(username, sha256), None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                missing.append(sha256)
+        return missing
+
+    def write_chunk(self, username, sha256, contents, length=None, quota=None):
+        """Store the contents of *contents* as a chunk for *username* with the
+        hex SHA-256 digest *sha256*. The *length* and *quota* arguments are
+        as for store(); chunks count towards the user's usage until pruned.
+        DigestMismatchError is raised if the contents have a different digest.
+        Writing a chunk which already exists does nothing.
+
+        """
+        path = self._chunk_path(username, sha256)
+        if os.path.exists(path):
+            # Nothing will be charged so the quota need not be checked
+            quota = None
+        limit = None
+        if quota is not None:
+            limit = self._allowance(username, quota, length)
+
+        f = self._spool(username, length)
+        try:
+            try:
+                with f:
+                    _copy(contents, f, length, limit=limit)
+            except _LimitExceeded:
+                raise QuotaExceededError(quota, self.usage(username))
+            _check_digest(sha256, f.digest())
+
+            # Linking rather than renaming fails if the chunk already exists,
+            # in which case it has already been charged for.
+            size = os.path.getsize(f.name)
+            self._update_usage(username, size, quota)
+            self._ensure_dir(os.path.dirname(path))
+            try:
+                os.link(f.name, path)
+            except OSError as e:
+                self._update_usage(username, -size)
+                if e.errno != errno.EEXIST:
+                    raise
+                return
+        finally:
+            _unlink_if_exists(f.name)
+        self._sync([path, os.path.dirname(path)])
+
+    def assemble(self, username, chunks, sha256=None, quota=None):
+        """Store a new file for *username* made by joining the chunks with the
+        digests in the sequence chunks and return a StoredFile describing it.
+        Raises MissingChunksError if any chunks have not been uploaded. The
+        *sha256* and *quota* arguments are as for store().
+
+        """
+        missing = self.missing_chunks(username, chunks)
+        if len(missing) > 0:
+            raise MissingChunksError(missing)
+
+        f = self.spool(username)
+        try:
+            for chunk in chunks:
+                try:
+                    with open(self._chunk_path(username, chunk), 'rb') as src:
+                        _copy(src, f)
+                except IOError as e:
+                    # The chunk has been pruned since it was checked for
+                    if e.errno != errno.ENOENT:
+                        raise
+                    raise MissingChunksError([chunk])
+            return self._write_file(username, f, sha256=sha256, quota=quota)
+        finally:
+            self.discard(f)
+
+    def prune_chunks(self, max_age):
+        """Remove every chunk which has not been uploaded or used within the
+        last max_age seconds, crediting their size back to their user's
+        usage. Returns the number of chunks removed.
+
+        """
+        removed, cutoff = 0, time.time() - max_age
+        for username in os.listdir(self.destdir):
+            chunk_dir = os.path.join(self._user_dir(username), CHUNK_DIR)
+            for dirpath, dirnames, filenames in os.walk(chunk_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                        if st.st_mtime >= cutoff:
+                            continue
+                        os.unlink(path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue
+                    self._update_usage(username, -st.st_size)
+                    removed += 1
+        return removed
+
+    def iter_files(self):
+        """Yield a (username, stored, mtime) tuple for every stored file,
+        wherever it is in the tree, where stored is a StoredFile and mtime the
+        file's modification time. The layout need not match shard_levels.
+        StoredFile.sha256 is None for files stored before digests were
+        recorded. StoredFile.size is the size of the file on disk, which is
+        smaller than that of its contents if it is stored compressed.
+
+        """
+        for username in sorted(os.listdir(self.destdir)):
+            user_dir = self._user_dir(username)
+            if username == BLOB_DIR or not os.path.isdir(user_dir):
+                continue
+            for dirpath, dirnames, filenames in os.walk(user_dir):
+                if dirpath == user_dir:
+                    dirnames[:] = [d for d in dirnames if d not in (PARTIAL_DIR, CHUNK_DIR)]
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    match = _STORED_NAME_RE.match(filename)
+                    if match is None:
+                        continue
+                    file_id = match.group(1)
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                        sha256 = _read_digest(os.path.join(dirpath, file_id))
+                    except (IOError, OSError) as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        if not os.path.exists(path):
+                            # Removed since it was listed
+                            continue
+                        sha256 = None
+                    yield username, StoredFile(file_id, st.st_size, sha256), st.st_mtime
+
+    def migrate(self):
+        """Move every stored file in to the location given by the current
+        layout. This converts a store written with a different value of
+        shard_levels to the current one. Digests are moved with their files.
+        Returns the number of files moved.
+        Sub-directories left empty are removed.
+
+        """
+        moved = 0
+        for username in os.listdir(self.destdir):
+            user_dir = self._user_dir(username)
+            if username == BLOB_DIR or not os.path.isdir(user_dir):
+                continue
+
+            # Walk bottom-up so that emptied directories can be removed
+            for dirpath, dirnames, filenames in os.walk(user_dir, topdown=False):
+                parts = os.path.relpath(dirpath, user_dir).split(os.sep)
+                if PARTIAL_DIR in parts or CHUNK_DIR in parts:
+                    continue
+                for filename in filenames:
+                    match = _ID_PREFIX_RE.match(filename)
+                    if match is None:
+                        continue
+                    src = os.path.join(dirpath, filename)
+                    dst = os.path.join(
+                        os.path.dirname(self.path(username, match.group(0))), filename)
+                    if src != dst:
+                        self._ensure_dir(os.path.dirname(dst))
+                        os.rename(src, dst)
+                        if not filename.endswith(DIGEST_SUFFIX):
+                            moved += 1
+                if dirpath != user_dir and len(os.listdir(dirpath)) == 0:
+                    os.rmdir(dirpath)
+                    self._known_dirs.discard(dirpath)
+
+        return moved
+
+    def _write_file(self, username, contents, length=None, sha256=None, quota=None):
+        f, digest = self._receive(username, contents, length, sha256, quota)
+        try:
+            return self._commit(username, f.name, digest, quota, f.codec)
+        except Exception:
+            self.discard(f)
+            raise
+
+    def _receive(self, username, contents, length=None, sha256=None, quota=None):
+        """Spool contents into username's partial directory, unless they
+        already are, and return the spooled file and its digest. Nothing is
+        left behind if the contents do not match sha256 or cannot fit within
+        quota.
+
+        """
+        with timer(self.metrics, 'bdfu_storage_seconds', stage='receive'):
+            return self._receive_file(username, contents, length, sha256, quota)
+
+    def _receive_file(self, username, contents, length, sha256, quota):
+        if self._spooled_path(username, contents) is not None:
+            f = contents
+            f.finish()
+        else:
+            # Give up as soon as the file cannot fit within the quota. The
+            # quota is checked again on commit since other files may have been
+            # stored in the meantime.
+            limit = None
+            if quota is not None:
+                limit = self._allowance(username, quota, length)
+
+            f = self.spool(username, length)
+            try:
+                with f:
+                    _copy(contents, f, length, limit=limit)
+            except _LimitExceeded:
+                os.unlink(f.name)
+                raise QuotaExceededError(quota, self.usage(username))
+            except Exception:
+                os.unlink(f.name)
+                raise
+
+        try:
+            digest = f.digest()
+            _check_digest(sha256, digest)
+        except Exception:
+            self.discard(f)
+            raise
+        return f, digest
+
+    def _commit(self, username, partial_path, digest, quota=None, codec=None):
+        """Atomically move a complete file from the partial directory into
+        place and return a StoredFile describing it. The digest is written
+        first so that a stored file always has one. The file's size on disk is
+        added to the user's usage beforehand so that concurrent commits cannot
+        together exceed quota. codec is the codec the file is compressed with.
+
+        """
+        size = os.path.getsize(partial_path)
+        self._update_usage(username, size, quota)
+
+        stored = StoredFile(uuid.uuid4().hex, digest.size, digest.hexdigest())
+        try:
+            self._place_file(username, partial_path, stored, codec)
+        except Exception:
+            self._update_usage(username, -size)
+            raise
+
+        return self._finish(username, stored, codec)
+
+    def _place_file(self, username, partial_path, stored, codec=None):
+        """Move partial_path into place as the file described by stored."""
+        destfile = self.path(username, stored.id)
+        with timer(self.metrics, 'bdfu_storage_seconds', stage='place'):
+            try:
+                self._place(partial_path, destfile, stored.sha256, codec)
+            except (IOError, OSError) as e:
+                # The directory may have been removed behind our back
+                if e.errno != errno.ENOENT or not os.path.exists(partial_path):
+                    raise
+                self._known_dirs.discard(os.path.dirname(destfile))
+                self._place(partial_path, destfile, stored.sha256, codec)
+
+    def _finish(self, username, stored, codec=None):
+        """Sync and index a file which has been moved into place."""
+        destfile = self.path(username, stored.id)
+        paths = [destfile + SUFFIXES.get(codec, ''), destfile + DIGEST_SUFFIX,
+                 os.path.dirname(destfile)]
+        blob_dir = os.path.dirname(self._blob_path(stored.sha256))
+        if self.dedup and os.path.isdir(blob_dir):
+            paths.append(blob_dir)
+        with timer(self.metrics, 'bdfu_storage_seconds', stage='sync'):
+            self._sync(paths)
+
+        if self.index is not None:
+            # The index records the size on disk, as iter_files() reports it,
+            # so that a rebuilt index agrees with one kept up to date.
+            on_disk = stored
+            if codec is not None:
+                on_disk = stored._replace(size=os.path.getsize(paths[0]))
+            self.index.record(username, on_disk)
+        return stored
+
+    def _allowance(self, username, quota, length=None, offset=0):
+        """Return the number of bytes which may be written at offset into a
+        new file within quota. Raises QuotaExceededError if length bytes
+        will not fit. A negative offset is the number of bytes to be written
+        over ones already counted towards usage.
+
+        """
+        usage = self.usage(username)
+        allowance = quota - usage - offset
+        if allowance < 0 or (length is not None and length > allowance):
+            raise QuotaExceededError(quota, usage)
+        return allowance
+
+    def _update_usage(self, username, delta, quota=None):
+        """Add delta to the usage counter for username. If quota is not None
+        and the counter would exceed it, raise QuotaExceededError instead. The
+        counter is locked while it is updated so that several processes may
+        update it at once.
+
+        """
+        self._with_usage(username, lambda usage: delta, quota)
+
+    def _with_usage(self, username, get_delta, quota=None):
+        """As _update_usage() but the delta is returned by calling get_delta
+        with the current usage while the counter is locked.
+
+        """
+        path = os.path.join(self._user_dir(username), USAGE_FILE)
+        self._ensure_dir(os.path.dirname(path))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            usage = int(f.read().strip() or 0)
+            delta = get_delta(usage)
+            if quota is not None and delta > 0 and usage + delta > quota:
+                raise QuotaExceededError(quota, usage)
+
+            # Overwrite the counter in place with a fixed-width value so that
+            # it is never seen truncated.
+            f.seek(0)
+            f.write('{0:20d}\n'.format(max(usage + delta, 0)))
+
+    def _charge_session(self, username, path, uncharge=False):
+        """Bring the usage charged for the session partial file at path into
+        line with its size or, if uncharge is True, credit back everything
+        charged for it. The charge is recorded alongside the file so that
+        concurrent writes to the session are charged once.
+
+        """
+        charge_path = path + SESSION_CHARGE_SUFFIX
+
+        def get_delta(usage):
+            charged = _read_count(charge_path)
+            if uncharge:
+                _unlink_if_exists(charge_path)
+                return -charged
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                # Abandoned, and so uncharged, while being written
+                if e.errno != errno.ENOENT:
+                    raise
+                return 0
+            if size != charged:
+                _write_count(charge_path, size)
+            return size - charged
+
+        self._with_usage(username, get_delta)
+
+    def _place(self, partial_path, destfile, sha256, codec=None):
+        """Write the digest file for destfile and rename partial_path to it,
+        adding the suffix for codec if it is compressed.
+
+        """
+        self._ensure_dir(os.path.dirname(destfile))
+        with open(destfile + DIGEST_SUFFIX, 'w') as f:
+            f.write('{0}  {1}\n'.format(sha256, os.path.basename(destfile)))
+        destfile += SUFFIXES.get(codec, '')
+        if self.dedup and self._link_blob(sha256, partial_path, destfile, codec):
+            return
+        os.rename(partial_path, destfile)
+
+    def _link_blob(self, sha256, partial_path, destfile, codec=None):
+        """Create destfile as a link to the blob for sha256, making
+        partial_path that blob if there is not one already. Returns False,
+        having done nothing, if links cannot be made, e.g. because the blob is
+        on another filesystem or has too many links. Blobs compressed with
+        different codecs are kept apart.
+
+        """
+        blob = self._blob_path(sha256, codec)
+        for _ in range(2):
+            try:
+                os.link(blob, destfile)
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EMLINK):
+                    return False
+                if e.errno != errno.ENOENT:
+                    raise
+                if os.path.exists(blob):
+                    # It is destfile's directory which has gone
+                    raise
+            else:
+                os.unlink(partial_path)
+                return True
+
+            # There is no blob yet so the new file becomes it. Another writer
+            # may get there first, in which case link to theirs instead.
+            self._ensure_dir(os.path.dirname(blob))
+            try:
+                os.link(partial_path, blob)
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EMLINK):
+                    return False
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            os.rename(partial_path, destfile)
+            return True
+
+        return False
+
+    def _release_blob(self, sha256, codec=None):
+        """Remove the blob for sha256 if no stored file links to it."""
+        blob = self._blob_path(sha256, codec)
+        try:
+            if os.stat(blob).st_nlink > 1:
+                return
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        # If a writer links to the blob between the check above and here, its
+        # file still has the contents but they will not be shared with later
+        # copies. Nothing is lost.
+        _unlink_if_exists(blob)
+
+    def _chunk_path(self, username, sha256):
+        if not _SHA256_RE.match(sha256):
+            raise ValueError('Bad chunk digest: {0!r}'.format(sha256))
+        return os.path.join(self._user_dir(username), CHUNK_DIR, sha256[:2], sha256)
+
+    def _blob_path(self, sha256, codec=None):
+        return os.path.join(self.destdir, BLOB_DIR, sha256[:2], sha256[2:4],
+                            sha256 + SUFFIXES.get(codec, ''))
+
+    def _spooled_path(self, username, contents):
+        """Return the path to *contents* if it is a file returned by spool()
+        for *username* or None otherwise.
+
+        """
+        if not isinstance(contents, SpooledFile):
+            return None
+        path = os.path.abspath(contents.name)
+        partial_dir = os.path.abspath(os.path.join(self._user_dir(username), PARTIAL_DIR))
+        if os.path.dirname(path) != partial_dir:
+            return None
+        if not os.path.basename(path).startswith(SPOOL_PREFIX):
+            return None
+        return path
+
+    def _staged_path(self, username, file_id):
+        return os.path.join(self._user_dir(username), PARTIAL_DIR, STAGED_PREFIX + file_id)
+
+    def _session_path(self, username, session_id):
+        """Return the path to a session's partial file or raise
+        UnknownSessionError if there is no such session.
+
+        """
+        if not _ID_RE.match(session_id):
+            raise UnknownSessionError(session_id)
+        path = os.path.join(self._user_dir(username), PARTIAL_DIR, session_id)
+        if not os.path.isfile(path):
+            raise UnknownSessionError(session_id)
+        return path
+
+    def _partial_dir(self, username):
+        """Return the partial directory for *username*, creating it if
+        necessary.
+
+        """
+        partial_dir = os.path.join(self._user_dir(username), PARTIAL_DIR)
+        self._ensure_dir(partial_dir)
+        return partial_dir
+
+    def _ensure_dir(self, path):
+        """Create the directory path if it does not already exist."""
+        if path in self._known_dirs:
+            return
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # Another writer may have created it first
+            if e.errno != errno.EEXIST:
+                raise
+
+        # New directories are only durable once their parents are synced
+        if self.durability != 'none':
+            parents, destdir = [], os.path.abspath(self.destdir)
+            parent = os.path.abspath(path)
+            while parent != destdir and parent != os.path.dirname(parent):
+                parent = os.path.dirname(parent)
+                parents.append(parent)
+            self._sync(parents)
+
+        self._known_dirs.add(path)
+
+    def _sync(self, paths):
+        """Flush the files and directories in paths to disk as required by
+        the durability mode.
+
+        """
+        if self.durability == 'file':
+            for path in paths:
+                _fsync_path(path)
+        elif self.durability == 'group':
+            self._syncer.sync(paths)
+
+    def _user_dir(self, username):
+        # Formatting the username allows proxy objects such as Flask-JWT's
+        # current_user to be passed directly.
+        return os.path.join(self.destdir, '%s' % (username,))
+
+class _GroupSyncer(object):
+    """Syncs paths given by several threads together. The first thread to
+    call sync() waits window seconds for others and then syncs every path
+    given in the meantime while the others wait for it to finish.
+
+    """
+    def __init__(self, window):
+        self.window = window
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._leading = False
+
+    def sync(self, paths):
+        """Return once paths have been synced or raise the error from doing
+        so.
+
+        """
+        entry = dict(paths=paths, done=False, error=None)
+        with self._cond:
+            self._waiting.append(entry)
+            while not entry['done']:
+                if self._leading:
+                    self._cond.wait()
+                    continue
+
+                # No other thread is syncing so this one does it for everyone
+                # waiting, including those arriving during the window.
+                self._leading = True
+                try:
+                    self._cond.release()
+                    try:
+                        time.sleep(self.window)
+                    finally:
+                        self._cond.acquire()
+                    batch, self._waiting = self._waiting, []
+
+                    error = None
+                    self._cond.release()
+                    try:
+                        synced = set()
+                        for other in batch:
+                            for path in other['paths']:
+                                if path not in synced:
+                                    _fsync_path(path)
+                                    synced.add(path)
+                    except Exception as e:
+                        error = e
+                    finally:
+                        self._cond.acquire()
+
+                    for other in batch:
+                        other['error'], other['done'] = error, True
+                finally:
+                    self._leading = False
+                    self._cond.notify_all()
+
+        if entry['error'] is not None:
+            raise entry['error']
+
+class SpooledFile(object):
+    """A file returned by Storage.spool(). It behaves as the underlying file
+    object but computes the digest of data as it is written so that the
+    contents need not be read again when stored.
+
+    If codec is not None, data written is compressed with it and the file can
+    only be written sequentially. The compressed stream is ended by finish(),
+    which is called on seeking or leaving a with block.
+
+    """
+    def __init__(self, fobj, codec=None):
+        self._fobj = fobj
+        self._digest = _Digest()
+        self.codec = codec
+        self._writer = CompressingWriter(fobj, codec) if codec is not None else None
+        self._finished = False
+
+    def write(self, data):
+        if self._writer is not None:
+            if self._finished:
+                raise IOError('Compressed file is finished')
+            self._digest.update(data)
+            return self._writer.write(data)
+
+        # The digest is only valid while the file is written sequentially
+        # from its start. Otherwise it must be computed when needed.
+        if self._digest is not None:
+            if self._fobj.tell() == self._digest.size:
+                self._digest.update(data)
+            else:
+                self._digest = None
+        return self._fobj.write(data)
+
+    def finish(self):
+        """End the compressed stream, if any, and flush the file. A file
+        written sequentially is truncated to the data written so that space
+        allocated for more is not kept as part of its contents.
+
+        """
+        if self._writer is not None and not self._finished:
+            self._writer.close()
+            self._finished = True
+        elif self._writer is None and self._digest is not None:
+            self._fobj.truncate(self._digest.size)
+        self._fobj.flush()
+
+    def seek(self, *args):
+        self.finish()
+        return self._fobj.seek(*args)
+
+    def digest(self):
+        """Return the digest of the file's contents."""
+        if self._digest is None:
+            self._digest = _hash_file(self.name, self.codec)
+        return self._digest
+
+    def written_directly(self):
+        """Note that the file has been written other than by write(), e.g. by
+        the kernel, so that the digest must be computed when needed.
+
+        """
+        self._digest = None
+
+    def __getattr__(self, name):
+        return getattr(self._fobj, name)
+
+    def __iter__(self):
+        return iter(self._fobj)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if not self._fobj.closed:
+                self.finish()
+        finally:
+            self._fobj.close()
+
+class _Digest(object):
+    """A SHA-256 hash of some data together with the data's length. It has a
+    write() method so that data may be copied into it.
+
+    """
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+    write = update
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+def parse_digest_header(value):
+    """Return the hex SHA-256 digest from the value of a Digest (RFC 3230) or
+    Content-Digest (RFC 9530) header or None if it does not contain one.
+    Digests using other algorithms are ignored. Raises ValueError if the value
+    is malformed.
+
+    """
+    for item in value.split(','):
+        algorithm, _, encoded = item.partition('=')
+        if algorithm.strip().lower() != 'sha-256':
+            continue
+        # Content-Digest wraps the value as a byte sequence, e.g. ":...:", and
+        # may add parameters after a semicolon.
+        encoded = encoded.split(';')[0].strip().strip(':')
+        try:
+            raw = base64.b64decode(encoded.encode('ascii'))
+        except (binascii.Error, TypeError, UnicodeError):
+            raise ValueError('Bad digest: {0}'.format(item))
+        if len(raw) != hashlib.sha256().digest_size:
+            raise ValueError('Bad digest: {0}'.format(item))
+        return binascii.hexlify(raw).decode('ascii')
+    return None
+
+def _find_compressed(path, codec=None):
+    """Return a (path, codec) pair for the file stored at path, which may
+    have had a codec's suffix added to it, or None if there is none. The
+    suffix for codec is tried first.
+
+    """
+    for c in [codec] + [c for c in [None] + sorted(SUFFIXES) if c != codec]:
+        candidate = path + SUFFIXES.get(c, '')
+        if os.path.isfile(candidate):
+            return candidate, c
+    return None
+
+def _read_digest(path):
+    """Return the hex digest recorded for the stored file at path."""
+    with open(path + DIGEST_SUFFIX) as f:
+        return f.read().split()[0]
+
+def _kernel_copy(src, dst, length=None, limit=None):
+    """Copy as for _copy() using copy_file_range() or sendfile() if src and
+    dst are both regular files. Returns False, having copied nothing, if
+    neither can be used.
+
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is None and sendfile is None:
+        return False
+    if not _is_plain_file(src) or not _is_plain_file(dst):
+        return False
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        src_st = os.fstat(src_fd)
+        if not stat.S_ISREG(src_st.st_mode) or not stat.S_ISREG(os.fstat(dst_fd).st_mode):
+            return False
+        src_start = src.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+    # Let a short source be reported in the usual way
+    count = max(src_st.st_size - src_start, 0)
+    if length is not None:
+        if count < length:
+            return False
+        count = length
+    if limit is not None and count > limit:
+        raise _LimitExceeded()
+
+    # Data buffered by the file objects must be accounted for before the
+    # kernel works on the descriptors directly.
+    dst.flush()
+    dst_start = dst.tell()
+    copied = 0
+    while copied < count:
+        n = None
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(src_fd, dst_fd, count - copied,
+                                    src_start + copied, dst_start + copied)
+            except OSError as e:
+                # Not supported between these files, e.g. on older kernels
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                copy_file_range = None
+        if n is None:
+            if sendfile is None:
+                if copied > 0:
+                    break
+                return False
+            os.lseek(dst_fd, dst_start + copied, os.SEEK_SET)
+            n = sendfile(dst_fd, src_fd, src_start + copied, count - copied)
+        if n == 0:
+            break
+        copied += n
+
+    if isinstance(dst, SpooledFile):
+        dst.written_directly()
+    src.seek(src_start + copied)
+    dst.seek(dst_start + copied)
+    if copied < count:
+        # The source shrank while being copied; finish in the usual way
+        _copy(src, dst, count - copied)
+    return True
+
+def _is_plain_file(fobj):
+    """Return True if the bytes read from or written to fobj are those of the
+    file its fileno() refers to. Wrappers such as gzip.GzipFile also have a
+    fileno() but it is that of the compressed file.
+
+    """
+    if isinstance(fobj, SpooledFile):
+        # Compressed data must pass through the compressor
+        return fobj.codec is None
+    if isinstance(fobj, (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)):
+        fobj = fobj.raw
+    return isinstance(fobj, io.FileIO)
+
+def _hash_file(path, codec=None):
+    """Return a _Digest of the contents of the file at path. The file is
+    mapped into memory so that it is hashed without being copied. If codec
+    is not None, the file is decompressed with it as it is read instead.
+
+    """
+    digest = _Digest()
+    with open(path, 'rb') as f:
+        if codec is not None:
+            _copy(DecompressingReader(f, codec), digest)
+            return digest
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest
+        try:
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            _copy(f, digest)
+            return digest
+        try:
+            digest.update(contents)
+        finally:
+            contents.close()
+    return digest
+
+def _preallocate(fobj, length):
+    """Allocate disk space for length bytes from the current position of the
+    file object fobj where the platform and filesystem support it.
+
+    """
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fobj.fileno(), fobj.tell(), length)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+
+def _read_count(path):
+    """Return the number in the file at path or zero if there is none."""
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+def _write_count(path, count):
+    """Replace the file at path with one holding the number count."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('{0}\n'.format(count))
+    os.rename(tmp_path, path)
+
+def _fsync_path(path):
+    """Flush the file or directory at path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _unlink_if_exists(path):
+    """Remove path, ignoring the error if it does not exist."""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _check_digest(expected, digest):
+    """Raise DigestMismatchError unless expected is None or equal to the hex
+    digest of the _Digest digest.
+
+    """
+    if expected is not None and expected.lower() != digest.hexdigest():
+        raise DigestMismatchError(expected, digest.hexdigest())
+
+class _LimitExceeded(Exception):
+    """Raised by _copy() when asked to copy more than its limit."""
+
+_buffers = threading.local()
+
+def _copy(src, dst, length=None, limit=None):
+    """Copy from file-like src to dst. If length is not None, copy exactly
+    length bytes or raise IOError if src is exhausted first. If limit is not
+    None, raise _LimitExceeded as soon as more than that many bytes have been
+    read.
+
+    If both are regular files, the kernel copies the data without it passing
+    through Python. Otherwise it is copied COPY_BUFFER_SIZE bytes at a time
+    through a buffer reused between calls.
+
+    """
+    if _kernel_copy(src, dst, length, limit):
+        return
+
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+
+    readinto = getattr(src, 'readinto', None)
+    remaining, copied = length, 0
+    while remaining is None or remaining > 0:
+        size = COPY_BUFFER_SIZE if remaining is None else min(COPY_BUFFER_SIZE, remaining)
+        if readinto is not None:
+            n = readinto(view[:size])
+            data = view[:n or 0]
+        else:
+            data = src.read(size)
+        if not data:
+            break
+        copied += len(data)
+        if limit is not None and copied > limit:
+            raise _LimitExceeded()
+        dst.write(data)
+        if remaining is not None:
+            remaining -= len(data)
 
-    def write(self, username, contents):
-        file_id = uuid.uuid4().hex
-        destfile = os.path.join(self.destdir, username, file_id)
-        if not os.path.exists(os.path.dirname(destfile)):
-            os.makedirs(os.path.dirname(destfile))
-        with open(destfile, 'wb') as f:
-            copyfileobj(contents, f)
-        return file_id
+    if remaining is not None and remaining > 0:
+        raise IOError('Unexpected end of input: {0} byte(s) missing'.format(remaining))
@@ -3,9 +3,15 @@ Command-line tool for the BDFU server.
 
 Usage:
     bdfu (-h | --help)
-    bdfu upload <endpoint> <token> <file>
-    bdfu gen-token [--expires-in=SECONDS] <username> <secret>
-    bdfu serve [--ip=ADDR] [--port=PORT] [<configuration>]
+    bdfu upload [--resumable | --parallel=N | --compress=CODEC] [--dedup] [--concurrency=N] <endpoint> <token> <file>...
+    bdfu gen-token [--expires-in=SECONDS] [--quota=BYTES] <username> <secret>
+    bdfu gen-token [--expires-in=SECONDS] [--quota=BYTES] [--processes=N] --from-file=FILE <secret>
+    bdfu serve [--ip=ADDR] [--port=PORT] [--workers=N] [--threads=M] [<configuration>]
+    bdfu migrate-storage [--shard-levels=N] <storage-dir>
+    bdfu prune-chunks [--max-age=DAYS] <storage-dir>
+    bdfu recount-usage <storage-dir>
+    bdfu index rebuild <storage-dir> <index-file>
+    bdfu index usage [--days=N] <index-file> [<username>]
 
 General Options:
 
@@ -15,7 +21,18 @@ Uploading files:
 
     <endpoint>                  URL of API endpoint. See below.
     <token>                     Token to present as authorisation.
-    <file>                      Path to file to upload.
+    <file>                      Path to file or directory to upload or "-"
+                                for standard input.
+    --resumable                 Upload in chunks, resuming after connection
+                                failures.
+    --parallel=N                Upload parts of the file over N concurrent
+                                connections.
+    --dedup                     Only send the parts of the file which the
+                                server does not already have. They are sent
+                                concurrently if used with --parallel.
+    --compress=CODEC            Compress the file as it is sent with "gzip" or
+                                "zstd". Cannot be used with --dedup.
+    --concurrency=N             Upload up to N files at once. [default: 1]
 
 The <endpoint> option specifies the URL of the API. For example, if you have
 configured BDFU as a CGI script, this will probably be something like
@@ -23,13 +40,28 @@ http://example.com/cgi-bin/bdfu/. THE TRAILING SLASH IS IMPORTANT.
 
 If upload succeeds, the file id is written to standard output.
 
+More than one file may be given. Directories are searched recursively for
+files to upload. In this case a line containing the file id and path is
+written to standard output for each file uploaded successfully. Failures are
+reported on standard error and the exit status is non-zero if any occurred.
+
 Generating tokens:
 
     -e, --expires-in=SECONDS    Set token expiry to SECONDS into the future.
                                 [default: 60]
+    --quota=BYTES               Limit the total size of the user's files.
+    --from-file=FILE            Generate a token for each user named on a line
+                                of FILE or, if FILE is "-", standard input.
+    --processes=N               Generate tokens from a file in N processes.
+                                [default: 1]
 
 The gen-token sub-command will generate a new access token for the specified
-user with an optionally specified expiry time.
+user with an optionally specified expiry time. A quota given in the token
+overrides the QUOTA and USER_QUOTAS configuration settings.
+
+With --from-file, a line of JSON with "user" and "token" keys is written for
+each user in the order they are named. Blank lines are ignored. All of the
+tokens expire at the same time.
 
 Simple server:
 
@@ -38,21 +70,64 @@ Simple server:
     --port=PORT                 Specify port number to bind to for server.
                                 [default: 8080]
 
+    --workers=N                 Number of worker processes. Defaults to the
+                                number of CPUs.
+    --threads=M                 Number of threads per worker process.
+                                [default: 8]
+
     <configuration>             File to load server configuration from.
 
-The serve sub-command will start an example HTTP server which may be used for
-testing or evaluation.
+The serve sub-command will start an HTTP server. Requests are handled by
+several worker processes, each with a pool of threads. Sending SIGHUP to the
+server reloads the configuration and gracefully replaces the workers. SIGTERM
+or Ctrl-C stops the server once requests in progress have finished.
+
+Migrating storage:
+
+    <storage-dir>               Storage directory to migrate.
+    --shard-levels=N            Number of levels of sub-directories to spread
+                                each user's files across. [default: 0]
+
+The migrate-storage sub-command moves files already stored in <storage-dir> to
+match the layout given by --shard-levels. It should be given the same value as
+the STORAGE_SHARD_LEVELS configuration setting. Stop the server before
+migrating.
+
+Pruning chunks:
+
+    --max-age=DAYS              Remove chunks unused for this many days.
+                                [default: 30]
+
+The prune-chunks sub-command removes chunks kept for "upload --dedup" which
+have not been used recently. It may be run while the server is running.
 
+Counting stored bytes:
+
+The recount-usage sub-command sets the counters of bytes stored by each user,
+against which quotas are checked, from the files in <storage-dir>. Counters are
+kept up to date as files are stored so this is only needed for files stored
+by older versions. Stop the server before recounting.
+
+Upload index:
+
+    <index-file>                SQLite database given as STORAGE_INDEX.
+    --days=N                    Only count files uploaded in the last N days.
+
+The index rebuild sub-command recreates the index from the files in
+<storage-dir>. The index usage sub-command reports the number of files and
+bytes stored for each user, or just <username>.
 
 """
 from __future__ import print_function
 
 import os
 import sys
+import time
 
 from docopt import docopt
 
-from bdfu.auth import make_user_token
+# Each sub-tool imports the modules it needs itself so that the tool starts
+# quickly whichever is run.
 
 def main():
     """Main entry point for the application.
@@ -63,42 +138,166 @@ def main():
 
     # Switch control to the appropriate sub-tool
     if opts['gen-token']:
-        gen_token(opts)
+        return gen_token(opts)
     elif opts['serve']:
-        serve(opts)
+        return serve(opts)
     elif opts['upload']:
-        upload(opts)
+        return upload(opts)
+    elif opts['migrate-storage']:
+        return migrate_storage(opts)
+    elif opts['prune-chunks']:
+        return prune_chunks(opts)
+    elif opts['recount-usage']:
+        return recount_usage(opts)
+    elif opts['index']:
+        return index(opts)
 
 def gen_token(opts):
     """Generate a token for a given user.
 
     """
+    from bdfu.auth import make_user_token
     expires_in = int(opts['--expires-in'])
     username = opts['<username>']
     secret = opts['<secret>']
+    quota = int(opts['--quota']) if opts['--quota'] is not None else None
 
-    print(make_user_token(username, secret, expires_in=expires_in))
+    if opts['--from-file'] is not None:
+        return gen_tokens(opts['--from-file'], secret, expires_in, quota,
+                          int(opts['--processes']))
+
+    print(make_user_token(username, secret, expires_in=expires_in, quota=quota))
+
+def gen_tokens(path, secret, expires_in, quota, processes):
+    """Generate tokens for the users named in a file.
+
+    """
+    import json
+    from bdfu.auth import make_user_tokens
+
+    def read_usernames(f):
+        for line in f:
+            username = line.strip()
+            if username != '':
+                yield username
+
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        tokens = make_user_tokens(read_usernames(f), secret, expires_in=expires_in,
+                                  quota=quota, processes=processes)
+        for username, token in tokens:
+            sys.stdout.write(json.dumps(dict(user=username, token=token), sort_keys=True) + '\n')
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 def serve(opts):
-    from wsgiref.simple_server import make_server
+    from multiprocessing import cpu_count
+    from bdfu.server import serve as serve_app
     from bdfu.webapp import app
 
-    if opts['<configuration>'] is not None:
-        app.config.from_pyfile(os.path.abspath(opts['<configuration>']))
+    def load_configuration():
+        if opts['<configuration>'] is not None:
+            app.config.from_pyfile(os.path.abspath(opts['<configuration>']))
+    load_configuration()
 
-    server = make_server(opts['--ip'], int(opts['--port']), app)
-    print('Serving on http://{0.server_name}:{0.server_port}/'.format(server))
-    server.serve_forever()
+    workers = opts['--workers']
+    workers = cpu_count() if workers is None else int(workers)
+
+    serve_app(
+        app, opts['--ip'], int(opts['--port']),
+        workers=workers, threads=int(opts['--threads']),
+        reload=load_configuration
+    )
 
 def upload(opts):
     from bdfu.client import Client
     endpoint = opts['<endpoint>']
     token = opts['<token>']
 
+    parallel = opts['--parallel']
+    if parallel is not None:
+        parallel = int(parallel)
+
+    kwargs = dict(resumable=opts['--resumable'], parallel=parallel, dedup=opts['--dedup'],
+                  encoding=opts['--compress'])
+
     c = Client(endpoint, token)
-    with open(opts['<file>'], 'rb') as f:
-        file_id = c.upload(f)
-    print(file_id)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+
+    # A single file simply has its id printed.
+    paths = opts['<file>']
+    if len(paths) == 1 and not os.path.isdir(paths[0]):
+        if paths[0] == '-':
+            file_id = c.upload(stdin, **kwargs)
+        else:
+            with open(paths[0], 'rb') as f:
+                file_id = c.upload(f, **kwargs)
+        print(file_id)
+        return 0
+
+    paths = list(_expand_paths(paths))
+    results = c.upload_many(
+        [stdin if p == '-' else p for p in paths],
+        concurrency=int(opts['--concurrency']), **kwargs
+    )
+
+    status = 0
+    for path, result in zip(paths, results):
+        if result.error is not None:
+            sys.stderr.write('{0}: {1}\n'.format(path, result.error))
+            status = 1
+        else:
+            print('{0}  {1}'.format(result.id, path))
+    return status
+
+def migrate_storage(opts):
+    from bdfu.storage import Storage
+    storage = Storage(opts['<storage-dir>'], shard_levels=int(opts['--shard-levels']))
+    print('Moved {0} file(s)'.format(storage.migrate()))
+
+def prune_chunks(opts):
+    from bdfu.storage import Storage
+    storage = Storage(opts['<storage-dir>'])
+    max_age = float(opts['--max-age']) * 24 * 60 * 60
+    print('Removed {0} chunk(s)'.format(storage.prune_chunks(max_age)))
+
+def recount_usage(opts):
+    from bdfu.storage import Storage
+    usage = Storage(opts['<storage-dir>']).recount_usage()
+    for username in sorted(usage):
+        print('{0}\t{1}'.format(username, usage[username]))
+
+def index(opts):
+    from bdfu.index import Index
+    from bdfu.storage import Storage
+    idx = Index(opts['<index-file>'])
+
+    if opts['rebuild']:
+        count = idx.rebuild(Storage(opts['<storage-dir>']))
+        print('Indexed {0} file(s)'.format(count))
+    elif opts['usage']:
+        since = None
+        if opts['--days'] is not None:
+            since = time.time() - float(opts['--days']) * 24 * 60 * 60
+        usage = idx.usage(opts['<username>'], since=since)
+        for username in sorted(usage):
+            count, size = usage[username]
+            print('{0}\t{1}\t{2}'.format(username, count, size))
+
+def _expand_paths(paths):
+    """Yield each path in turn, replacing directories by the files within
+    them.
+
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -7,34 +7,445 @@ The Flask application is exported as "app". The following configuration values
     * JWT_SECRET_KEY: bytes used as the key for the JWTs.
     * STORAGE_DIR: absolute path on disk to the storage directory.
 
+The following configuration values are optional:
+
+    * TOKEN_CACHE_SIZE: maximum number of verified tokens to remember so that
+      repeated requests with the same token skip verification (default: 1024).
+      Set to 0 to disable the cache.
+    * STATS_ENABLED: if True, expose internal statistics as JSON at /stats
+      (default: False).
+    * METRICS_ENABLED: if True, record request counts, bytes received and the
+      time spent in each stage of uploads and expose them in the Prometheus
+      text format at /metrics (default: False).
+    * METRICS_DIR: directory in which each worker process writes its metrics
+      so that /metrics reports those of every process (default: None, meaning
+      only those of the process answering). Empty it before starting the
+      server. See bdfu.metrics.
+    * STORAGE_SHARD_LEVELS: number of levels of sub-directories to spread each
+      user's files across (default: 0). See bdfu.storage.Storage.
+    * STORAGE_DEDUP: if True, files with identical contents share disk space
+      (default: False). See bdfu.storage.Storage.
+    * STORAGE_INDEX: path to an SQLite database in which to record each file
+      stored (default: None). See bdfu.index.
+    * STORAGE_DURABILITY: "none", "file" or "group" (default: "none"). With
+      "file" or "group", files are synced to disk before their ids are
+      returned. See bdfu.storage.Storage.
+    * STORAGE_SYNC_WINDOW: with "group" durability, the number of seconds to
+      wait for other uploads to sync along with each (default: 0.002).
+    * STORAGE_WRITERS: if non-zero, uploads are answered once received and
+      moved into place by this many background threads (default: 0). See
+      bdfu.writebehind.
+    * STORAGE_QUEUE_SIZE: with STORAGE_WRITERS, the number of received files
+      which may wait to be moved into place before uploads are refused with
+      503 Service Unavailable (default: 64).
+    * STORAGE_QUEUE_TIMEOUT: seconds to wait for room in a full queue before
+      moving a received file into place directly (default: 1.0).
+    * UPLOAD_CONCURRENCY: maximum number of uploads which may be in progress
+      at once in each process. Further uploads are refused with 503 Service
+      Unavailable (default: None, meaning no limit).
+    * USER_UPLOAD_CONCURRENCY: maximum number of uploads by one user which
+      may be in progress at once in each process. Further uploads are refused
+      with 429 Too Many Requests (default: None).
+    * USER_UPLOAD_RATE: average number of bytes per second each user may
+      upload. Uploads beyond it are refused with 429 Too Many Requests
+      (default: None).
+    * USER_UPLOAD_BURST: number of bytes a user may upload at once before
+      USER_UPLOAD_RATE applies (default: ten seconds' worth). See
+      bdfu.admission.
+    * QUOTA: maximum total size in bytes of each user's files (default: None,
+      meaning no limit).
+    * USER_QUOTAS: mapping from user name to quota in bytes which overrides
+      QUOTA for those users (default: empty). A "quota" claim in a user's
+      token overrides both.
+    * STORAGE_COMPRESSION: "gzip" or "zstd" to compress files as they are
+      stored (default: None). See bdfu.compression.
+
+Raw request bodies may be sent compressed with a Content-Encoding of "gzip" or
+"zstd". They are decompressed as they are received.
+
 """
-from flask import Flask, abort, request, jsonify, current_app
-from flask_jwt import jwt_required, JWT, current_user
+import functools
+import re
+import tarfile
+import time
+
+from flask import Flask, Request, Response, abort, request, jsonify, current_app, g
+from flask_jwt import jwt_required, JWT, current_user, _default_decode_handler
+
+from bdfu.admission import AdmissionController, AdmissionError
+from bdfu.auth import TokenCache, get_quota
+from bdfu.compression import (
+    DecompressingReader, DecompressionError, UnsupportedCodecError, parse_content_encoding,
+)
+from bdfu.metrics import CONTENT_TYPE, Registry, timer
+from bdfu.storage import (
+    STORAGE_SETTINGS, DigestMismatchError, MissingChunksError, QuotaExceededError,
+    Storage, UnknownSessionError, parse_digest_header,
+)
+from bdfu.writebehind import StorageBusyError, WriteBehindStorage
+
+#: Request content types which are treated as tar archives by /batch.
+TAR_MIMETYPES = ('application/x-tar', 'application/x-gtar', 'application/gzip')
+
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class UploadRequest(Request):
+    """A request which spools uploaded files straight into the authenticated
+    user's partial directory within storage. Storage can then move them into
+    place with a rename rather than copying them again. Spooled files which
+    are not written to storage are removed when the request is closed.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(UploadRequest, self).__init__(*args, **kwargs)
+        self._spooled = []
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # Form data is only parsed by views once the user is known but fall
+        # back to the default temporary file should that not be the case.
+        if not current_user:
+            return super(UploadRequest, self)._get_file_stream(
+                total_content_length, content_type, filename, content_length)
+
+        # No space is allocated up front since the part's Content-Length is
+        # given by the client and need not be true.
+        storage = _get_storage()
+        fobj = storage.spool(current_user)
+        self._spooled.append((storage, fobj))
+        return fobj
+
+    def close(self):
+        super(UploadRequest, self).close()
+        for storage, fobj in self._spooled:
+            storage.discard(fobj)
+
+class _CountingStream(object):
+    """Wrap a WSGI input stream, counting the bytes read from it so that only
+    the request bodies actually received are counted.
 
-from bdfu.storage import Storage
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._stream.readline(*args)
+        self.count += len(data)
+        return data
 
 # Create the flask webapp and support objects
 app = Flask(__name__)
+app.request_class = UploadRequest
 jwt = JWT(app)
 
 # Configure the application from the environment. It's a soft-failure if such a
 # variable is not set.
 app.config.from_envvar('BDFU_SETTINGS', silent=True)
 
+#: Configuration keys which set the limits of admission control.
+ADMISSION_SETTINGS = (
+    'UPLOAD_CONCURRENCY', 'USER_UPLOAD_CONCURRENCY', 'USER_UPLOAD_RATE', 'USER_UPLOAD_BURST',
+)
+
+def admission_controlled(view):
+    """Decorate a view which receives an upload so that it is subject to
+    admission control. It must be used within jwt_required() so that the
+    user is known. Uploads over a limit are refused before their body is read.
+
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = _get_admission()
+        if controller is None:
+            return view(*args, **kwargs)
+        with controller.admit(current_user, request.content_length) as admission:
+            g.admission = admission
+            return view(*args, **kwargs)
+    return wrapper
+
 ## VIEW FUNCTIONS ##
 
 @app.route('/upload', methods=['POST'])
 @jwt_required()
+@admission_controlled
 def upload():
-    # The file to upload is sent as the "file" form field
-    fobj = request.files.get('file')
+    # The file to upload is sent as the "file" form field. Refuse it before
+    # the form is parsed, and so the file spooled, if it cannot fit.
+    quota = _check_quota(request.content_length)
+    with _stage_timer('parse'):
+        fobj = request.files.get('file')
     if fobj is None:
         abort(400)
 
-    # Write contents
-    file_id = _get_storage().write(current_user, fobj)
+    # Write contents. The file's stream was spooled into storage as the form
+    # was parsed so this is usually just a rename.
+    with _stage_timer('write'):
+        stored = _get_storage().store(current_user, fobj.stream, quota=quota)
+    _count_stored([stored])
+
+    with _stage_timer('response'):
+        return jsonify(id=stored.id, sha256=stored.sha256), 201
+
+@app.route('/upload', methods=['PUT'])
+@jwt_required()
+@admission_controlled
+def upload_raw():
+    # The request body is the file itself. It is streamed directly to storage
+    # without any multipart parsing or spooling to a temporary file.
+    length = request.content_length
+    if length is None and not request.environ.get('wsgi.input_terminated'):
+        # Without a length we can only read a body if the server has told us
+        # it will terminate the input stream, e.g. for chunked requests.
+        abort(411)
+
+    # Write contents, checking them against any digest sent by the client
+    quota = _check_quota(length)
+    stream, length = _request_body(length)
+    with _stage_timer('write'):
+        stored = _get_storage().store(
+            current_user, stream, length=length, sha256=_expected_digest(), quota=quota)
+    _count_stored([stored])
+    _charge_received(stored.size)
+
+    with _stage_timer('response'):
+        return jsonify(id=stored.id, sha256=stored.sha256), 201
+
+@app.route('/batch', methods=['POST'])
+@jwt_required()
+@admission_controlled
+def upload_batch():
+    # Many files may be sent at once, either as repeated "file" form fields or
+    # as a (possibly compressed) tar archive. The ids and digests are returned
+    # in the same order as the files.
+    storage = _get_storage()
+    quota = _check_quota(request.content_length)
+    if request.mimetype in TAR_MIMETYPES:
+        length = request.content_length
+        if length is None and not request.environ.get('wsgi.input_terminated'):
+            abort(411)
+        try:
+            stored = storage.store_many(current_user, _iter_tar(request.stream), quota=quota)
+        except tarfile.TarError:
+            abort(400)
+    else:
+        fobjs = request.files.getlist('file')
+        if len(fobjs) == 0:
+            abort(400)
+        stored = storage.store_many(current_user, [f.stream for f in fobjs], quota=quota)
+    _count_stored(stored)
+    _charge_received(sum(s.size for s in stored))
 
-    return jsonify(id=file_id), 201
+    return jsonify(ids=[s.id for s in stored], sha256=[s.sha256 for s in stored]), 201
+
+@app.route('/uploads', methods=['POST'])
+@jwt_required()
+def create_session():
+    # Start a new resumable upload session. The file is sent in one or more
+    # PATCH requests to the session and then committed by POST-ing to it.
+    session_id = _get_storage().create_session(current_user)
+    return jsonify(id=session_id, offset=0), 201
+
+@app.route('/uploads/<session_id>', methods=['GET'])
+@jwt_required()
+def session_status(session_id):
+    offset = _get_storage().session_offset(current_user, session_id)
+    return jsonify(id=session_id, offset=offset)
+
+@app.route('/uploads/<session_id>', methods=['PATCH'])
+@jwt_required()
+@admission_controlled
+def append_session(session_id):
+    # The Upload-Offset header must match the number of bytes already
+    # received. If it does not, the client is told where to resume from.
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        abort(400)
+
+    storage = _get_storage()
+    current_offset = storage.session_offset(current_user, session_id)
+    if offset != current_offset:
+        return jsonify(id=session_id, offset=current_offset), 409
+
+    length = request.content_length
+    if length is None and not request.environ.get('wsgi.input_terminated'):
+        abort(411)
+
+    stream, length = _request_body(length)
+    new_offset = storage.write_session(
+        current_user, session_id, offset, stream, length=length, quota=_get_quota())
+    _charge_received(new_offset - offset)
+    offset = new_offset
+
+    return jsonify(id=session_id, offset=offset)
+
+@app.route('/uploads/<session_id>/<int:offset>', methods=['PUT'])
+@jwt_required()
+@admission_controlled
+def write_session_part(session_id, offset):
+    # Write one part of a file at an arbitrary offset. Unlike PATCH, parts may
+    # arrive in any order and so several may be sent concurrently.
+    length = request.content_length
+    if length is None and not request.environ.get('wsgi.input_terminated'):
+        abort(411)
+
+    stream, length = _request_body(length)
+    new_offset = _get_storage().write_session(
+        current_user, session_id, offset, stream, length=length, quota=_get_quota())
+    _charge_received(new_offset - offset)
+    offset = new_offset
+
+    return jsonify(id=session_id, offset=offset)
+
+@app.route('/uploads/<session_id>', methods=['POST'])
+@jwt_required()
+def commit_session(session_id):
+    # If the client says how long the file should be, check that we have
+    # exactly that many bytes before committing.
+    storage = _get_storage()
+    if 'Upload-Length' in request.headers:
+        try:
+            length = int(request.headers['Upload-Length'])
+        except ValueError:
+            abort(400)
+        offset = storage.session_offset(current_user, session_id)
+        if offset != length:
+            return jsonify(id=session_id, offset=offset), 409
+
+    stored = storage.commit_session(
+        current_user, session_id, sha256=_expected_digest(), quota=_get_quota())
+    _count_stored([stored])
+    return jsonify(id=stored.id, sha256=stored.sha256), 201
+
+@app.route('/uploads/<session_id>', methods=['DELETE'])
+@jwt_required()
+def delete_session(session_id):
+    _get_storage().delete_session(current_user, session_id)
+    return '', 204
+
+@app.route('/chunks/missing', methods=['POST'])
+@jwt_required()
+def missing_chunks():
+    # The body is a JSON object whose "chunks" member lists the digests of the
+    # chunks of a file. Reply with those which the client must upload.
+    missing = _get_storage().missing_chunks(current_user, _chunk_list())
+    return jsonify(missing=missing)
+
+@app.route('/chunks/<sha256>', methods=['PUT'])
+@jwt_required()
+@admission_controlled
+def upload_chunk(sha256):
+    # The raw body is a chunk whose digest must match the URL.
+    length = request.content_length
+    if length is None and not request.environ.get('wsgi.input_terminated'):
+        abort(411)
+
+    quota = _check_quota(length)
+    stream, length = _request_body(length)
+    try:
+        _get_storage().write_chunk(current_user, sha256, stream, length=length, quota=quota)
+    except DecompressionError:
+        raise
+    except ValueError:
+        abort(404)
+
+    return jsonify(sha256=sha256), 201
+
+@app.route('/chunks/assemble', methods=['POST'])
+@jwt_required()
+def assemble_chunks():
+    # Make a file from chunks already uploaded, given as for /chunks/missing.
+    # If some have not been, the client is told which.
+    stored = _get_storage().assemble(
+        current_user, _chunk_list(), sha256=_expected_digest(), quota=_get_quota())
+    _count_stored([stored])
+    return jsonify(id=stored.id, sha256=stored.sha256), 201
+
+@app.errorhandler(MissingChunksError)
+def chunks_missing(e):
+    return jsonify(error='Chunks missing', missing=e.missing), 409
+
+@app.errorhandler(QuotaExceededError)
+def quota_exceeded(e):
+    return jsonify(error='Quota exceeded', quota=e.quota, usage=e.usage), 413
+
+@app.errorhandler(AdmissionError)
+def admission_refused(e):
+    response = jsonify(error=str(e))
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status
+
+@app.errorhandler(StorageBusyError)
+def storage_busy(e):
+    response = jsonify(error='Storage busy')
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.errorhandler(UnknownSessionError)
+def unknown_session(e):
+    return jsonify(error='Unknown upload session'), 404
+
+@app.errorhandler(DecompressionError)
+def decompression_failed(e):
+    return jsonify(error='Bad compressed data'), 400
+
+@app.errorhandler(DigestMismatchError)
+def digest_mismatch(e):
+    return jsonify(error='Digest mismatch', expected=e.expected, sha256=e.actual), 400
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # Statistics are only exposed if explicitly enabled.
+    if not current_app.config.get('STATS_ENABLED', False):
+        abort(404)
+    stats = dict(token_cache=_get_token_cache().stats())
+    storage, _ = current_app.extensions.get('bdfu.storage', (None, None))
+    if isinstance(storage, WriteBehindStorage):
+        stats['write_queue'] = storage.stats()
+    controller = _get_admission()
+    if controller is not None:
+        stats['admission'] = controller.stats()
+    return jsonify(**stats)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metrics are only exposed if explicitly enabled.
+    registry = _get_metrics()
+    if registry is None:
+        abort(404)
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+@app.before_request
+def count_received_bytes():
+    # Bodies of requests which are refused, e.g. for being over quota, are
+    # never read and so not counted.
+    if _get_metrics() is not None and 'wsgi.input' in request.environ:
+        g.received = request.environ['wsgi.input'] = _CountingStream(
+            request.environ['wsgi.input'])
+
+@app.after_request
+def record_request(response):
+    registry = _get_metrics()
+    if registry is not None:
+        endpoint = request.endpoint or 'none'
+        registry.inc('bdfu_requests_total', endpoint=endpoint, method=request.method,
+                     status=response.status_code)
+        received = g.get('received')
+        registry.inc('bdfu_received_bytes_total', received.count if received is not None else 0)
+        if 'request_started' in g:
+            registry.observe('bdfu_request_seconds', time.time() - g.request_started,
+                             endpoint=endpoint)
+    return response
 
 ## SUPPORT FUNCTIONS ##
 
@@ -43,12 +454,188 @@ def _get_storage():
     app. Requires that the STORAGE_DIR configuration key is set.
 
     """
-    return Storage(current_app.config['STORAGE_DIR'])
+    # The instance is kept for as long as the configuration is unchanged so
+    # that any state it holds persists between requests.
+    settings = tuple(current_app.config.get(k) for k in STORAGE_SETTINGS)
+    storage, storage_settings = current_app.extensions.get('bdfu.storage', (None, None))
+    settings += (_get_metrics(),)
+    if storage is None or storage_settings != settings:
+        storage = Storage.from_config(current_app.config, metrics=settings[-1])
+        current_app.extensions['bdfu.storage'] = (storage, settings)
+    return storage
+
+def _get_metrics():
+    """Return the metrics Registry for this app or None if METRICS_ENABLED
+    is not set. It is replaced if the METRICS_DIR configuration key changes.
+
+    """
+    if not current_app.config.get('METRICS_ENABLED', False):
+        return None
+    directory = current_app.config.get('METRICS_DIR')
+    registry = current_app.extensions.get('bdfu.metrics')
+    if registry is None or registry.directory != directory:
+        registry = Registry(directory)
+        registry.counter('bdfu_requests_total', 'Requests handled by endpoint, method and status.')
+        registry.counter('bdfu_received_bytes_total', 'Bytes of request bodies received.')
+        registry.counter('bdfu_user_stored_bytes_total', 'Bytes of files stored by user.')
+        registry.histogram('bdfu_request_seconds', 'Time spent handling requests by endpoint.')
+        registry.histogram('bdfu_upload_stage_seconds', 'Time spent in each stage of uploads.')
+        current_app.extensions['bdfu.metrics'] = registry
+    return registry
+
+def _stage_timer(stage):
+    """Return a context manager recording the time spent in a stage of an
+    upload if metrics are enabled.
+
+    """
+    return timer(_get_metrics(), 'bdfu_upload_stage_seconds', stage=stage)
+
+def _count_stored(stored):
+    """Count the bytes of the StoredFiles in stored against the
+    authenticated user if metrics are enabled.
+
+    """
+    registry = _get_metrics()
+    if registry is not None:
+        registry.inc('bdfu_user_stored_bytes_total', sum(s.size for s in stored),
+                     user=current_user)
+
+def _get_admission():
+    """Return the AdmissionController for this app or None if no limits are
+    configured. It is replaced if the limits change.
+
+    """
+    settings = tuple(current_app.config.get(k) for k in ADMISSION_SETTINGS)
+    if all(v is None for v in settings):
+        return None
+    controller, controller_settings = current_app.extensions.get('bdfu.admission', (None, None))
+    if controller is None or controller_settings != settings:
+        controller = AdmissionController(*settings)
+        current_app.extensions['bdfu.admission'] = (controller, settings)
+    return controller
+
+def _charge_received(nbytes):
+    """Charge nbytes received against the authenticated user's upload rate
+    if the request's length was not known when it was admitted.
+
+    """
+    admission = g.get('admission')
+    if admission is not None and request.content_length is None:
+        admission.charge(nbytes)
+
+def _get_quota():
+    """Return the quota in bytes of the authenticated user or None if they
+    have no quota. See bdfu.auth.get_quota().
+
+    """
+    return get_quota(g.get('jwt_payload', {}), current_app.config)
+
+def _check_quota(length):
+    """Return the quota of the authenticated user as for _get_quota(). Raises
+    QuotaExceededError before anything is read if a request body of length
+    bytes cannot fit within it.
+
+    """
+    quota = _get_quota()
+    if quota is not None and length is not None:
+        usage = _get_storage().usage(current_user)
+        if usage + length > quota:
+            raise QuotaExceededError(quota, usage)
+    return quota
+
+def _request_body(length):
+    """Return a (stream, length) pair for the raw request body of length
+    bytes, decompressing it if it has a Content-Encoding. The length of a
+    decompressed body is not known in advance so is None. Aborts with 415 if
+    the encoding is not supported.
+
+    """
+    try:
+        codec = parse_content_encoding(request.headers.get('Content-Encoding', ''))
+    except UnsupportedCodecError:
+        abort(415)
+    if codec is None:
+        return request.stream, length
+    return DecompressingReader(request.stream, codec), None
+
+def _expected_digest():
+    """Return the hex SHA-256 digest the client says the uploaded file has,
+    taken from a Content-Digest or Digest header, or None if it does not say.
+
+    """
+    for header in ('Content-Digest', 'Digest'):
+        if header in request.headers:
+            try:
+                digest = parse_digest_header(request.headers[header])
+            except ValueError:
+                abort(400)
+            if digest is not None:
+                return digest
+    return None
+
+def _chunk_list():
+    """Return the list of chunk digests in the "chunks" member of a JSON
+    request body. Aborts with 400 if there is no such list.
+
+    """
+    body = request.get_json(force=True, silent=True)
+    chunks = body.get('chunks') if isinstance(body, dict) else None
+    if not isinstance(chunks, list):
+        abort(400)
+    try:
+        if not all(_SHA256_RE.match(sha256) for sha256 in chunks):
+            abort(400)
+    except TypeError:
+        abort(400)
+    return chunks
+
+def _iter_tar(stream):
+    """Yield a file-like object for each regular file in a tar archive read
+    from stream. Each must be read before the next is requested since the
+    archive is read sequentially.
+
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield archive.extractfile(member)
+
+def _get_token_cache():
+    """Return the TokenCache for this app. It is replaced if the
+    TOKEN_CACHE_SIZE configuration key changes.
+
+    """
+    maxsize = current_app.config.get('TOKEN_CACHE_SIZE', 1024)
+    cache = current_app.extensions.get('bdfu.token_cache')
+    if cache is None or cache.maxsize != maxsize:
+        cache = TokenCache(maxsize)
+        current_app.extensions['bdfu.token_cache'] = cache
+    return cache
+
+@jwt.decode_handler
+def decode_token(token):
+    """Verify a token and return its payload. Tokens which have been verified
+    before are looked up in the token cache until they expire. The cache is
+    keyed by secret as well as token so that changing the secret invalidates
+    it.
+
+    """
+    cache = _get_token_cache()
+    key = (current_app.config['JWT_SECRET_KEY'], token)
+    with _stage_timer('auth'):
+        payload = cache.get(key)
+        if payload is None:
+            payload = _default_decode_handler(token)
+            if 'exp' in payload:
+                cache.put(key, payload, payload['exp'])
+    return payload
 
 @jwt.user_handler
 def load_user(payload):
     """The user handler is very simple; it returns whatever the "user" claim is
-    in the payload.
+    in the payload. The payload is kept for the rest of the request so that
+    other claims, such as "quota", can be consulted.
 
     """
+    g.jwt_payload = payload
     return payload.get('user')
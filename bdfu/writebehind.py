@@ -0,0 +1,150 @@
+"""
+Write-behind storage.
+
+A WriteBehindStorage wraps a Storage so that storing a file only receives it
+into the user's partial directory. Moving it into place, which may mean
+waiting for the disk to sync, linking it to a deduplicated blob and recording
+it in the index, is left to a pool of writer threads. Requests are therefore
+answered as soon as their data is staged and are not held up by slow disks.
+See the STORAGE_WRITERS configuration setting.
+
+Staged files are kept on disk, named after the id they will have, so that a
+staged file is not lost should the process die before it is written. They are
+written by recover(), which is called when a WriteBehindStorage is created by
+Storage.from_config().
+
+The queue of staged files is bounded. When it is full, new files are refused
+with StorageBusyError before any of their data is received.
+
+"""
+import logging
+import threading
+
+try:
+    import queue
+except ImportError: # pragma: no cover
+    import Queue as queue
+
+from bdfu.storage import StorageError
+
+_log = logging.getLogger(__name__)
+
+class StorageBusyError(StorageError):
+    """Raised when a file cannot be accepted because too many are waiting to
+    be written.
+
+    """
+
+class WriteBehindStorage(object):
+    """Wrap storage, a Storage, so that files are written to it by writer
+    threads in the background. At most queue_size files may be waiting at
+    once. Methods other than write(), store() and store_many() are those of
+    storage.
+
+    Files which have been staged but not yet written have ids but do not yet
+    appear in storage. Use join() to wait for them.
+
+    """
+    def __init__(self, storage, writers=4, queue_size=64, timeout=1.0):
+        self.storage = storage
+        self.writers = writers
+        self.timeout = timeout
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.written = self.failed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def write(self, username, contents, length=None):
+        """As Storage.write()."""
+        return self.store(username, contents, length).id
+
+    def store(self, username, contents, length=None, sha256=None, quota=None):
+        """As Storage.store() but return once the file is staged. Raises
+        StorageBusyError without reading contents if the queue is full.
+
+        """
+        if self.full():
+            raise StorageBusyError('{0} file(s) waiting to be written'.format(self.depth()))
+        # Proxy objects such as Flask-JWT's current_user cannot be used once
+        # the request has finished so the name is resolved now.
+        username = '%s' % (username,)
+        stored = self.storage.stage(username, contents, length, sha256, quota)
+        self._put(username, stored.id, stored.sha256, stored.size)
+        return stored
+
+    def store_many(self, username, files, quota=None):
+        """As Storage.store_many()."""
+        return [self.store(username, contents, quota=quota) for contents in files]
+
+    def recover(self):
+        """Queue any files staged but not written, e.g. by a process which
+        has since died. Returns the number queued.
+
+        """
+        count = 0
+        for username, file_id in self.storage.iter_staged():
+            self._put(username, file_id, None, None)
+            count += 1
+        return count
+
+    def depth(self):
+        """Return the number of staged files waiting to be written."""
+        return self._queue.qsize()
+
+    def full(self):
+        """Return True if no more files can be accepted at the moment."""
+        return self._queue.full()
+
+    def join(self):
+        """Wait until every file staged so far has been written."""
+        self._queue.join()
+
+    def stats(self):
+        """Return a dictionary of queue statistics."""
+        return dict(
+            depth=self.depth(), capacity=self._queue.maxsize, writers=self.writers,
+            written=self.written, failed=self.failed,
+        )
+
+    def _put(self, username, file_id, sha256, size):
+        self._start()
+        try:
+            # The file is already staged so wait for space rather than give up.
+            self._queue.put((username, file_id, sha256, size), timeout=self.timeout)
+        except queue.Full:
+            # Writing the file here slows this request rather than losing it.
+            self._commit(username, file_id, sha256, size)
+
+    def _start(self):
+        # Writers are started here so that they run in the process which
+        # stages files rather than one it was forked from.
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.writers:
+                thread = threading.Thread(target=self._write_staged)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _write_staged(self):
+        while True:
+            username, file_id, sha256, size = self._queue.get()
+            try:
+                self._commit(username, file_id, sha256, size)
+            finally:
+                self._queue.task_done()
+
+    def _commit(self, username, file_id, sha256, size):
+        try:
+            self.storage.commit_staged(username, file_id, sha256, size)
+        except Exception:
+            # The file stays staged to be written by a later recover()
+            with self._lock:
+                self.failed += 1
+            _log.exception('Failed to write staged file %s for %s', file_id, username)
+        else:
+            with self._lock:
+                self.written += 1
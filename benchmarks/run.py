@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+Benchmarks for BDFU.
+
+Usage:
+    run.py [options] [<benchmark>...]
+    run.py --list
+
+Options:
+
+    -h, --help                  Show a brief usage summary.
+    --list                      List the available benchmarks.
+    --sizes=SIZES               Comma-separated file sizes for benchmarks which
+                                store files. A suffix of K, M or G multiplies
+                                by 1024, 1024^2 or 1024^3.
+                                [default: 1K,64K,1M,16M]
+    --concurrency=LEVELS        Comma-separated numbers of threads to run each
+                                benchmark with. [default: 1,4]
+    --repeat=N                  Number of operations per measurement.
+                                [default: 50]
+    --max-bytes=SIZE            Limit the operations per measurement so that at
+                                most this many bytes are stored. [default: 256M]
+    --dir=DIR                   Directory to store files in. Defaults to a
+                                temporary directory.
+    --save=FILE                 Write the results to FILE as JSON.
+    --baseline=FILE             Compare the results with those saved in FILE.
+    --threshold=FRACTION        Report a regression if the median latency rises
+                                or the throughput falls by more than this
+                                fraction of the baseline. [default: 0.1]
+
+Each measurement runs an operation the given number of times over the given
+number of threads and reports latency percentiles in milliseconds and
+throughput. With no <benchmark>, all are run. Sizes up to 1G may be given;
+only one file per thread is kept on disk at a time.
+
+The exit status is 1 if a regression from the baseline was found.
+
+"""
+from __future__ import division, print_function
+
+import json
+import os
+import platform
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import threading
+import time
+
+from docopt import docopt
+
+from bdfu.auth import make_user_token, verify_user_token
+from bdfu.storage import Storage
+
+SECRET = 'benchmark-secret'
+
+USERNAME = 'bench'
+
+# The most precise clock available
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Bytes repeated to make the contents of files being stored
+_BLOCK = os.urandom(1024 * 1024)
+
+class Source(object):
+    """A file-like object yielding size bytes without holding them all in
+    memory.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self._pos = 0
+
+    def read(self, size=-1):
+        remaining = self.size - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        size = min(size, len(_BLOCK))
+        self._pos += size
+        return _BLOCK[:size]
+
+    def __len__(self):
+        return self.size
+
+## BENCHMARKS ##
+
+# Each benchmark is a function taking a Context and a file size, or None if
+# it does not store files, and returning a function performing one operation.
+# The operation may return a function to be called after it has been timed,
+# e.g. to remove what it stored.
+
+class Context(object):
+    """State shared by the benchmarks of one run."""
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.storage = Storage(destdir)
+        self.token = make_user_token(USERNAME, SECRET, expires_in=24 * 60 * 60)
+        self._app = None
+
+    @property
+    def app(self):
+        if self._app is None:
+            from bdfu.webapp import app
+            app.config['JWT_SECRET_KEY'] = SECRET
+            app.config['STORAGE_DIR'] = self.destdir
+            self._app = app
+        return self._app
+
+def bench_storage_write(ctx, size):
+    """Storage.write() of a file of the given size."""
+    def op():
+        file_id = ctx.storage.write(USERNAME, Source(size), length=size)
+        return lambda: ctx.storage.delete(USERNAME, file_id)
+    return op
+
+def bench_make_token(ctx, size):
+    """make_user_token()."""
+    return lambda: make_user_token(USERNAME, SECRET)
+
+def bench_verify_token(ctx, size):
+    """verify_user_token() without a cache."""
+    return lambda: verify_user_token(ctx.token, SECRET)
+
+def bench_webapp_upload(ctx, size):
+    """POST /upload of a file of the given size via the Flask test client.
+
+    This includes token verification and multipart parsing.
+
+    """
+    headers = {'Authorization': 'Bearer ' + ctx.token}
+    def op():
+        resp = ctx.app.test_client().post(
+            '/upload', headers=headers, data=dict(file=(Source(size), 'bench.bin')))
+        if resp.status_code != 201:
+            raise RuntimeError('Upload failed: HTTP {0}'.format(resp.status_code))
+        file_id = json.loads(resp.data.decode('utf8'))['id']
+        return lambda: ctx.storage.delete(USERNAME, file_id)
+    return op
+
+#: Benchmarks by name and whether they store files of each size.
+BENCHMARKS = [
+    ('storage.write', bench_storage_write, True),
+    ('auth.make_token', bench_make_token, False),
+    ('auth.verify_token', bench_verify_token, False),
+    ('webapp.upload', bench_webapp_upload, True),
+]
+
+## MEASUREMENT ##
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of the sorted list values."""
+    if len(values) == 0:
+        return None
+    rank = max(int(-(-fraction * len(values) // 1)), 1)
+    return values[min(rank, len(values)) - 1]
+
+def measure(op, count, concurrency):
+    """Perform op count times over concurrency threads and return a dict of
+    statistics. Latencies are in milliseconds. op is performed once more
+    beforehand, untimed, so that one-off costs such as imports and opening
+    databases are not counted.
+
+    """
+    cleanup = op()
+    if callable(cleanup):
+        cleanup()
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    remaining = [count]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0 or errors:
+                    return
+                remaining[0] -= 1
+            start = _clock()
+            try:
+                cleanup = op()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+            elapsed = _clock() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+            if callable(cleanup):
+                cleanup()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = _clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = _clock() - start
+    if errors:
+        raise errors[0]
+
+    latencies.sort()
+    return dict(
+        ops=len(latencies),
+        mean=sum(latencies) / len(latencies),
+        p50=percentile(latencies, 0.5),
+        p90=percentile(latencies, 0.9),
+        p99=percentile(latencies, 0.99),
+        max=latencies[-1],
+        ops_per_sec=len(latencies) / wall,
+    )
+
+def run(names, sizes, levels, repeat, max_bytes, destdir):
+    """Run the named benchmarks and return a dict mapping a key naming each
+    measurement to its statistics.
+
+    """
+    ctx = Context(destdir)
+    results = {}
+    for name, factory, sized in BENCHMARKS:
+        if name not in names:
+            continue
+        for size in (sizes if sized else [None]):
+            count = repeat if size is None else max(1, min(repeat, max_bytes // size))
+            op = factory(ctx, size)
+            for concurrency in levels:
+                key = result_key(name, size, concurrency)
+                stats = measure(op, count, concurrency)
+                if size is not None:
+                    stats['bytes_per_sec'] = stats['ops_per_sec'] * size
+                results[key] = stats
+                print(format_result(key, stats))
+                sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """Return a list of (key, description) pairs for measurements in results
+    which have regressed from baseline by more than the fraction threshold.
+
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        new, old = results[key], baseline[key]
+        if new['p50'] > old['p50'] * (1 + threshold):
+            regressions.append((key, 'median latency {0:.3f}ms -> {1:.3f}ms'.format(
+                old['p50'], new['p50'])))
+        if new['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold):
+            regressions.append((key, 'throughput {0:.1f}/s -> {1:.1f}/s'.format(
+                old['ops_per_sec'], new['ops_per_sec'])))
+    return regressions
+
+## SUPPORT FUNCTIONS ##
+
+def result_key(name, size, concurrency):
+    if size is None:
+        return '{0} concurrency={1}'.format(name, concurrency)
+    return '{0} size={1} concurrency={2}'.format(name, format_size(size), concurrency)
+
+def format_result(key, stats):
+    line = '{0:<48} {1[ops]:>6} ops  p50 {1[p50]:>9.3f}ms  p90 {1[p90]:>9.3f}ms  ' \
+           'p99 {1[p99]:>9.3f}ms  {1[ops_per_sec]:>9.1f}/s'.format(key, stats)
+    if 'bytes_per_sec' in stats:
+        line += '  {0:>8.1f}MB/s'.format(stats['bytes_per_sec'] / (1024 * 1024))
+    return line
+
+def parse_size(value):
+    """Parse a size such as "64K" into a number of bytes."""
+    value = value.strip().upper()
+    multiplier = 1
+    for i, suffix in enumerate('KMG'):
+        if value.endswith(suffix):
+            value, multiplier = value[:-1], 1024 ** (i + 1)
+            break
+    return int(value) * multiplier
+
+def format_size(size):
+    for i, suffix in reversed(list(enumerate('KMG'))):
+        unit = 1024 ** (i + 1)
+        if size % unit == 0:
+            return '{0}{1}'.format(size // unit, suffix)
+    return str(size)
+
+def main():
+    opts = docopt(__doc__)
+
+    if opts['--list']:
+        for name, factory, _ in BENCHMARKS:
+            print('{0:<20} {1}'.format(name, factory.__doc__.splitlines()[0]))
+        return 0
+
+    known = [name for name, _, _ in BENCHMARKS]
+    names = opts['<benchmark>'] or known
+    for name in names:
+        if name not in known:
+            sys.stderr.write('Unknown benchmark: {0}\n'.format(name))
+            return 2
+
+    sizes = [parse_size(s) for s in opts['--sizes'].split(',')]
+    levels = [int(c) for c in opts['--concurrency'].split(',')]
+
+    destdir = opts['--dir']
+    tempdir = None
+    if destdir is None:
+        destdir = tempdir = mkdtemp(prefix='bdfu-bench')
+    try:
+        results = run(names, sizes, levels, int(opts['--repeat']),
+                      parse_size(opts['--max-bytes']), destdir)
+    finally:
+        if tempdir is not None:
+            rmtree(tempdir)
+
+    if opts['--save'] is not None:
+        with open(opts['--save'], 'w') as f:
+            json.dump(dict(
+                python=platform.python_version(), platform=platform.platform(),
+                time=time.time(), results=results,
+            ), f, indent=2, sort_keys=True)
+
+    if opts['--baseline'] is not None:
+        with open(opts['--baseline']) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, float(opts['--threshold']))
+        for key, description in regressions:
+            print('REGRESSION: {0}: {1}'.format(key, description))
+        if regressions:
+            return 1
+        print('No regressions from {0}'.format(opts['--baseline']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
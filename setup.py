@@ -19,9 +19,6 @@ setup(
         ],
     ),
     install_requires=[
-        # Py2/3 compat
-        "future",
-
         # Authentication
         "pyjwt",
 
@@ -35,6 +32,10 @@ setup(
         # Command-line tool
         "docopt",
     ],
+    extras_require=dict(
+        # Zstandard compression
+        zstd=["zstandard"],
+    ),
     tests_require=[
         "pytest",
         "mock",
@@ -0,0 +1,9 @@
+"""
+Shared pytest configuration.
+
+"""
+import sys
+
+# The ASGI application and its tests use async def, which is a syntax error
+# before Python 3.5
+collect_ignore = ['test_asgi.py'] if sys.version_info < (3, 5) else []
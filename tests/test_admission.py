@@ -0,0 +1,80 @@
+"""
+Test admission control.
+
+"""
+import pytest
+
+from bdfu.admission import AdmissionController, AdmissionError
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_unlimited():
+    """With no limits, everything should be admitted."""
+    controller = AdmissionController()
+    admissions = [controller.admit('alice', 10 ** 9) for _ in range(100)]
+    assert controller.stats()['uploads'] == 100
+    for admission in admissions:
+        admission.release()
+    assert controller.stats() == dict(uploads=0, users=0, admitted=100, refused=0)
+
+def test_concurrency():
+    """Concurrent uploads should be limited in total and per user."""
+    controller = AdmissionController(max_uploads=3, max_user_uploads=2)
+    first = controller.admit('alice')
+    with controller.admit('alice'):
+        with pytest.raises(AdmissionError) as excinfo:
+            controller.admit('alice')
+        assert excinfo.value.status == 429
+        assert excinfo.value.retry_after == 1
+
+        with controller.admit('bob'):
+            with pytest.raises(AdmissionError) as excinfo:
+                controller.admit('carol')
+            assert excinfo.value.status == 503
+
+    # Released admissions make room
+    controller.admit('alice').release()
+    first.release()
+    first.release()
+    assert controller.stats()['uploads'] == 0
+    assert controller.stats()['refused'] == 2
+
+def test_rate():
+    """Each user's bytes should be limited by a token bucket."""
+    clock = Clock()
+    controller = AdmissionController(rate=100, burst=1000, clock=clock)
+
+    controller.admit('alice', 600).release()
+    controller.admit('alice', 400).release()
+    with pytest.raises(AdmissionError) as excinfo:
+        controller.admit('alice', 250)
+    assert excinfo.value.status == 429
+    assert excinfo.value.retry_after == 3
+    controller.admit('bob', 1000).release()
+
+    clock.now += 2.5
+    controller.admit('alice', 250).release()
+
+    # Uploads larger than the burst may overdraw a full bucket
+    clock.now += 100
+    controller.admit('alice', 5000).release()
+    with pytest.raises(AdmissionError) as excinfo:
+        controller.admit('alice', 1)
+    assert excinfo.value.retry_after == 41
+
+def test_charge():
+    """Uploads of unknown length should be charged once they are known."""
+    clock = Clock()
+    controller = AdmissionController(rate=100, clock=clock)
+    assert controller.burst == 1000
+    with controller.admit('alice') as admission:
+        admission.charge(1500)
+    with pytest.raises(AdmissionError):
+        controller.admit('alice')
+    clock.now += 5.5
+    controller.admit('alice').release()
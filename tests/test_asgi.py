@@ -0,0 +1,244 @@
+"""
+Test the ASGI web application.
+
+"""
+import asyncio
+import base64
+import gzip
+import hashlib
+from io import BytesIO
+import json
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import tracemalloc
+import uuid
+
+from mock import patch
+import pytest
+
+from bdfu.asgi import UploadApplication
+from bdfu.auth import make_user_token
+from bdfu.storage import PARTIAL_DIR
+from bdfu.writebehind import WriteBehindStorage
+
+@pytest.fixture
+def config():
+    storage_dir = mkdtemp(prefix='asgitest')
+    yield dict(JWT_SECRET_KEY=uuid.uuid4().hex, STORAGE_DIR=storage_dir)
+    rmtree(storage_dir)
+
+def request(app, method, path, headers=(), chunks=(b'',), disconnect=False):
+    """Make a request to an ASGI application. The body is sent as the
+    sequence chunks. If disconnect is True, the client disconnects after
+    sending them. Returns the status, headers and decoded JSON body.
+
+    """
+    scope = dict(
+        type='http', method=method, path=path,
+        headers=[(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    )
+
+    messages = [
+        dict(type='http.request', body=c, more_body=disconnect or i + 1 < len(chunks))
+        for i, c in enumerate(chunks)
+    ]
+    if disconnect:
+        messages.append(dict(type='http.disconnect'))
+    messages.reverse()
+
+    async def receive():
+        return messages.pop()
+
+    sent = []
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+
+    if len(sent) == 0:
+        return None, None, None
+    return sent[0]['status'], dict(sent[0]['headers']), json.loads(sent[1]['body'].decode('utf8'))
+
+def gzip_compress(contents):
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(contents)
+    return out.getvalue()
+
+def auth_headers(config, username='testuser'):
+    token = make_user_token(username, config['JWT_SECRET_KEY'])
+    return [('Authorization', 'Bearer ' + token)]
+
+def test_put_succeeds(config):
+    """PUT-ing an authorised body in several chunks creates a file."""
+    app = UploadApplication(config)
+    contents = [os.urandom(1000) for _ in range(5)]
+    status, _, body = request(
+        app, 'PUT', '/upload', chunks=contents,
+        headers=auth_headers(config, 'myuser') + [('Content-Length', '5000')],
+    )
+    assert status == 201
+    with open(os.path.join(config['STORAGE_DIR'], 'myuser', body['id']), 'rb') as f:
+        assert f.read() == b''.join(contents)
+
+def test_unauthorised_put_fails(config):
+    """PUT-ing without JWT is Unauthorized (401)."""
+    status, headers, _ = request(UploadApplication(config), 'PUT', '/upload', chunks=[b'hello'])
+    assert status == 401
+    assert b'www-authenticate' in headers
+
+def test_bad_token_fails(config):
+    """PUT-ing with an incorrect JWT is a Bad Request (400)."""
+    token = make_user_token('testuser', 'this is not the secret')
+    status, _, _ = request(
+        UploadApplication(config), 'PUT', '/upload', chunks=[b'hello'],
+        headers=[('Authorization', 'Bearer ' + token)],
+    )
+    assert status == 400
+
+def test_wrong_method_or_path(config):
+    """Only PUT to /upload is allowed."""
+    app = UploadApplication(config)
+    assert request(app, 'POST', '/upload', headers=auth_headers(config))[0] == 405
+    assert request(app, 'PUT', '/elsewhere', headers=auth_headers(config))[0] == 404
+
+def test_short_body_fails(config):
+    """A body shorter than its Content-Length is a Bad Request (400) and
+    leaves nothing behind.
+
+    """
+    status, _, _ = request(
+        UploadApplication(config), 'PUT', '/upload', chunks=[b'hello'],
+        headers=auth_headers(config, 'myuser') + [('Content-Length', '10')],
+    )
+    assert status == 400
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser')) == [PARTIAL_DIR]
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_bad_content_length_fails(config):
+    """A malformed or negative Content-Length is a Bad Request (400)."""
+    app = UploadApplication(config)
+    for length in ('abc', '-1'):
+        status, _, body = request(
+            app, 'PUT', '/upload', chunks=[b'hello'],
+            headers=auth_headers(config, 'myuser') + [('Content-Length', length)],
+        )
+        assert status == 400
+        assert body == dict(error='Bad content length')
+
+def test_disconnect_leaves_nothing(config):
+    """A client disconnecting part way through leaves nothing behind."""
+    status, _, _ = request(
+        UploadApplication(config), 'PUT', '/upload', chunks=[b'hello'], disconnect=True,
+        headers=auth_headers(config, 'myuser'),
+    )
+    assert status is None
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_digest_mismatch_fails(config):
+    """A body which does not match its Content-Digest is a Bad Request (400)
+    and leaves nothing behind.
+
+    """
+    encoded = base64.b64encode(hashlib.sha256(b'hello').digest()).decode('ascii')
+    headers = auth_headers(config, 'myuser') + [('Content-Digest', 'sha-256=:' + encoded + ':')]
+    app = UploadApplication(config)
+
+    status, _, body = request(app, 'PUT', '/upload', chunks=[b'hello'], headers=headers)
+    assert status == 201
+    assert body['sha256'] == hashlib.sha256(b'hello').hexdigest()
+
+    status, _, body = request(app, 'PUT', '/upload', chunks=[b'HELLO'], headers=headers)
+    assert status == 400
+    assert body['sha256'] == hashlib.sha256(b'HELLO').hexdigest()
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_quota_exceeded_fails(config):
+    """A body which would take the user over quota is Request Entity Too Large
+    (413) and leaves nothing behind.
+
+    """
+    config['QUOTA'] = 10
+    app = UploadApplication(config)
+    headers = auth_headers(config, 'myuser')
+
+    assert request(app, 'PUT', '/upload', chunks=[b'x' * 8], headers=headers)[0] == 201
+
+    status, _, body = request(app, 'PUT', '/upload', chunks=[b'x' * 8],
+                              headers=headers + [('Content-Length', '8')])
+    assert status == 413
+    assert body['usage'] == 8
+
+    status, _, _ = request(app, 'PUT', '/upload', chunks=[b'x', b'x' * 8], headers=headers)
+    assert status == 413
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_content_encoding(config):
+    """A compressed body is decompressed before being stored. Unsupported
+    encodings are Unsupported Media Type (415) and bad data is Bad Request
+    (400).
+
+    """
+    app = UploadApplication(config)
+    contents = b'hello world\n' * 1000
+    compressed = gzip_compress(contents)
+    headers = auth_headers(config, 'myuser') + [
+        ('Content-Encoding', 'gzip'), ('Content-Length', str(len(compressed)))]
+
+    status, _, body = request(
+        app, 'PUT', '/upload', headers=headers,
+        chunks=[compressed[:100], compressed[100:]])
+    assert status == 201
+    assert body['sha256'] == hashlib.sha256(contents).hexdigest()
+    with open(os.path.join(config['STORAGE_DIR'], 'myuser', body['id']), 'rb') as f:
+        assert f.read() == contents
+
+    headers = auth_headers(config, 'myuser') + [('Content-Encoding', 'gzip')]
+    assert request(app, 'PUT', '/upload', headers=headers, chunks=[compressed[:-10]])[0] == 400
+    assert request(app, 'PUT', '/upload', headers=headers, chunks=[b'not gzip'])[0] == 400
+    headers = auth_headers(config, 'myuser') + [('Content-Encoding', 'br')]
+    assert request(app, 'PUT', '/upload', headers=headers, chunks=[b'hello'])[0] == 415
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_compressed_quota_exceeded_fails(config):
+    """A small compressed body which expands beyond the quota is refused
+    without being decompressed all at once.
+
+    """
+    config['QUOTA'] = 1024 * 1024
+    app = UploadApplication(config)
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        for _ in range(64):
+            f.write(bytes(1024 * 1024))
+    headers = auth_headers(config, 'myuser') + [('Content-Encoding', 'gzip')]
+
+    tracemalloc.start()
+    try:
+        status, _, _ = request(app, 'PUT', '/upload', headers=headers, chunks=[out.getvalue()])
+        assert tracemalloc.get_traced_memory()[1] < 16 * 1024 * 1024
+    finally:
+        tracemalloc.stop()
+    assert status == 413
+    assert os.listdir(os.path.join(config['STORAGE_DIR'], 'myuser', PARTIAL_DIR)) == []
+
+def test_storage_busy_fails(config):
+    """Uploads are Service Unavailable (503) while write-behind storage is
+    full.
+
+    """
+    config['STORAGE_WRITERS'] = 1
+    app = UploadApplication(config)
+    headers = auth_headers(config, 'myuser')
+    assert request(app, 'PUT', '/upload', chunks=[b'hello'], headers=headers)[0] == 201
+
+    with patch.object(WriteBehindStorage, 'full', return_value=True):
+        status, response_headers, _ = request(
+            app, 'PUT', '/upload', chunks=[b'hello'], headers=headers)
+    assert status == 503
+    assert response_headers[b'retry-after'] == b'1'
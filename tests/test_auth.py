@@ -0,0 +1,140 @@
+"""
+Test token generation and verification.
+
+"""
+import time
+import uuid
+
+import pytest
+
+from bdfu.auth import (
+    InvalidTokenError, TokenCache, _jwt_token, decode_user_token, get_quota,
+    make_user_token, make_user_tokens, verify_user_token,
+)
+
+def test_verify_token():
+    """A generated token should verify with the same secret."""
+    secret = uuid.uuid4().hex
+    token = make_user_token('testuser', secret)
+    assert verify_user_token(token, secret) == 'testuser'
+
+def test_verify_wrong_secret():
+    """A token should not verify with a different secret."""
+    token = make_user_token('testuser', uuid.uuid4().hex)
+    with pytest.raises(InvalidTokenError):
+        verify_user_token(token, uuid.uuid4().hex)
+
+def test_verify_expired():
+    """An expired token should not verify."""
+    secret = uuid.uuid4().hex
+    token = make_user_token('testuser', secret, expires_in=-10)
+    with pytest.raises(InvalidTokenError):
+        verify_user_token(token, secret)
+
+def test_verify_needs_user():
+    """A token without a user claim should not verify."""
+    secret = uuid.uuid4().hex
+    token = _jwt_token(dict(notuser='testuser'), secret).decode('ascii')
+    with pytest.raises(InvalidTokenError):
+        verify_user_token(token, secret)
+
+def test_verify_garbage():
+    """Something which is not a token should not verify."""
+    with pytest.raises(InvalidTokenError):
+        verify_user_token('not.a.token', uuid.uuid4().hex)
+
+def test_quota():
+    """A quota in a token should override configured quotas."""
+    secret = uuid.uuid4().hex
+    config = dict(QUOTA=100, USER_QUOTAS={'biguser': 1000})
+
+    payload = decode_user_token(make_user_token('testuser', secret), secret)
+    assert get_quota(payload, config) == 100
+    assert get_quota(payload, {}) is None
+    payload = decode_user_token(make_user_token('biguser', secret), secret)
+    assert get_quota(payload, config) == 1000
+    payload = decode_user_token(make_user_token('testuser', secret, quota=10), secret)
+    assert payload['user'] == 'testuser'
+    assert get_quota(payload, config) == 10
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000
+    def __call__(self):
+        return self.now
+
+def test_make_user_tokens():
+    """Tokens made in bulk should verify like those made singly."""
+    secret = uuid.uuid4().hex
+    usernames = ['user{0}'.format(i) for i in range(25)] + [u'caf\xe9 "quoted"']
+    for processes in (None, 2):
+        pairs = list(make_user_tokens(
+            iter(usernames), secret, expires_in=60, quota=100, processes=processes,
+            batch_size=10))
+        assert [username for username, _ in pairs] == usernames
+
+        payloads = [decode_user_token(token, secret) for _, token in pairs]
+        assert [p['user'] for p in payloads] == usernames
+        assert all(p['quota'] == 100 for p in payloads)
+        assert len(set((p['exp'], p['nbf']) for p in payloads)) == 1
+        assert payloads[0]['exp'] == payloads[0]['nbf'] + 60
+
+    single = decode_user_token(make_user_token('someone', secret), secret)
+    _, token = next(make_user_tokens(['someone'], secret))
+    assert sorted(decode_user_token(token, secret)) == sorted(single)
+
+    _, token = next(make_user_tokens(['someone'], secret, expires_in=-10))
+    with pytest.raises(InvalidTokenError):
+        verify_user_token(token, secret)
+    with pytest.raises(ValueError):
+        list(make_user_tokens(['someone'], None))
+
+def test_token_cache_lru():
+    """TokenCache should evict the least recently used entry when full."""
+    cache = TokenCache(maxsize=2, clock=FakeClock())
+    cache.put('a', 'payload-a', 2000)
+    cache.put('b', 'payload-b', 2000)
+
+    # Use "a" so that "b" is least recently used
+    assert cache.get('a') == 'payload-a'
+    cache.put('c', 'payload-c', 2000)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'payload-a'
+    assert cache.get('c') == 'payload-c'
+    assert cache.stats() == dict(
+        hits=3, misses=1, evictions=1, expirations=0, size=2, maxsize=2)
+
+def test_token_cache_expiry():
+    """TokenCache entries should expire at the time given."""
+    clock = FakeClock()
+    cache = TokenCache(clock=clock)
+    cache.put('a', 'payload-a', 1010)
+    assert cache.get('a') == 'payload-a'
+
+    clock.now = 1010
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['size'] == 0
+
+def test_token_cache_disabled():
+    """A TokenCache of size zero should cache nothing."""
+    cache = TokenCache(maxsize=0)
+    cache.put('a', 'payload-a', time.time() + 100)
+    assert cache.get('a') is None
+
+def test_verify_token_with_cache():
+    """Verifying a token twice with a cache should hit the cache the second
+    time. The cache should not accept the token with another secret.
+
+    """
+    secret = uuid.uuid4().hex
+    token = make_user_token('testuser', secret)
+    cache = TokenCache()
+
+    assert verify_user_token(token, secret, cache=cache) == 'testuser'
+    assert verify_user_token(token, secret, cache=cache) == 'testuser'
+    assert cache.stats()['hits'] == 1
+
+    with pytest.raises(InvalidTokenError):
+        verify_user_token(token, uuid.uuid4().hex, cache=cache)
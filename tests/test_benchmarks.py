@@ -0,0 +1,63 @@
+"""
+Test the benchmark suite.
+
+"""
+import os
+import runpy
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pytest
+
+bench = runpy.run_path(
+    os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'run.py'), run_name='bench')
+
+@pytest.fixture
+def destdir():
+    destdir = mkdtemp(prefix='benchtest')
+    yield destdir
+    rmtree(destdir)
+
+def test_run(destdir):
+    """Every benchmark should run and leave no files behind."""
+    names = [name for name, _, _ in bench['BENCHMARKS']]
+    results = bench['run'](names, [1024, 1024 * 1024], [1, 2], 3, 10 ** 9, destdir)
+
+    assert len(results) == 2 * (2 + 2 + 1 + 1)
+    stats = results['storage.write size=1M concurrency=2']
+    assert stats['ops'] == 3
+    assert 0 < stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['max']
+    assert stats['bytes_per_sec'] == stats['ops_per_sec'] * 1024 * 1024
+    assert results['auth.make_token concurrency=1']['ops'] == 3
+    assert sorted(os.listdir(os.path.join(destdir, bench['USERNAME']))) == ['.partial', '.usage']
+
+def test_compare():
+    """Regressions beyond the threshold should be reported."""
+    baseline = {
+        'a': dict(p50=1.0, ops_per_sec=100.0),
+        'b': dict(p50=1.0, ops_per_sec=100.0),
+        'c': dict(p50=1.0, ops_per_sec=100.0),
+    }
+    results = {
+        'a': dict(p50=1.05, ops_per_sec=96.0),
+        'b': dict(p50=1.2, ops_per_sec=80.0),
+        'c': dict(p50=0.5, ops_per_sec=200.0),
+        'new': dict(p50=1.0, ops_per_sec=1.0),
+    }
+    regressions = bench['compare'](results, baseline, 0.1)
+    assert [key for key, _ in regressions] == ['b', 'b']
+
+def test_percentile():
+    """Percentiles should be by nearest rank."""
+    values = list(range(1, 101))
+    assert bench['percentile'](values, 0.5) == 50
+    assert bench['percentile'](values, 0.99) == 99
+    assert bench['percentile']([7], 0.99) == 7
+    assert bench['percentile']([], 0.5) is None
+
+def test_sizes():
+    """Sizes should be parsed and formatted with suffixes."""
+    assert [bench['parse_size'](s) for s in ('100', '1K', '64k', '1G')] == \
+        [100, 1024, 65536, 1024 ** 3]
+    assert [bench['format_size'](s) for s in (100, 1024, 1536, 1024 ** 3)] == \
+        ['100', '1K', '1536', '1G']
@@ -0,0 +1,48 @@
+"""
+Test content-defined chunking.
+
+"""
+from io import BytesIO
+import os
+
+from bdfu.chunking import iter_chunks
+
+# Small chunk sizes keep the tests quick
+SIZES = dict(min_size=256, avg_size=1024, max_size=4096)
+
+def test_chunks_join_to_contents():
+    """Chunks should be within the size limits and join to make the input."""
+    contents = os.urandom(100000)
+    chunks = list(iter_chunks(BytesIO(contents), **SIZES))
+    assert b''.join(chunks) == contents
+    assert all(256 <= len(c) <= 4096 for c in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 4096
+
+    # Chunk sizes should average roughly min_size + avg_size
+    assert 50 < len(chunks) < 150
+
+def test_chunking_is_deterministic():
+    """The same contents should always be split in the same way."""
+    contents = os.urandom(50000)
+    assert list(iter_chunks(BytesIO(contents), **SIZES)) == \
+        list(iter_chunks(BytesIO(contents), **SIZES))
+
+def test_insertion_changes_few_chunks():
+    """Inserting bytes should only change the chunks around them."""
+    contents = os.urandom(100000)
+    edited = contents[:50000] + b'inserted' + contents[50000:]
+
+    before = set(iter_chunks(BytesIO(contents), **SIZES))
+    after = list(iter_chunks(BytesIO(edited), **SIZES))
+    changed = [c for c in after if c not in before]
+    assert len(changed) <= 3
+
+def test_empty_and_uniform_input():
+    """Empty input has no chunks. Uniform input is still split within the
+    size limits.
+
+    """
+    assert list(iter_chunks(BytesIO(b''), **SIZES)) == []
+    chunks = list(iter_chunks(BytesIO(b'\0' * 10000), **SIZES))
+    assert b''.join(chunks) == b'\0' * 10000
+    assert all(256 <= len(c) <= 4096 for c in chunks[:-1])
@@ -1,33 +1,66 @@
+import hashlib
 from io import BytesIO
+import os
+import re
+from functools import partial
+from shutil import rmtree
+from tempfile import mkdtemp
 import uuid
 from mock import patch
 
-from future import standard_library
-standard_library.install_aliases()
-
-from urllib.parse import urljoin
+try:
+    from urllib.parse import urljoin
+except ImportError:  # Python 2
+    from urlparse import urljoin
 
 from flask.ext.testing import TestCase
 import pytest
+import requests
 import responses
 
 from bdfu.auth import make_user_token
-from bdfu.client import Client, ClientError
-from bdfu.webapp import app
+from bdfu.chunking import iter_chunks
+from bdfu.client import Client, ClientError, DigestMismatchError
+from bdfu.storage import StoredFile
+from bdfu.webapp import _get_admission, app
+
+def stored_file(file_id, contents):
+    """Return the StoredFile a Storage would return for contents."""
+    return StoredFile(file_id, len(contents), hashlib.sha256(contents).hexdigest())
+
+def request_body(request):
+    """Return the body of a requests request as bytes. Streamed bodies are
+    read in their entirety.
+
+    """
+    if hasattr(request.body, 'read'):
+        return request.body.read()
+    if request.body is None or isinstance(request.body, bytes):
+        return request.body
+    return b''.join(request.body)
 
-def add_responses_post_handler(from_url, client, to_url):
-    """Add a responses handler for from_url mapping to the werkzeug HTTP test
-    client at to_url.
+def add_responses_handlers(endpoint, client, methods):
+    """Add responses handlers mapping every URL under endpoint to the werkzeug
+    HTTP test client for each of the given methods. Chunked bodies are passed
+    on whole with a Content-Length since not every version of the test client
+    marks chunked input as terminated.
 
     """
-    def post_callback(request):
-        resp = client.post(to_url, data=request.body, headers=list(request.headers.items()))
+    def callback(request):
+        path = '/' + request.url[len(endpoint):]
+        headers = [(k, v) for k, v in request.headers.items()
+                   if k.lower() != 'transfer-encoding']
+        resp = client.open(
+            path, method=request.method, data=request_body(request),
+            headers=headers
+        )
         return resp.status_code, resp.headers, resp.data
 
-    responses.add_callback(
-        responses.POST, from_url,
-        callback=post_callback, content_type='application/json'
-    )
+    for method in methods:
+        responses.add_callback(
+            method, re.compile(re.escape(endpoint) + '.*'),
+            callback=callback, content_type='application/json'
+        )
 
 class ClientTestCase(TestCase):
     def create_app(self):
@@ -43,8 +76,8 @@ class ClientTestCase(TestCase):
         app.config
         return app
 
-    def _add_post_handler(self, url):
-        add_responses_post_handler(urljoin(self.endpoint, url), self.client, url)
+    def _add_handlers(self):
+        add_responses_handlers(self.endpoint, self.client, ['PUT'])
 
     @responses.activate
     @patch('bdfu.webapp._get_storage')
@@ -59,26 +92,26 @@ class ClientTestCase(TestCase):
         file_contents = uuid.uuid4().bytes
 
         # Add responses wrapper
-        self._add_post_handler('upload')
+        self._add_handlers()
 
         # Mock the storage's write method to record it's call values
         new_id = uuid.uuid4().hex
         stored_state = {}
-        def side_effect(username, fobj):
+        def side_effect(username, fobj, length=None, sha256=None, quota=None):
             # HACK: we need to use str() here as a "copy" since the user is
             # passed as current_user which is only a proxy object for the real
             # username. Without the call to str(), the username would be
             # "None" by the time we check it.
             stored_state['username'] = str(username)
-            stored_state['contents'] = fobj.read()
-            return new_id
-        gs_mock().write.side_effect = side_effect
+            stored_state['contents'] = fobj.read(length)
+            return stored_file(new_id, stored_state['contents'])
+        gs_mock().store.side_effect = side_effect
 
         # Perform upload
         created_id = client.upload(BytesIO(file_contents))
 
         # Check write was called exactly once
-        assert gs_mock().write.call_count == 1
+        assert gs_mock().store.call_count == 1
 
         # Check that the storage was passed the right values
         assert stored_state['username'] == username
@@ -87,6 +120,51 @@ class ClientTestCase(TestCase):
         # Check the id made its way back to us
         assert created_id == new_id
 
+    @responses.activate
+    @patch('bdfu.webapp._get_storage')
+    def test_unseekable_upload(self, gs_mock):
+        """Uploading a stream of unknown length should send it in chunks."""
+        token = make_user_token('myusername', self.secret)
+        client = Client(self.endpoint, token)
+        file_contents = os.urandom(10000)
+
+        # Record the request body as sent by requests
+        sent = {}
+        def callback(request):
+            sent['transfer-encoding'] = request.headers.get('Transfer-Encoding')
+            sent['chunks'] = list(request.body)
+            resp = self.client.put(
+                '/upload', data=b''.join(sent['chunks']), headers=self._auth_headers(token)
+            )
+            return resp.status_code, resp.headers, resp.data
+        responses.add_callback(
+            responses.PUT, urljoin(self.endpoint, 'upload'),
+            callback=callback, content_type='application/json'
+        )
+
+        new_id = uuid.uuid4().hex
+        stored_state = {}
+        def side_effect(username, fobj, length=None, sha256=None, quota=None):
+            stored_state['contents'] = fobj.read(length)
+            return stored_file(new_id, stored_state['contents'])
+        gs_mock().store.side_effect = side_effect
+
+        # A file-like object which cannot seek or tell, as for a pipe
+        class Pipe(object):
+            def __init__(self, contents):
+                self._f = BytesIO(contents)
+            def read(self, size=-1):
+                return self._f.read(size)
+
+        created_id = client.upload(Pipe(file_contents), chunk_size=1024)
+        assert created_id == new_id
+        assert stored_state['contents'] == file_contents
+        assert sent['transfer-encoding'] == 'chunked'
+        assert max(len(c) for c in sent['chunks']) == 1024
+
+    def _auth_headers(self, token):
+        return { 'Authorization': 'Bearer ' + token }
+
     @responses.activate
     def test_wrong_endpoint(self):
         """A bad endpoint should fail."""
@@ -99,3 +177,257 @@ class ClientTestCase(TestCase):
         # Attempt upload
         with pytest.raises(responses.ConnectionError):
             client.upload(BytesIO(file_contents))
+
+class StorageClientTestCase(TestCase):
+    """Uploads tested against a real storage directory."""
+    def create_app(self):
+        self.secret = uuid.uuid4().hex
+        self.endpoint = 'http://mock.endpoint.example.com/root/'
+        self.storage_dir = mkdtemp(prefix='clienttest')
+
+        app.config['JWT_SECRET_KEY'] = self.secret
+        app.config['STORAGE_DIR'] = self.storage_dir
+        app.debug = True
+        return app
+
+    def tearDown(self):
+        rmtree(self.storage_dir)
+
+    def _read_stored(self, username, file_id):
+        with open(os.path.join(self.storage_dir, username, file_id), 'rb') as f:
+            return f.read()
+
+    @responses.activate
+    def test_resumable_upload(self):
+        """Resumable uploading should succeed."""
+        add_responses_handlers(self.endpoint, self.client, ['GET', 'POST', 'PATCH'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        file_contents = os.urandom(10000)
+        created_id = client.upload(BytesIO(file_contents), resumable=True, chunk_size=1024)
+        assert self._read_stored('myusername', created_id) == file_contents
+
+    @responses.activate
+    def test_resumable_upload_survives_dropped_connection(self):
+        """A resumable upload should resume from the server's offset after a
+        connection failure.
+
+        """
+        patch_count = [0]
+        def callback(request):
+            # Let the server see the third chunk but lose the response.
+            patch_count[0] += 1
+            path = '/' + request.url[len(self.endpoint):]
+            resp = self.client.open(
+                path, method='PATCH', data=request.body,
+                headers=list(request.headers.items())
+            )
+            if patch_count[0] == 3:
+                raise requests.ConnectionError('connection dropped')
+            return resp.status_code, resp.headers, resp.data
+        responses.add_callback(
+            responses.PATCH, re.compile(re.escape(self.endpoint) + '.*'),
+            callback=callback, content_type='application/json'
+        )
+        add_responses_handlers(self.endpoint, self.client, ['GET', 'POST'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        file_contents = os.urandom(10000)
+        created_id = client.upload(BytesIO(file_contents), resumable=True, chunk_size=1024)
+        assert self._read_stored('myusername', created_id) == file_contents
+
+        # The server's offset shows that the chunk whose response was lost
+        # arrived and so no chunk is sent twice.
+        assert patch_count[0] == 10
+
+    @responses.activate
+    def test_resumable_upload_gives_up(self):
+        """A resumable upload should give up after too many failures."""
+        responses.add(
+            responses.PATCH, re.compile(re.escape(self.endpoint) + '.*'),
+            body=requests.ConnectionError('connection dropped')
+        )
+        add_responses_handlers(self.endpoint, self.client, ['GET', 'POST'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        with pytest.raises(requests.ConnectionError):
+            client.upload(BytesIO(os.urandom(10000)), resumable=True, retries=2)
+
+    @responses.activate
+    @patch('bdfu.client.time.sleep')
+    def test_busy_server_retried(self, sleep_mock):
+        """Uploads refused by a busy server should be retried after the
+        delay it asks for.
+
+        """
+        add_responses_handlers(self.endpoint, self.client, ['PUT'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+        app.config['USER_UPLOAD_CONCURRENCY'] = 1
+        try:
+            # Hold the user's only upload slot until the second retry
+            with self.app.test_request_context():
+                controller = _get_admission()
+            admission = controller.admit('myusername')
+            def release(delay):
+                if sleep_mock.call_count == 2:
+                    admission.release()
+            sleep_mock.side_effect = release
+
+            file_contents = os.urandom(10000)
+            created_id = client.upload(BytesIO(file_contents))
+            assert self._read_stored('myusername', created_id) == file_contents
+            assert [c[0][0] for c in sleep_mock.call_args_list] == [1, 1]
+
+            # Unseekable files cannot be sent again
+            admission = controller.admit('myusername')
+            sleep_mock.reset_mock()
+            class Pipe(object):
+                def __init__(self, contents):
+                    self._f = BytesIO(contents)
+                def read(self, size=-1):
+                    return self._f.read(size)
+            with pytest.raises(ClientError) as excinfo:
+                client.upload(Pipe(file_contents))
+            assert excinfo.value.response.status_code == 429
+            assert sleep_mock.call_count == 0
+        finally:
+            del app.config['USER_UPLOAD_CONCURRENCY']
+
+    def test_retry_delay(self):
+        """Delays should follow Retry-After or back off exponentially."""
+        client = Client(self.endpoint, 'token', backoff=0.5, max_backoff=3)
+        response = requests.Response()
+        assert [client._retry_delay(response, n) for n in range(5)] == [0.5, 1, 2, 3, 3]
+        response.headers['Retry-After'] = '2'
+        assert client._retry_delay(response, 3) == 2
+        response.headers['Retry-After'] = '3600'
+        assert client._retry_delay(response, 0) == 3
+        response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        assert client._retry_delay(response, 0) == 0.5
+
+    @responses.activate
+    def test_compressed_upload(self):
+        """Compressed uploading should store the original contents."""
+        add_responses_handlers(self.endpoint, self.client, ['PUT'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        file_contents = os.urandom(10000) + b'x' * 10000
+        created_id = client.upload(BytesIO(file_contents), chunk_size=1024, encoding='gzip')
+        assert self._read_stored('myusername', created_id) == file_contents
+
+        with pytest.raises(ValueError):
+            client.upload(BytesIO(file_contents), resumable=True, encoding='gzip')
+
+    @responses.activate
+    def test_parallel_upload(self):
+        """Parallel uploading should succeed."""
+        add_responses_handlers(self.endpoint, self.client, ['POST', 'PUT'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        # A size which is not a multiple of the part size and a non-zero
+        # starting position
+        file_contents = os.urandom(10000)
+        fobj = BytesIO(b'skipped' + file_contents)
+        fobj.seek(7)
+        created_id = client.upload(fobj, parallel=4, chunk_size=1024)
+        assert self._read_stored('myusername', created_id) == file_contents
+
+    @responses.activate
+    def test_corrupted_upload_fails(self):
+        """An upload whose stored digest differs from that computed by the
+        client should fail.
+
+        """
+        def callback(request):
+            # Corrupt the body on its way to the server
+            body = bytearray(request_body(request))
+            body[0] ^= 0xff
+            resp = self.client.put('/upload', data=bytes(body), headers=dict(request.headers))
+            return resp.status_code, resp.headers, resp.data
+        responses.add_callback(
+            responses.PUT, urljoin(self.endpoint, 'upload'),
+            callback=callback, content_type='application/json'
+        )
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        file_contents = os.urandom(1000)
+        with pytest.raises(DigestMismatchError) as excinfo:
+            client.upload(BytesIO(file_contents))
+        assert excinfo.value.expected == hashlib.sha256(file_contents).hexdigest()
+
+    @responses.activate
+    def test_upload_many(self):
+        """Uploading many files should return results in order with per-file
+        errors.
+
+        """
+        add_responses_handlers(self.endpoint, self.client, ['PUT'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        contents = [os.urandom(100 * (i + 1)) for i in range(8)]
+        files = [BytesIO(c) for c in contents]
+
+        # A path which does not exist should fail
+        files.insert(3, os.path.join(self.storage_dir, 'does-not-exist'))
+
+        results = client.upload_many(files, concurrency=3)
+        assert len(results) == 9
+
+        assert results[3].id is None
+        assert isinstance(results[3].error, IOError)
+        del results[3]
+
+        for result, expected in zip(results, contents):
+            assert result.error is None
+            assert self._read_stored('myusername', result.id) == expected
+
+    @responses.activate
+    def test_dedup_upload(self):
+        """Deduplicated uploads should only send chunks the server does not
+        already have.
+
+        """
+        add_responses_handlers(self.endpoint, self.client, ['POST', 'PUT'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        file_contents = os.urandom(100000)
+        edited = file_contents[:50000] + b'inserted' + file_contents[50000:]
+        small_chunks = partial(iter_chunks, min_size=256, avg_size=1024, max_size=4096)
+
+        with patch('bdfu.client.iter_chunks', small_chunks):
+            with patch.object(client.session, 'put', wraps=client.session.put) as put_mock:
+                created_id = client.upload(BytesIO(file_contents), dedup=True)
+                first_count = put_mock.call_count
+                put_mock.reset_mock()
+
+                edited_id = client.upload(BytesIO(edited), dedup=True, parallel=4)
+                assert put_mock.call_count <= 3
+
+        assert first_count > 50
+        assert self._read_stored('myusername', created_id) == file_contents
+        assert self._read_stored('myusername', edited_id) == edited
+
+    @responses.activate
+    def test_session_reuse(self):
+        """All requests should go through the client's session."""
+        add_responses_handlers(self.endpoint, self.client, ['PUT'])
+        session = requests.Session()
+        client = Client(self.endpoint, make_user_token('myusername', self.secret), session=session)
+        assert client.session is session
+
+        with patch.object(session, 'put', wraps=session.put) as put_mock:
+            client.upload(BytesIO(b'hello'))
+            client.upload(BytesIO(b'world'))
+        assert put_mock.call_count == 2
+
+    @responses.activate
+    def test_upload_batch(self):
+        """Uploading a batch of files in one request should succeed."""
+        add_responses_handlers(self.endpoint, self.client, ['POST'])
+        client = Client(self.endpoint, make_user_token('myusername', self.secret))
+
+        contents = [os.urandom(100 * (i + 1)) for i in range(5)]
+        file_ids = client.upload_batch([BytesIO(c) for c in contents])
+        assert len(file_ids) == 5
+        for file_id, expected in zip(file_ids, contents):
+            assert self._read_stored('myusername', file_id) == expected
@@ -0,0 +1,134 @@
+"""
+Test streaming compression.
+
+"""
+from io import BytesIO
+import gzip
+import os
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+import pytest
+
+from bdfu.compression import (
+    CompressingWriter, DecompressingReader, DecompressionError, UnsupportedCodecError,
+    available, compressor, decompressor, parse_content_encoding,
+)
+
+def compress(data, codec):
+    out = BytesIO()
+    w = CompressingWriter(out, codec)
+    w.write(data)
+    w.close()
+    return out.getvalue()
+
+def codecs():
+    """Return parameters for each codec, skipping those not installed."""
+    return [
+        'gzip',
+        pytest.param('zstd', marks=pytest.mark.skipif(
+            not available('zstd'), reason='zstandard is not installed')),
+    ]
+
+@pytest.mark.parametrize('codec', codecs())
+def test_round_trip(codec):
+    """Data should decompress to what was compressed, however it is read."""
+    data = os.urandom(100000) + b'x' * 100000
+    compressed = compress(data, codec)
+    assert len(compressed) < len(data)
+
+    reader = DecompressingReader(BytesIO(compressed), codec, chunk_size=1000)
+    parts = []
+    while True:
+        part = reader.read(777)
+        if not part:
+            break
+        parts.append(part)
+    assert b''.join(parts) == data
+    assert DecompressingReader(BytesIO(compressed), codec).read() == data
+
+@pytest.mark.parametrize('codec', codecs())
+def test_concatenated_streams(codec):
+    """Streams one after another should decompress as one."""
+    compressed = compress(b'hello ', codec) + compress(b'world', codec)
+    assert DecompressingReader(BytesIO(compressed), codec).read() == b'hello world'
+
+def compressed_zeros(size, codec):
+    """Return size zero bytes compressed, written a megabyte at a time."""
+    out = BytesIO()
+    w = CompressingWriter(out, codec)
+    for _ in range(size // (1024 * 1024)):
+        w.write(bytes(bytearray(1024 * 1024)))
+    w.close()
+    return out.getvalue()
+
+@pytest.mark.parametrize('codec', codecs())
+def test_bounded_output(codec):
+    """Highly compressed data should be decompressed a little at a time."""
+    size = 64 * 1024 * 1024
+    compressed = compressed_zeros(size, codec)
+    assert len(compressed) < size // 100
+
+    d = decompressor(codec)
+    total, data = 0, d.decompress(compressed, 1000)
+    assert len(data) == 1000
+    while data:
+        assert len(data) <= 1024 * 1024
+        total += len(data)
+        data = d.decompress(b'', 1024 * 1024)
+    assert total == size
+    d.check_finished()
+
+    if tracemalloc is None:
+        return
+    tracemalloc.start()
+    try:
+        reader = DecompressingReader(BytesIO(compressed), codec)
+        while reader.read(1024 * 1024):
+            pass
+        assert tracemalloc.get_traced_memory()[1] < 16 * 1024 * 1024
+    finally:
+        tracemalloc.stop()
+
+def test_gzip_compatible():
+    """gzip streams should be those of the gzip module."""
+    assert gzip.GzipFile(fileobj=BytesIO(compress(b'hello', 'gzip'))).read() == b'hello'
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(b'hello')
+    assert DecompressingReader(BytesIO(out.getvalue()), 'gzip').read() == b'hello'
+
+@pytest.mark.parametrize('codec', codecs())
+def test_bad_data(codec):
+    """Corrupt or truncated data should raise DecompressionError."""
+    compressed = compress(os.urandom(1000), codec)
+    with pytest.raises(DecompressionError):
+        DecompressingReader(BytesIO(compressed[:-10]), codec).read()
+    with pytest.raises(DecompressionError):
+        DecompressingReader(BytesIO(b'not compressed at all'), codec).read()
+
+    d = decompressor(codec)
+    d.decompress(compressed[:100])
+    with pytest.raises(DecompressionError):
+        d.check_finished()
+
+def test_parse_content_encoding():
+    """Content-Encoding values should name codecs."""
+    assert parse_content_encoding('') is None
+    assert parse_content_encoding('identity') is None
+    assert parse_content_encoding('gzip') == 'gzip'
+    assert parse_content_encoding(' X-GZIP ') == 'gzip'
+    for value in ('br', 'gzip, gzip', 'deflate'):
+        with pytest.raises(UnsupportedCodecError):
+            parse_content_encoding(value)
+
+def test_unknown_codec():
+    """Unknown codecs should be refused."""
+    assert not available('lzma')
+    with pytest.raises(UnsupportedCodecError):
+        compressor('lzma')
+    with pytest.raises(UnsupportedCodecError):
+        decompressor('lzma')
@@ -0,0 +1,128 @@
+"""
+Test the SQLite index of stored files.
+
+"""
+from io import BytesIO
+import os
+from shutil import rmtree
+import sqlite3
+from tempfile import mkdtemp
+import threading
+import time
+
+import pytest
+
+from bdfu.index import Index
+from bdfu.storage import Storage, StoredFile
+
+@pytest.fixture
+def tempdir():
+    path = mkdtemp(prefix='indextest')
+    yield path
+    rmtree(path)
+
+def count_rows(path):
+    """Count the records in the index at path as seen by another connection."""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_record_and_usage(tempdir):
+    """Recorded files should be counted by user and time."""
+    index = Index(os.path.join(tempdir, 'index.sqlite'))
+    index.record('alice', StoredFile('a' * 32, 100, 'x' * 64), uploaded=1000)
+    index.record('alice', StoredFile('b' * 32, 200, 'y' * 64), uploaded=2000)
+    index.record('bob', StoredFile('c' * 32, 50, 'z' * 64), uploaded=2000)
+
+    assert index.usage() == dict(alice=(2, 300), bob=(1, 50))
+    assert index.usage('alice') == dict(alice=(2, 300))
+    assert index.usage(since=1500) == dict(alice=(1, 200), bob=(1, 50))
+
+    index.remove('b' * 32)
+    assert index.usage('alice') == dict(alice=(1, 100))
+
+def test_wal_mode(tempdir):
+    """The index should be opened in WAL mode."""
+    path = os.path.join(tempdir, 'index.sqlite')
+    Index(path)
+    conn = sqlite3.connect(path)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    conn.close()
+
+def test_batching(tempdir):
+    """Records should be written in batches or after flush_interval."""
+    path = os.path.join(tempdir, 'index.sqlite')
+    index = Index(path, batch_size=3, flush_interval=0.2)
+
+    for i in range(2):
+        index.record('alice', StoredFile('{0:032x}'.format(i), 1, None))
+    assert count_rows(path) == 0
+    index.record('alice', StoredFile('{0:032x}'.format(2), 1, None))
+    assert count_rows(path) == 3
+
+    # A partial batch is written in the background
+    index.record('alice', StoredFile('{0:032x}'.format(3), 1, None))
+    deadline = time.time() + 5
+    while count_rows(path) < 4 and time.time() < deadline:
+        time.sleep(0.05)
+    assert count_rows(path) == 4
+
+def test_concurrent_writers(tempdir):
+    """Several indexes, as in several processes, may write at once."""
+    path = os.path.join(tempdir, 'index.sqlite')
+    def write(n):
+        index = Index(path, batch_size=10)
+        for i in range(50):
+            index.record('user{0}'.format(n), StoredFile('{0:016x}{1:016x}'.format(n, i), 1, None))
+        index.close()
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert count_rows(path) == 200
+
+def test_storage_records_files(tempdir):
+    """Storage should record files it stores and deletes."""
+    index = Index(os.path.join(tempdir, 'index.sqlite'))
+    storage = Storage(os.path.join(tempdir, 'storage'), index=index)
+    stored = storage.store('alice', BytesIO(b'hello'))
+    storage.write('alice', BytesIO(b'world!'))
+    assert index.usage() == dict(alice=(2, 11))
+
+    storage.delete('alice', stored.id)
+    assert index.usage() == dict(alice=(1, 6))
+
+def test_rebuild(tempdir):
+    """Rebuilding should index every file already in storage."""
+    storage = Storage(os.path.join(tempdir, 'storage'), shard_levels=1)
+    for username in ('alice', 'bob'):
+        for i in range(3):
+            storage.write(username, BytesIO(os.urandom(10)))
+    storage.spool('alice')
+    storage.create_session('bob')
+
+    index = Index(os.path.join(tempdir, 'index.sqlite'))
+    index.record('carol', StoredFile('a' * 32, 100, None))
+    # The layout of the tree need not match that of the Storage
+    assert index.rebuild(Storage(storage.destdir)) == 6
+    assert index.usage() == dict(alice=(3, 30), bob=(3, 30))
+
+def test_compressed_sizes(tempdir):
+    """Files stored compressed should be recorded with their size on disk
+    both as they are stored and when the index is rebuilt.
+
+    """
+    index = Index(os.path.join(tempdir, 'index.sqlite'))
+    storage = Storage(os.path.join(tempdir, 'storage'), index=index, compression='gzip')
+    stored = storage.store('alice', BytesIO(b'x' * 100000))
+    assert stored.size == 100000
+    size = os.path.getsize(storage.locate('alice', stored.id)[0])
+    assert size < 100000
+    assert index.usage() == dict(alice=(1, size))
+
+    assert index.rebuild(storage) == 1
+    assert index.usage() == dict(alice=(1, size))
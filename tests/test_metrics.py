@@ -0,0 +1,82 @@
+"""
+Test metrics.
+
+"""
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pytest
+
+from bdfu.metrics import Registry, timer
+
+@pytest.fixture
+def directory():
+    directory = mkdtemp(prefix='metricstest')
+    yield directory
+    rmtree(directory)
+
+def make_registry(directory=None):
+    registry = Registry(directory, interval=60)
+    registry.counter('requests_total', 'Requests "handled".')
+    registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    return registry
+
+def test_render():
+    """Values should be rendered in the Prometheus text format."""
+    registry = make_registry()
+    registry.inc('requests_total', status=200)
+    registry.inc('requests_total', 2, status=200)
+    registry.inc('requests_total', status=404)
+    registry.inc('requests_total', user='a"b\\c')
+    for value in (0.05, 0.1, 0.5, 3):
+        registry.observe('latency_seconds', value, stage='write')
+
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests "handled".',
+        '# TYPE requests_total counter',
+        'requests_total{status="200"} 3',
+        'requests_total{status="404"} 1',
+        'requests_total{user="a\\"b\\\\c"} 1',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{stage="write",le="0.1"} 2',
+        'latency_seconds_bucket{stage="write",le="1.0"} 3',
+        'latency_seconds_bucket{stage="write",le="+Inf"} 4',
+        'latency_seconds_sum{stage="write"} 3.65',
+        'latency_seconds_count{stage="write"} 4',
+    ]
+
+def test_timer():
+    """Timers should observe the time spent within them."""
+    registry = make_registry()
+    with registry.time('latency_seconds', stage='x'):
+        pass
+    with timer(registry, 'latency_seconds', stage='x'):
+        pass
+    with timer(None, 'latency_seconds', stage='x'):
+        pass
+    [(name, labels, value)] = registry.snapshot()
+    assert (name, labels) == ('latency_seconds', (('stage', 'x'),))
+    assert value[0] == 2
+
+def test_processes(directory):
+    """Values written by other processes should be added together."""
+    first, second = make_registry(directory), make_registry(directory)
+    first.inc('requests_total', status=200)
+    first.observe('latency_seconds', 0.5)
+    second.inc('requests_total', 2, status=200)
+    second.inc('requests_total', status=500)
+    second.observe('latency_seconds', 0.05)
+    second.write()
+
+    # Files other than complete snapshots are ignored
+    with open(os.path.join(directory, 'metrics-partial.json.tmp'), 'w') as f:
+        f.write('[["requests_total", [["status", "200"]], 100]]')
+
+    text = first.render()
+    assert 'requests_total{status="200"} 3\n' in text
+    assert 'requests_total{status="500"} 1\n' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'latency_seconds_count 2\n' in text
+    assert len([f for f in os.listdir(directory) if f.endswith('.json')]) == 2
@@ -0,0 +1,110 @@
+"""
+Test the bundled WSGI server.
+
+"""
+from io import BytesIO
+import os
+import threading
+
+try:
+    from http.client import HTTPConnection
+except ImportError: # pragma: no cover
+    from httplib import HTTPConnection
+
+import pytest
+
+from bdfu.server import ChunkedReader, PooledWSGIServer
+
+def chunked(data, chunk_size):
+    """Encode data with chunked transfer encoding."""
+    out = []
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:i+chunk_size]
+        out.append('{0:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+    out.append(b'0\r\nX-Trailer: ignored\r\n\r\n')
+    return b''.join(out)
+
+def test_chunked_reader():
+    """ChunkedReader should decode a chunked body and leave the stream at the
+    end of it.
+
+    """
+    data = os.urandom(10000)
+    rfile = BytesIO(chunked(data, 1000) + b'next request')
+    reader = ChunkedReader(rfile)
+
+    assert reader.read(1500) == data[:1500]
+    assert reader.read() == data[1500:]
+    assert reader.read() == b''
+    assert rfile.read() == b'next request'
+
+def test_chunked_reader_readline():
+    """ChunkedReader should support reading lines."""
+    reader = ChunkedReader(BytesIO(chunked(b'one\ntwo\nthree', 5)))
+    assert reader.readline() == b'one\n'
+    assert reader.readline() == b'two\n'
+    assert reader.readline() == b'three'
+    assert reader.readline() == b''
+
+def test_chunked_reader_truncated():
+    """ChunkedReader should raise IOError if the body is truncated."""
+    reader = ChunkedReader(BytesIO(chunked(b'hello, world', 5)[:10]))
+    with pytest.raises(IOError):
+        reader.read()
+
+@pytest.fixture
+def server():
+    def echo_app(environ, start_response):
+        # Respond with the request body and whether the input was terminated
+        body = environ['wsgi.input'].read(
+            None if environ.get('wsgi.input_terminated') else int(environ.get('CONTENT_LENGTH') or 0))
+        start_response('200 OK', [
+            ('Content-Type', 'application/octet-stream'),
+            ('X-Input-Terminated', str(bool(environ.get('wsgi.input_terminated')))),
+            ('X-Multithread', str(environ['wsgi.multithread'])),
+        ])
+        return [body]
+
+    server = PooledWSGIServer(('127.0.0.1', 0), threads=4)
+    server.set_app(echo_app)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def test_server_chunked_request(server):
+    """The server should pass a chunked request body to the application."""
+    data = os.urandom(100000)
+    conn = HTTPConnection('127.0.0.1', server.server_port)
+    conn.putrequest('PUT', '/')
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    conn.send(chunked(data, 4096))
+
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader('X-Input-Terminated') == 'True'
+    assert resp.getheader('X-Multithread') == 'True'
+    assert resp.read() == data
+
+def test_server_concurrent_requests(server):
+    """The server should handle more concurrent requests than it has
+    threads.
+
+    """
+    results = []
+    def request(i):
+        conn = HTTPConnection('127.0.0.1', server.server_port)
+        body = str(i).encode('ascii') * 1000
+        conn.request('POST', '/', body=body)
+        resp = conn.getresponse()
+        results.append(resp.read() == body)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [True] * 20
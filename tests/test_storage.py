@@ -3,13 +3,28 @@ Test the file storage backend.
 
 """
 from contextlib import contextmanager
+import errno
+import gzip
+import hashlib
 from io import BytesIO
 import os
 from shutil import rmtree
 from tempfile import mkdtemp
+import threading
+import time
 from unittest import TestCase
+import uuid
 
-from bdfu.storage import Storage
+from mock import patch
+import pytest
+
+import bdfu.storage
+from bdfu.compression import DecompressingReader, UnsupportedCodecError
+from bdfu.storage import (
+    DIGEST_SUFFIX, PARTIAL_DIR, USAGE_FILE, DigestMismatchError, MissingChunksError,
+    QuotaExceededError, Storage, UnknownFileError, UnknownSessionError,
+    parse_digest_header,
+)
 
 @contextmanager
 def temp_storage(prefix='storagetest'):
@@ -93,3 +108,742 @@ def test_repeat_write():
         # File ids should differ
         assert file_id_1 != file_id_2
 
+
+def test_concurrent_directory_creation():
+    """Writing should succeed if another writer creates the user's directory
+    first.
+
+    """
+    makedirs = os.makedirs
+    def racing_makedirs(path, *args, **kwargs):
+        makedirs(path, *args, **kwargs)
+        raise OSError(errno.EEXIST, 'File exists', path)
+
+    with temp_storage() as storage:
+        username = 'testuser'
+        with patch('os.makedirs', side_effect=racing_makedirs):
+            file_id = storage.write(username, BytesIO(b'abc'))
+            session_id = storage.create_session(username)
+        with open(os.path.join(storage.destdir, username, file_id), 'rb') as f:
+            assert f.read() == b'abc'
+        assert storage.session_offset(username, session_id) == 0
+
+def test_write_with_length():
+    """Storage should read exactly length bytes if length is specified."""
+    contents = os.urandom(1024)
+
+    with temp_storage() as storage:
+        username = 'testuser'
+        src = BytesIO(contents)
+        file_id = storage.write(username, src, length=100)
+
+        # Only the first 100 bytes should have been consumed and written
+        assert src.tell() == 100
+        with open(os.path.join(storage.destdir, username, file_id), 'rb') as f:
+            assert f.read() == contents[:100]
+
+def test_short_write_fails():
+    """Storage should raise IOError and not leave a file behind if fewer than
+    length bytes are available.
+
+    """
+    with temp_storage() as storage:
+        username = 'testuser'
+        with pytest.raises(IOError):
+            storage.write(username, BytesIO(os.urandom(100)), length=1024)
+        assert os.listdir(os.path.join(storage.destdir, username)) == [PARTIAL_DIR]
+        assert os.listdir(os.path.join(storage.destdir, username, PARTIAL_DIR)) == []
+
+def test_session_upload():
+    """Data written to a session should become a stored file on commit."""
+    contents = os.urandom(1024)
+
+    with temp_storage() as storage:
+        username = 'testuser'
+        session_id = storage.create_session(username)
+        assert storage.session_offset(username, session_id) == 0
+
+        # Write in two pieces
+        assert storage.write_session(username, session_id, 0, BytesIO(contents[:100])) == 100
+        assert storage.session_offset(username, session_id) == 100
+        assert storage.write_session(username, session_id, 100, BytesIO(contents[100:])) == 1024
+
+        stored = storage.commit_session(username, session_id)
+        assert stored.size == 1024
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+        with open(os.path.join(storage.destdir, username, stored.id), 'rb') as f:
+            assert f.read() == contents
+
+        # The session no longer exists
+        with pytest.raises(UnknownSessionError):
+            storage.session_offset(username, session_id)
+
+def test_session_keeps_data_after_short_write():
+    """A session should keep data received before an incomplete write so
+    that the upload can be resumed.
+
+    """
+    with temp_storage() as storage:
+        username = 'testuser'
+        session_id = storage.create_session(username)
+        with pytest.raises(IOError):
+            storage.write_session(username, session_id, 0, BytesIO(b'x' * 100), length=200)
+        assert storage.session_offset(username, session_id) == 100
+
+def test_unknown_session():
+    """Bad or unknown session ids should raise UnknownSessionError."""
+    with temp_storage() as storage:
+        username = 'testuser'
+        storage.create_session(username)
+        for session_id in (uuid.uuid4().hex, '../../etc/passwd', ''):
+            with pytest.raises(UnknownSessionError):
+                storage.session_offset(username, session_id)
+            with pytest.raises(UnknownSessionError):
+                storage.commit_session(username, session_id)
+
+def test_delete_session():
+    """Deleting a session should discard it."""
+    with temp_storage() as storage:
+        username = 'testuser'
+        session_id = storage.create_session(username)
+        storage.delete_session(username, session_id)
+        with pytest.raises(UnknownSessionError):
+            storage.session_offset(username, session_id)
+
+def test_write_many():
+    """Storage should write many files returning ids in order."""
+    contents = [os.urandom(100 * (i + 1)) for i in range(5)]
+
+    with temp_storage() as storage:
+        username = 'testuser'
+        file_ids = storage.write_many(username, (BytesIO(c) for c in contents))
+        assert len(set(file_ids)) == 5
+
+        for file_id, expected in zip(file_ids, contents):
+            with open(os.path.join(storage.destdir, username, file_id), 'rb') as f:
+                assert f.read() == expected
+
+def test_write_spooled():
+    """Storage should move a spooled file into place without copying it."""
+    contents = os.urandom(1024)
+
+    with temp_storage() as storage:
+        username = 'testuser'
+        f = storage.spool(username)
+        f.write(contents)
+        f.seek(0)
+        inode = os.fstat(f.fileno()).st_ino
+
+        file_id = storage.write(username, f)
+        expected_path = os.path.join(storage.destdir, username, file_id)
+        assert os.stat(expected_path).st_ino == inode
+        with open(expected_path, 'rb') as f2:
+            assert f2.read() == contents
+
+        # Discarding the spooled file after writing it does nothing
+        storage.discard(f)
+        assert os.path.isfile(expected_path)
+
+def test_write_spooled_other_user():
+    """A file spooled for one user should be copied if written for another."""
+    with temp_storage() as storage:
+        f = storage.spool('alice')
+        f.write(b'hello')
+        f.seek(0)
+
+        file_id = storage.write('bob', f)
+        assert os.path.isfile(f.name)
+        with open(os.path.join(storage.destdir, 'bob', file_id), 'rb') as f2:
+            assert f2.read() == b'hello'
+
+def test_discard():
+    """Discarding a spooled file should remove it."""
+    with temp_storage() as storage:
+        f = storage.spool('testuser')
+        assert os.path.isfile(f.name)
+        storage.discard(f)
+        assert not os.path.exists(f.name)
+
+def test_sharded_write():
+    """A sharded Storage should write files to <user>/ab/cd/<uuid>."""
+    with temp_storage() as flat:
+        storage = Storage(flat.destdir, shard_levels=2)
+        file_id = storage.write('testuser', BytesIO(b'hello'))
+        expected_path = os.path.join(
+            storage.destdir, 'testuser', file_id[:2], file_id[2:4], file_id)
+        assert storage.path('testuser', file_id) == expected_path
+        with open(expected_path, 'rb') as f:
+            assert f.read() == b'hello'
+
+def test_sharded_write_recreates_removed_dir(monkeypatch):
+    """Writing should succeed if a directory known to exist is removed."""
+    with temp_storage() as flat:
+        storage = Storage(flat.destdir, shard_levels=1)
+        file_id = storage.write('testuser', BytesIO(b'hello'))
+        path = storage.path('testuser', file_id)
+        os.unlink(path)
+        os.unlink(path + DIGEST_SUFFIX)
+        os.rmdir(os.path.dirname(path))
+
+        # Force the next write to use the same shard
+        monkeypatch.setattr(uuid, 'uuid4', lambda: uuid.UUID(hex=file_id[:2] + '0' * 30))
+        new_id = storage.write('testuser', BytesIO(b'again'))
+        assert os.path.isfile(storage.path('testuser', new_id))
+
+def test_migrate():
+    """Migrating should move files between flat and sharded layouts."""
+    with temp_storage() as flat:
+        ids = [flat.write('testuser', BytesIO(os.urandom(16))) for _ in range(10)]
+        flat.spool('testuser')
+
+        sharded = Storage(flat.destdir, shard_levels=2)
+        assert sharded.migrate() == 10
+        assert sharded.migrate() == 0
+        for file_id in ids:
+            assert os.path.isfile(sharded.path('testuser', file_id))
+
+        assert flat.migrate() == 10
+        assert sorted(os.listdir(os.path.join(flat.destdir, 'testuser'))) == \
+            sorted(ids + [i + DIGEST_SUFFIX for i in ids] + [PARTIAL_DIR, USAGE_FILE])
+        assert len(os.listdir(os.path.join(flat.destdir, 'testuser', PARTIAL_DIR))) == 1
+
+def test_store_records_digest():
+    """Storage should compute the digest of a file as it is written and
+    record it alongside the file.
+
+    """
+    contents = os.urandom(1024)
+    expected = hashlib.sha256(contents).hexdigest()
+
+    with temp_storage() as storage:
+        stored = storage.store('testuser', BytesIO(contents))
+        assert stored.size == 1024
+        assert stored.sha256 == expected
+        assert storage.sha256('testuser', stored.id) == expected
+
+        # The digest file can be checked with sha256sum
+        with open(storage.path('testuser', stored.id) + DIGEST_SUFFIX) as f:
+            assert f.read() == '{0}  {1}\n'.format(expected, stored.id)
+
+def test_store_spooled_digest():
+    """The digest of a spooled file should be computed as it is written, or
+    by reading it if it is not written sequentially.
+
+    """
+    with temp_storage() as storage:
+        f = storage.spool('testuser')
+        f.write(b'hello, world')
+        f.seek(0)
+        assert storage.store('testuser', f).sha256 == hashlib.sha256(b'hello, world').hexdigest()
+
+        f = storage.spool('testuser')
+        f.write(b'hello, world')
+        f.seek(0)
+        f.write(b'HELLO')
+        assert storage.store('testuser', f).sha256 == hashlib.sha256(b'HELLO, world').hexdigest()
+
+def test_store_digest_mismatch():
+    """Storing a file whose digest is not that expected should fail and leave
+    nothing behind.
+
+    """
+    with temp_storage() as storage:
+        with pytest.raises(DigestMismatchError) as excinfo:
+            storage.store('testuser', BytesIO(b'hello'), sha256='00' * 32)
+        assert excinfo.value.actual == hashlib.sha256(b'hello').hexdigest()
+        assert os.listdir(os.path.join(storage.destdir, 'testuser')) == [PARTIAL_DIR]
+        assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == []
+
+        # A session is left open so that it may be deleted or inspected
+        session_id = storage.create_session('testuser')
+        storage.write_session('testuser', session_id, 0, BytesIO(b'hello'))
+        with pytest.raises(DigestMismatchError):
+            storage.commit_session('testuser', session_id, sha256='00' * 32)
+        assert storage.session_offset('testuser', session_id) == 5
+
+def test_parse_digest_header():
+    """SHA-256 digests should be parsed from Digest and Content-Digest
+    headers.
+
+    """
+    digest = hashlib.sha256(b'hello').hexdigest()
+    encoded = 'LPJNul+wow4m6DsqxbninhsWHlwfp0JecwQzYpOLmCQ='
+    assert parse_digest_header('sha-256=' + encoded) == digest
+    assert parse_digest_header('MD5=XUFAKrxLKna5cZ2REBfFkg==, SHA-256=' + encoded) == digest
+    assert parse_digest_header('sha-256=:' + encoded + ':') == digest
+    assert parse_digest_header('sha-512=:abcd:') is None
+    with pytest.raises(ValueError):
+        parse_digest_header('sha-256=:aGVsbG8=:')
+
+@contextmanager
+def temp_dedup_storage():
+    """As temp_storage() but with deduplication enabled."""
+    with temp_storage() as storage:
+        yield Storage(storage.destdir, dedup=True)
+
+def test_dedup_links_identical_files():
+    """With dedup enabled, files with identical contents should share an
+    inode while different contents should not.
+
+    """
+    contents = os.urandom(1024)
+    with temp_dedup_storage() as storage:
+        id_1 = storage.write('alice', BytesIO(contents))
+        id_2 = storage.write('bob', BytesIO(contents))
+        id_3 = storage.write('alice', BytesIO(b'something else'))
+
+        st_1 = os.stat(storage.path('alice', id_1))
+        st_2 = os.stat(storage.path('bob', id_2))
+        assert st_1.st_ino == st_2.st_ino
+        assert st_1.st_nlink == 3  # the blob plus two files
+        assert os.stat(storage.path('alice', id_3)).st_ino != st_1.st_ino
+
+        with open(storage.path('bob', id_2), 'rb') as f:
+            assert f.read() == contents
+        assert os.listdir(os.path.join(storage.destdir, 'alice', PARTIAL_DIR)) == []
+
+def test_dedup_delete():
+    """Deleting a file should only remove shared contents with the last
+    file using them.
+
+    """
+    contents = os.urandom(1024)
+    with temp_dedup_storage() as storage:
+        id_1 = storage.write('alice', BytesIO(contents))
+        id_2 = storage.write('alice', BytesIO(contents))
+        blob = storage._blob_path(hashlib.sha256(contents).hexdigest())
+
+        storage.delete('alice', id_1)
+        assert not os.path.exists(storage.path('alice', id_1))
+        assert not os.path.exists(storage.path('alice', id_1) + DIGEST_SUFFIX)
+        assert os.path.isfile(blob)
+
+        storage.delete('alice', id_2)
+        assert not os.path.exists(blob)
+        assert sorted(os.listdir(os.path.join(storage.destdir, 'alice'))) == [PARTIAL_DIR, USAGE_FILE]
+
+        with pytest.raises(UnknownFileError):
+            storage.delete('alice', id_2)
+        with pytest.raises(UnknownFileError):
+            storage.delete('alice', '../bob')
+
+def test_dedup_blob_removed_while_writing(monkeypatch):
+    """A blob disappearing just before a file is linked to it should result
+    in a new blob.
+
+    """
+    contents = os.urandom(1024)
+    with temp_dedup_storage() as storage:
+        storage.write('alice', BytesIO(contents))
+        blob = storage._blob_path(hashlib.sha256(contents).hexdigest())
+
+        real_link = os.link
+        def link(src, dst):
+            if src == blob and os.path.exists(blob):
+                os.unlink(blob)
+            return real_link(src, dst)
+        monkeypatch.setattr(os, 'link', link)
+
+        file_id = storage.write('alice', BytesIO(contents))
+        assert os.stat(blob).st_ino == os.stat(storage.path('alice', file_id)).st_ino
+
+def test_chunks():
+    """Chunks should be stored and assembled into files."""
+    chunks = [os.urandom(100) for _ in range(3)]
+    digests = [hashlib.sha256(c).hexdigest() for c in chunks]
+    contents = chunks[0] + chunks[1] + chunks[0] + chunks[2]
+
+    with temp_storage() as storage:
+        # Missing chunks are listed once each
+        order = [digests[0], digests[1], digests[0], digests[2]]
+        assert storage.missing_chunks('testuser', order) == digests
+
+        storage.write_chunk('testuser', digests[0], BytesIO(chunks[0]))
+        storage.write_chunk('testuser', digests[1], BytesIO(chunks[1]))
+        assert storage.missing_chunks('testuser', order) == [digests[2]]
+        with pytest.raises(MissingChunksError) as excinfo:
+            storage.assemble('testuser', order)
+        assert excinfo.value.missing == [digests[2]]
+
+        storage.write_chunk('testuser', digests[2], BytesIO(chunks[2]))
+        stored = storage.assemble('testuser', order)
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+        with open(storage.path('testuser', stored.id), 'rb') as f:
+            assert f.read() == contents
+
+        # Chunks are kept for later files
+        assert storage.missing_chunks('testuser', order) == []
+        assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == []
+
+        # Chunks are per-user
+        assert storage.missing_chunks('otheruser', order) == digests
+
+def test_bad_chunk():
+    """A chunk whose contents do not match its digest should not be stored."""
+    with temp_storage() as storage:
+        digest = hashlib.sha256(b'hello').hexdigest()
+        with pytest.raises(DigestMismatchError):
+            storage.write_chunk('testuser', digest, BytesIO(b'HELLO'))
+        assert storage.missing_chunks('testuser', [digest]) == [digest]
+        assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == []
+
+        with pytest.raises(ValueError):
+            storage.write_chunk('testuser', '../../etc/passwd', BytesIO(b'hello'))
+
+def test_prune_chunks():
+    """Pruning should remove chunks which have not been used recently."""
+    with temp_storage() as storage:
+        old, new = hashlib.sha256(b'old').hexdigest(), hashlib.sha256(b'new').hexdigest()
+        storage.write_chunk('testuser', old, BytesIO(b'old'))
+        storage.write_chunk('testuser', new, BytesIO(b'new'))
+        an_hour_ago = time.time() - 3600
+        os.utime(storage._chunk_path('testuser', old), (an_hour_ago, an_hour_ago))
+
+        assert storage.prune_chunks(60) == 1
+        assert storage.missing_chunks('testuser', [old, new]) == [old]
+
+def test_usage():
+    """Usage should count the bytes stored by each user."""
+    with temp_storage() as storage:
+        assert storage.usage('alice') == 0
+        id_1 = storage.write('alice', BytesIO(b'x' * 100))
+        storage.write('alice', BytesIO(b'x' * 50))
+        id_2 = storage.write('bob', BytesIO(b'x' * 10))
+        assert storage.usage('alice') == 150
+        assert storage.usage('bob') == 10
+
+        storage.delete('alice', id_1)
+        assert storage.usage('alice') == 50
+
+        # Files stored before usage was counted can be counted later
+        os.unlink(os.path.join(storage.destdir, 'alice', USAGE_FILE))
+        assert storage.usage('alice') == 0
+        assert storage.recount_usage() == {'alice': 50, 'bob': 10}
+        assert storage.usage('alice') == 50
+
+        # A user whose files have all been removed is reset to zero
+        os.unlink(storage.path('bob', id_2))
+        assert storage.recount_usage() == {'alice': 50, 'bob': 0}
+        assert storage.usage('bob') == 0
+
+def test_quota():
+    """Storing a file which takes a user over quota should fail and leave
+    nothing behind.
+
+    """
+    with temp_storage() as storage:
+        storage.store('alice', BytesIO(b'x' * 60), quota=100)
+
+        # Known to be too long before reading
+        contents = BytesIO(b'x' * 50)
+        with pytest.raises(QuotaExceededError) as excinfo:
+            storage.store('alice', contents, length=50, quota=100)
+        assert excinfo.value.quota == 100
+        assert excinfo.value.usage == 60
+        assert contents.tell() == 0
+
+        # Found to be too long while reading
+        with pytest.raises(QuotaExceededError):
+            storage.store('alice', BytesIO(b'x' * 50), quota=100)
+
+        # Found to be too long on commit
+        f = storage.spool('alice')
+        f.write(b'x' * 50)
+        with pytest.raises(QuotaExceededError):
+            storage.store('alice', f, quota=100)
+
+        assert storage.usage('alice') == 60
+        assert os.listdir(os.path.join(storage.destdir, 'alice', PARTIAL_DIR)) == []
+        assert len(list(storage.iter_files())) == 1
+
+        storage.store('alice', BytesIO(b'x' * 40), quota=100)
+        assert storage.usage('alice') == 100
+
+def test_session_quota():
+    """Writing a session beyond quota should fail."""
+    with temp_storage() as storage:
+        sid = storage.create_session('alice')
+        assert storage.write_session('alice', sid, 0, BytesIO(b'x' * 60), quota=100) == 60
+        with pytest.raises(QuotaExceededError):
+            storage.write_session('alice', sid, 60, BytesIO(b'x' * 50), quota=100)
+
+        # The session's data counts until it is committed or abandoned
+        storage.write('alice', BytesIO(b'x' * 50))
+        assert storage.usage('alice') == 110
+        with pytest.raises(QuotaExceededError):
+            storage.commit_session('alice', sid, quota=100)
+        assert storage.usage('alice') == 110
+        assert storage.session_offset('alice', sid) >= 60
+
+        # Other sessions cannot be used to get around the quota
+        other = storage.create_session('alice')
+        with pytest.raises(QuotaExceededError):
+            storage.write_session('alice', other, 0, BytesIO(b'x'), quota=100)
+
+        storage.delete_session('alice', sid)
+        assert storage.usage('alice') == 50
+        assert storage.write_session('alice', other, 0, BytesIO(b'x' * 20), quota=100) == 20
+        assert storage.write_session('alice', other, 10, BytesIO(b'x' * 20), quota=100) == 30
+        assert storage.usage('alice') == 80
+        stored = storage.commit_session('alice', other, quota=100)
+        assert storage.usage('alice') == 80
+        assert os.listdir(os.path.join(storage.destdir, 'alice', PARTIAL_DIR)) == []
+
+        storage.delete('alice', stored.id)
+        assert storage.recount_usage() == {'alice': 50}
+
+def test_chunk_quota():
+    """Chunks should count towards usage until they are pruned."""
+    with temp_storage() as storage:
+        chunks = [os.urandom(40) for _ in range(3)]
+        digests = [hashlib.sha256(c).hexdigest() for c in chunks]
+        storage.write_chunk('alice', digests[0], BytesIO(chunks[0]), quota=100)
+        storage.write_chunk('alice', digests[1], BytesIO(chunks[1]), quota=100)
+        assert storage.usage('alice') == 80
+
+        # Writing a chunk again does not charge for it twice
+        storage.write_chunk('alice', digests[0], BytesIO(chunks[0]), quota=100)
+        assert storage.usage('alice') == 80
+
+        with pytest.raises(QuotaExceededError):
+            storage.write_chunk('alice', digests[2], BytesIO(chunks[2]), quota=100)
+        with pytest.raises(QuotaExceededError):
+            storage.write_chunk('alice', digests[2], BytesIO(chunks[2]), length=40, quota=100)
+        assert storage.missing_chunks('alice', digests) == digests[2:]
+        assert storage.usage('alice') == 80
+        assert storage.recount_usage() == {'alice': 80}
+
+        assert storage.prune_chunks(-60) == 2
+        assert storage.usage('alice') == 0
+
+def record_syncs(monkeypatch):
+    """Record the paths synced by storage in the returned list."""
+    synced, fsync_path = [], bdfu.storage._fsync_path
+    def record(path):
+        synced.append(path)
+        fsync_path(path)
+    monkeypatch.setattr(bdfu.storage, '_fsync_path', record)
+    return synced
+
+def test_durability_file(monkeypatch):
+    """With per-file durability, a stored file, its digest and directories
+    should be synced before it is returned.
+
+    """
+    synced = record_syncs(monkeypatch)
+    with temp_storage() as storage:
+        storage = Storage(storage.destdir, shard_levels=1, durability='file')
+        file_id = storage.write('testuser', BytesIO(b'hello'))
+        path = storage.path('testuser', file_id)
+        for p in (path, path + DIGEST_SUFFIX, os.path.dirname(path),
+                  os.path.join(storage.destdir, 'testuser')):
+            assert p in synced
+
+    with pytest.raises(ValueError):
+        Storage(storage.destdir, durability='sometimes')
+
+def test_durability_none(monkeypatch):
+    """By default nothing should be synced."""
+    synced = record_syncs(monkeypatch)
+    with temp_storage() as storage:
+        storage.write('testuser', BytesIO(b'hello'))
+    assert synced == []
+
+def test_durability_group(monkeypatch):
+    """With group commit, files stored at about the same time should be
+    synced together.
+
+    """
+    synced = record_syncs(monkeypatch)
+    with temp_storage() as storage:
+        storage = Storage(storage.destdir, durability='group', sync_window=0.2)
+        storage.write('testuser', BytesIO(b'first'))
+        del synced[:]
+
+        ids, start = [], threading.Event()
+        def write():
+            start.wait()
+            ids.append(storage.write('testuser', BytesIO(os.urandom(16))))
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+
+        assert len(ids) == 8
+        for file_id in ids:
+            assert storage.path('testuser', file_id) in synced
+        assert synced.count(os.path.join(storage.destdir, 'testuser')) < 8
+
+@pytest.mark.parametrize('kernel_copy', ['copy_file_range', 'sendfile', None])
+def test_store_from_file(monkeypatch, kernel_copy):
+    """Storing part of a regular file should copy exactly that part whether
+    or not the kernel can copy it.
+
+    """
+    for name in ('copy_file_range', 'sendfile'):
+        if name != kernel_copy and hasattr(os, name):
+            monkeypatch.delattr(os, name)
+    if kernel_copy is not None and not hasattr(os, kernel_copy):
+        pytest.skip('{0} is not available'.format(kernel_copy))
+
+    contents = os.urandom(3 * 1024 * 1024)
+    with temp_storage() as storage:
+        src_path = os.path.join(storage.destdir, 'source')
+        with open(src_path, 'wb') as f:
+            f.write(contents)
+
+        with open(src_path, 'rb') as f:
+            f.read(10)
+            stored = storage.store('testuser', f, length=2 * 1024 * 1024)
+            assert f.tell() == 10 + 2 * 1024 * 1024
+        expected = contents[10:10 + 2 * 1024 * 1024]
+        assert stored.sha256 == hashlib.sha256(expected).hexdigest()
+        with open(storage.path('testuser', stored.id), 'rb') as f:
+            assert f.read() == expected
+
+        with open(src_path, 'rb') as f:
+            stored = storage.store('testuser', f)
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+
+        with open(src_path, 'rb') as f:
+            with pytest.raises(IOError):
+                storage.store('testuser', f, length=len(contents) + 1)
+        with open(src_path, 'rb') as f:
+            with pytest.raises(QuotaExceededError):
+                storage.store('testuser', f, quota=storage.usage('testuser') + 100)
+        assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == []
+
+def test_store_from_wrapped_file():
+    """Storing from a wrapper whose fileno() is that of another file, such as
+    a GzipFile, should store what is read from the wrapper.
+
+    """
+    contents = b'hello world\n' * 100
+    with temp_storage() as storage:
+        src_path = os.path.join(storage.destdir, 'source.gz')
+        with gzip.open(src_path, 'wb') as f:
+            f.write(contents)
+
+        with gzip.open(src_path, 'rb') as f:
+            stored = storage.store('testuser', f)
+        assert stored.size == len(contents)
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+        with open(storage.path('testuser', stored.id), 'rb') as f:
+            assert f.read() == contents
+
+def test_spool_preallocates():
+    """Spooling a file of known length should allocate space for it."""
+    with temp_storage() as storage:
+        f = storage.spool('testuser', 100000)
+        assert os.fstat(f.fileno()).st_size in (0, 100000)
+        f.write(b'x' * 100000)
+        stored = storage.store('testuser', f)
+        assert stored.size == 100000
+        assert stored.sha256 == hashlib.sha256(b'x' * 100000).hexdigest()
+
+def test_spool_truncates_to_written():
+    """Space allocated beyond the data written should not be stored."""
+    with temp_storage() as storage:
+        f = storage.spool('testuser', 100000)
+        f.write(b'hello')
+        stored = storage.store('testuser', f)
+        assert stored.size == 5
+        assert os.path.getsize(storage.path('testuser', stored.id)) == 5
+        assert storage.usage('testuser') == 5
+
+def read_compressed(storage, username, file_id):
+    """Return the decompressed contents of a stored file."""
+    path, codec = storage.locate(username, file_id)
+    with open(path, 'rb') as f:
+        if codec is None:
+            return f.read()
+        return DecompressingReader(f, codec).read()
+
+def test_compression():
+    """With compression, files should be stored compressed with their
+    contents' digests and counted at their compressed size.
+
+    """
+    contents = b'hello world\n' * 10000
+    with temp_storage() as plain:
+        storage = Storage(plain.destdir, compression='gzip')
+        stored = storage.store('testuser', BytesIO(contents))
+        assert stored.size == len(contents)
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+        assert storage.sha256('testuser', stored.id) == stored.sha256
+
+        path, codec = storage.locate('testuser', stored.id)
+        assert (path, codec) == (storage.path('testuser', stored.id) + '.gz', 'gzip')
+        assert read_compressed(storage, 'testuser', stored.id) == contents
+        assert storage.usage('testuser') == os.path.getsize(path) < len(contents)
+
+        # Spooled files may be seeked as when parsing forms
+        f = storage.spool('testuser', len(contents))
+        f.write(contents)
+        f.seek(0)
+        spooled = storage.store('testuser', f)
+        assert spooled.sha256 == stored.sha256
+        assert read_compressed(storage, 'testuser', spooled.id) == contents
+
+        # Files stored before compression was enabled are still found
+        old = plain.store('testuser', BytesIO(b'old'))
+        assert storage.locate('testuser', old.id) == (storage.path('testuser', old.id), None)
+
+        listed = dict((s.id, s) for _, s, _ in storage.iter_files())
+        assert sorted(listed) == sorted([stored.id, spooled.id, old.id])
+        assert listed[stored.id].sha256 == stored.sha256
+        assert listed[stored.id].size == os.path.getsize(path)
+        assert storage.recount_usage() == {'testuser': storage.usage('testuser')}
+
+        for file_id in (stored.id, spooled.id, old.id):
+            storage.delete('testuser', file_id)
+        assert storage.usage('testuser') == 0
+        assert sorted(os.listdir(os.path.join(storage.destdir, 'testuser'))) == \
+            sorted([PARTIAL_DIR, USAGE_FILE])
+        with pytest.raises(UnknownFileError):
+            storage.locate('testuser', stored.id)
+
+def test_compression_sessions_and_chunks():
+    """Files made from sessions and chunks should be stored compressed."""
+    contents = b'0123456789' * 1000
+    with temp_storage() as plain:
+        storage = Storage(plain.destdir, compression='gzip', dedup=True)
+
+        session_id = storage.create_session('testuser')
+        storage.write_session('testuser', session_id, 5000, BytesIO(contents[5000:]))
+        storage.write_session('testuser', session_id, 0, BytesIO(contents[:5000]))
+        stored = storage.commit_session('testuser', session_id)
+        assert stored.sha256 == hashlib.sha256(contents).hexdigest()
+        assert storage.locate('testuser', stored.id)[1] == 'gzip'
+        assert read_compressed(storage, 'testuser', stored.id) == contents
+        with pytest.raises(UnknownSessionError):
+            storage.session_offset('testuser', session_id)
+
+        chunks = [contents[:4000], contents[4000:]]
+        digests = [hashlib.sha256(c).hexdigest() for c in chunks]
+        for chunk, digest in zip(chunks, digests):
+            storage.write_chunk('testuser', digest, BytesIO(chunk))
+        assembled = storage.assemble('testuser', digests)
+        assert assembled.sha256 == stored.sha256
+        assert read_compressed(storage, 'testuser', assembled.id) == contents
+
+        # Identical compressed files share a blob
+        path = storage.locate('testuser', stored.id)[0]
+        assert os.stat(path).st_nlink == 3
+
+def test_compression_staged():
+    """Staged files should be committed compressed."""
+    with temp_storage() as plain:
+        storage = Storage(plain.destdir, compression='gzip')
+        staged = storage.stage('testuser', BytesIO(b'hello'))
+        assert list(storage.iter_staged()) == [('testuser', staged.id)]
+        assert storage.commit_staged('testuser', staged.id) == staged
+        assert read_compressed(storage, 'testuser', staged.id) == b'hello'
+        assert storage.commit_staged('testuser', staged.id) is None
+
+def test_unknown_compression():
+    """Unknown codecs should be refused."""
+    with pytest.raises(UnsupportedCodecError):
+        Storage('/tmp', compression='lzma')
@@ -0,0 +1,114 @@
+"""
+Test the command-line tool and its start-up cost.
+
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from bdfu.auth import verify_user_token
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which only some sub-commands need
+HEAVY_MODULES = ('jwt', 'requests', 'flask', 'future', 'multiprocessing.pool')
+
+# Upper bound in seconds on the time taken to import bdfu.tool and on running
+# gen-token. Importing the tool takes around 20ms, most of it docopt, and
+# gen-token around 40ms all told, whereas requests alone takes over 100ms.
+IMPORT_BUDGET = 0.1
+
+# Upper bound in seconds on importing what the upload sub-command needs, which
+# is dominated by requests. It takes around 200ms.
+UPLOAD_IMPORT_BUDGET = 0.5
+
+GEN_TOKEN = (
+    'import sys\n'
+    'sys.argv = ["bdfu", "gen-token", "someone", "secret"]\n'
+    'from bdfu.tool import main\n'
+    'main()'
+)
+
+def run_python(*args):
+    """Run a fresh Python interpreter in the repository and return its
+    standard error.
+
+    """
+    proc = subprocess.Popen(
+        [sys.executable] + list(args), cwd=ROOT_DIR,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+    return out.decode('utf8'), err.decode('utf8')
+
+def loaded_modules(code):
+    """Return the heavy modules loaded by running code."""
+    out, _ = run_python('-c', code + (
+        '\nimport sys\nprint("loaded:" + ",".join(m for m in {0!r} if m in sys.modules))'.format(
+            HEAVY_MODULES)))
+    loaded = out.splitlines()[-1][len('loaded:'):]
+    return set(m for m in loaded.split(',') if m)
+
+def run_time(code):
+    """Return the time in seconds taken to run code, imports included, in a
+    fresh Python interpreter.
+
+    """
+    out, _ = run_python('-c', (
+        'import time\n'
+        '_start = time.time()\n'
+        '{0}\n'
+        'print(time.time() - _start)'
+    ).format(code))
+    return float(out.rstrip('\n').split('\n')[-1])
+
+def test_import_loads_no_sub_command():
+    """Importing the tool should not import what its sub-commands need."""
+    assert loaded_modules('import bdfu.tool') == set()
+    assert loaded_modules('import bdfu.auth') == set()
+
+def test_gen_token_loads_no_heavy_modules():
+    """gen-token should not import PyJWT, the client or the server."""
+    assert loaded_modules(GEN_TOKEN) == set()
+
+def test_gen_token_from_file(tmpdir):
+    """gen-token --from-file should write a line of JSON for each user."""
+    users = tmpdir.join('users.txt')
+    users.write('alice\n\n  bob  \ncarol\n')
+    out, _ = run_python('-c', (
+        'import sys\n'
+        'sys.argv = ["bdfu", "gen-token", "--from-file={0}", "secret"]\n'
+        'from bdfu.tool import main\n'
+        'main()'
+    ).format(users))
+
+    lines = [json.loads(line) for line in out.splitlines()]
+    assert [line['user'] for line in lines] == ['alice', 'bob', 'carol']
+    for line in lines:
+        assert verify_user_token(line['token'], 'secret') == line['user']
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime needs Python 3.7')
+def test_import_budget():
+    """Importing the tool should be quick."""
+    def import_time():
+        _, err = run_python('-X', 'importtime', '-c', 'import bdfu.tool')
+        for line in err.splitlines():
+            fields = [f.strip() for f in line.split('|')]
+            if fields[-1] == 'bdfu.tool':
+                return int(fields[1]) / 1e6
+        raise AssertionError('bdfu.tool not in import times')
+
+    # The best of a few runs is less affected by a busy machine
+    assert min(import_time() for _ in range(3)) < IMPORT_BUDGET
+
+def test_gen_token_budget():
+    """Making a token with gen-token should be quick."""
+    assert min(run_time(GEN_TOKEN) for _ in range(3)) < IMPORT_BUDGET
+
+def test_upload_import_budget():
+    """Importing what upload needs should not cost much more than requests."""
+    code = 'from bdfu.client import Client'
+    assert min(run_time(code) for _ in range(3)) < UPLOAD_IMPORT_BUDGET
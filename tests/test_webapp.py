@@ -1,6 +1,14 @@
 """
 Basic functionality tests for web application.
 """
+import base64
+import gzip
+import hashlib
+import json
+import os
+from shutil import rmtree
+import tarfile
+from tempfile import mkdtemp, TemporaryFile
 import uuid
 
 from io import BytesIO
@@ -11,7 +19,9 @@ import pytest
 from mock import patch
 
 from bdfu.auth import _jwt_token
-from bdfu.webapp import app
+from bdfu.storage import PARTIAL_DIR, SESSION_CHARGE_SUFFIX, Storage, StoredFile
+from bdfu.webapp import ADMISSION_SETTINGS, _get_admission, app
+from bdfu.writebehind import WriteBehindStorage
 
 def jwt_headers(*args, **kwargs):
     """Like _jwt_token() but return a dict of headers containing HTTP
@@ -28,6 +38,23 @@ def jwt_payload(user=None):
         user = 'testuser'
     return dict(user=user)
 
+def gzip_compress(contents):
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(contents)
+    return out.getvalue()
+
+def received_bytes(text):
+    """Return the value of bdfu_received_bytes_total in the metrics text."""
+    for line in text.splitlines():
+        if line.startswith('bdfu_received_bytes_total '):
+            return int(line.split()[1])
+    raise AssertionError('bdfu_received_bytes_total not in metrics')
+
+def stored_file(file_id, contents):
+    """Return the StoredFile a Storage would return for contents."""
+    return StoredFile(file_id, len(contents), hashlib.sha256(contents).hexdigest())
+
 class WebAppTestCase(TestCase):
     def create_app(self):
         # Create and record a secret key
@@ -117,15 +144,18 @@ class WebAppTestCase(TestCase):
         # Mock the storage's write method to record it's call values
         new_id = uuid.uuid4().hex
         stored_state = {}
-        def side_effect(username, fobj):
+        def side_effect(username, fobj, quota=None):
             # HACK: we need to use str() here as a "copy" since the user is
             # passed as current_user which is only a proxy object for the real
             # username. Without the call to str(), the username would be
             # "None" by the time we check it.
             stored_state['username'] = str(username)
             stored_state['contents'] = fobj.read()
-            return new_id
-        gs_mock().write.side_effect = side_effect
+            return stored_file(new_id, stored_state['contents'])
+        gs_mock().store.side_effect = side_effect
+
+        # Uploaded files are spooled into storage as the form is parsed
+        gs_mock().spool.side_effect = lambda username, length=None: TemporaryFile()
 
         # Upload a file
         resp = self.client.post(
@@ -134,12 +164,577 @@ class WebAppTestCase(TestCase):
         )
 
         # Check write was called exactly once
-        assert gs_mock().write.call_count == 1
+        assert gs_mock().store.call_count == 1
+
+        # Check that the storage was passed the right values
+        assert stored_state['username'] == 'myuser'
+        assert stored_state['contents'] == file_contents
+
+        # Check that we Created the correct file
+        assert resp.status_code == 201
+        assert resp.json['id'] == new_id
+
+    @patch('bdfu.webapp._get_storage')
+    def test_authorised_put_succeeds(self, gs_mock):
+        """PUT-ing an authorized raw body results in a file being Created
+        (201) with exactly the body as contents.
+
+        """
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+
+        # Create a random file contents
+        file_contents = uuid.uuid4().bytes
+
+        # Mock the storage's write method to record it's call values
+        new_id = uuid.uuid4().hex
+        stored_state = {}
+        def side_effect(username, fobj, length=None, sha256=None, quota=None):
+            stored_state['username'] = str(username)
+            stored_state['contents'] = fobj.read(length)
+            stored_state['length'] = length
+            return stored_file(new_id, stored_state['contents'])
+        gs_mock().store.side_effect = side_effect
+
+        # Upload a file
+        resp = self.client.put('/upload', headers=auth_headers, data=file_contents)
 
         # Check that the storage was passed the right values
+        assert gs_mock().store.call_count == 1
         assert stored_state['username'] == 'myuser'
         assert stored_state['contents'] == file_contents
+        assert stored_state['length'] == len(file_contents)
 
         # Check that we Created the correct file
         assert resp.status_code == 201
         assert resp.json['id'] == new_id
+
+    def test_unauthorised_put_fails(self):
+        """PUT-ing without JWT is Unauthorized (401)."""
+        assert self.client.put('/upload', data=b'hello').status_code == 401
+
+    @patch('bdfu.webapp._get_storage')
+    def test_put_without_length_fails(self, gs_mock):
+        """PUT-ing a body of unknown length is Length Required (411)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        resp = self.client.put(
+            '/upload', headers=auth_headers, input_stream=BytesIO(b'hello'),
+            environ_overrides={'CONTENT_LENGTH': ''},
+        )
+        assert resp.status_code == 411
+        assert gs_mock().store.call_count == 0
+
+    @patch('bdfu.webapp._get_storage')
+    def test_token_cache(self, gs_mock):
+        """Repeated requests with the same token are verified once."""
+        current_app.config['STATS_ENABLED'] = True
+        current_app.config['TOKEN_CACHE_SIZE'] = 10
+        gs_mock().store.return_value = stored_file(uuid.uuid4().hex, b'hello')
+
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        for _ in range(3):
+            resp = self.client.put('/upload', headers=auth_headers, data=b'hello')
+            assert resp.status_code == 201
+
+        stats = self.client.get('/stats').json['token_cache']
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+
+        # A token with the wrong secret is still rejected
+        bad_headers = jwt_headers(jwt_payload(user='myuser'), 'this is not the secret')
+        assert self.client.put('/upload', headers=bad_headers, data=b'hello').status_code == 400
+
+    def test_stats_disabled(self):
+        """Statistics are Not Found (404) unless enabled."""
+        current_app.config['STATS_ENABLED'] = False
+        assert self.client.get('/stats').status_code == 404
+
+class StorageTestCase(TestCase):
+    """Views tested against a real storage directory."""
+    def create_app(self):
+        self.secret = uuid.uuid4().hex
+        self.storage_dir = mkdtemp(prefix='webapptest')
+
+        app.config['JWT_SECRET_KEY'] = self.secret
+        app.config['STORAGE_DIR'] = self.storage_dir
+        app.debug = True
+        return app
+
+    def tearDown(self):
+        app.config.pop('QUOTA', None)
+        app.config.pop('USER_QUOTAS', None)
+        app.config.pop('STORAGE_WRITERS', None)
+        app.config.pop('STORAGE_COMPRESSION', None)
+        app.config.pop('METRICS_ENABLED', None)
+        for key in ADMISSION_SETTINGS:
+            app.config.pop(key, None)
+        rmtree(self.storage_dir)
+
+    def _create_session(self, auth_headers):
+        resp = self.client.post('/uploads', headers=auth_headers)
+        assert resp.status_code == 201
+        assert resp.json['offset'] == 0
+        return '/uploads/' + resp.json['id']
+
+    def _patch(self, url, auth_headers, offset, data):
+        headers = dict(auth_headers)
+        headers['Upload-Offset'] = str(offset)
+        return self.client.patch(url, headers=headers, data=data)
+
+    def test_quota(self):
+        """Uploads which would take a user over quota are refused."""
+        app.config['QUOTA'] = 10
+        app.config['USER_QUOTAS'] = {'biguser': 1000}
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+
+        assert self.client.put('/upload', headers=auth_headers, data=b'x' * 8).status_code == 201
+        resp = self.client.put('/upload', headers=auth_headers, data=b'x' * 8)
+        assert resp.status_code == 413
+        assert resp.json['quota'] == 10
+        assert resp.json['usage'] == 8
+        resp = self.client.post('/upload', headers=auth_headers, data=dict(
+            file=(BytesIO(b'x' * 8), 'test.txt')))
+        assert resp.status_code == 413
+
+        # Quotas may be given per-user or in the token
+        auth_headers = jwt_headers(jwt_payload(user='biguser'), self.secret)
+        assert self.client.put('/upload', headers=auth_headers, data=b'x' * 100).status_code == 201
+        auth_headers = jwt_headers(dict(jwt_payload(user='myuser'), quota=100), self.secret)
+        assert self.client.put('/upload', headers=auth_headers, data=b'x' * 8).status_code == 201
+        assert len(list(Storage(self.storage_dir).iter_files())) == 3
+
+    def test_quota_checked_before_form_is_parsed(self):
+        """A POST which cannot fit is refused without spooling its file."""
+        app.config['QUOTA'] = 100
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        with patch('bdfu.storage.Storage.spool', autospec=True, side_effect=Storage.spool) as spool_mock:
+            resp = self.client.post('/upload', headers=auth_headers, data=dict(
+                file=(BytesIO(b'x' * 100000), 'test.txt')))
+        assert resp.status_code == 413
+        assert spool_mock.call_count == 0
+
+    def test_content_encoding(self):
+        """Compressed bodies are decompressed before being stored."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        contents = b'hello world\n' * 1000
+        headers = dict(auth_headers)
+        headers['Content-Encoding'] = 'gzip'
+
+        resp = self.client.put('/upload', headers=headers, data=gzip_compress(contents))
+        assert resp.status_code == 201
+        assert resp.json['sha256'] == hashlib.sha256(contents).hexdigest()
+        assert self._read_stored('myuser', resp.json['id']) == contents
+
+        url = self._create_session(auth_headers)
+        headers['Upload-Offset'] = '0'
+        resp = self.client.patch(url, headers=headers, data=gzip_compress(contents))
+        assert resp.json['offset'] == len(contents)
+
+        assert self.client.put('/upload', headers=headers, data=b'not gzip').status_code == 400
+        assert self.client.put('/upload', headers=headers, data=gzip_compress(contents)[:-20]).status_code == 400
+        headers['Content-Encoding'] = 'br'
+        assert self.client.put('/upload', headers=headers, data=b'hello').status_code == 415
+        session_id = url.split('/')[-1]
+        assert sorted(os.listdir(os.path.join(self.storage_dir, 'myuser', PARTIAL_DIR))) == [
+            session_id, session_id + SESSION_CHARGE_SUFFIX]
+
+    def test_compression(self):
+        """With compression configured, files are stored compressed."""
+        app.config['STORAGE_COMPRESSION'] = 'gzip'
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        resp = self.client.put('/upload', headers=auth_headers, data=b'hello')
+        assert resp.status_code == 201
+        resp = self.client.post('/upload', headers=auth_headers, data=dict(
+            file=(BytesIO(b'hello'), 'test.txt')))
+        assert resp.status_code == 201
+
+        storage = Storage(self.storage_dir)
+        for _, stored, _ in storage.iter_files():
+            path, codec = storage.locate('myuser', stored.id)
+            assert codec == 'gzip'
+            with gzip.open(path) as f:
+                assert f.read() == b'hello'
+
+    def test_metrics(self):
+        """With metrics enabled, requests and upload stages are counted and
+        exposed at /metrics.
+
+        """
+        assert self.client.get('/metrics').status_code == 404
+        app.config['METRICS_ENABLED'] = True
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        assert self.client.put('/upload', headers=auth_headers, data=b'hello').status_code == 201
+        resp = self.client.post('/upload', headers=auth_headers, data=dict(
+            file=(BytesIO(b'hello world'), 'test.txt')))
+        assert resp.status_code == 201
+        assert self.client.put('/upload', data=b'hello').status_code == 401
+        received = received_bytes(self.client.get('/metrics').data.decode('utf8'))
+        assert received > 5 + 11
+
+        # The bodies of refused requests are not read and so not counted
+        app.config['QUOTA'] = 1
+        assert self.client.put('/upload', headers=auth_headers, data=b'x' * 100).status_code == 413
+
+        resp = self.client.get('/metrics')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'text/plain'
+        text = resp.data.decode('utf8')
+        assert 'bdfu_requests_total{endpoint="upload_raw",method="PUT",status="201"} 1\n' in text
+        assert 'bdfu_requests_total{endpoint="upload_raw",method="PUT",status="401"} 1\n' in text
+        assert 'bdfu_requests_total{endpoint="upload",method="POST",status="201"} 1\n' in text
+        assert 'bdfu_user_stored_bytes_total{user="myuser"} 16\n' in text
+        assert received_bytes(text) == received
+        for stage in ('auth', 'parse', 'write', 'response'):
+            assert 'bdfu_upload_stage_seconds_count{{stage="{0}"}}'.format(stage) in text
+        for stage in ('receive', 'place', 'sync'):
+            assert 'bdfu_storage_seconds_count{{stage="{0}"}} 2\n'.format(stage) in text
+
+    def test_admission(self):
+        """Uploads over the configured limits are refused with Retry-After
+        before their body is read.
+
+        """
+        app.config['UPLOAD_CONCURRENCY'] = 1
+        app.config['USER_UPLOAD_RATE'] = 10
+        app.config['USER_UPLOAD_BURST'] = 100
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        assert self.client.put('/upload', headers=auth_headers, data=b'x' * 80).status_code == 201
+
+        resp = self.client.put('/upload', headers=auth_headers, data=b'x' * 80)
+        assert resp.status_code == 429
+        assert int(resp.headers['Retry-After']) >= 6
+        other_headers = jwt_headers(jwt_payload(user='otheruser'), self.secret)
+        assert self.client.put('/upload', headers=other_headers, data=b'x' * 80).status_code == 201
+
+        with self.app.test_request_context():
+            controller = _get_admission()
+        with controller.admit('someone'):
+            resp = self.client.put('/upload', headers=other_headers, data=b'x')
+            assert resp.status_code == 503
+            assert resp.headers['Retry-After'] == '1'
+        assert len(list(Storage(self.storage_dir).iter_files())) == 2
+
+    def test_write_behind(self):
+        """With writers configured, uploads are written in the background and
+        refused while too many are waiting.
+
+        """
+        app.config['STORAGE_WRITERS'] = 1
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        resp = self.client.put('/upload', headers=auth_headers, data=b'hello')
+        assert resp.status_code == 201
+
+        storage, _ = app.extensions['bdfu.storage']
+        assert isinstance(storage, WriteBehindStorage)
+        storage.join()
+        with open(storage.path('myuser', resp.json['id']), 'rb') as f:
+            assert f.read() == b'hello'
+
+        with patch.object(WriteBehindStorage, 'full', return_value=True):
+            resp = self.client.put('/upload', headers=auth_headers, data=b'hello')
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '1'
+
+    def test_session_upload(self):
+        """A file sent in pieces to a session is stored on commit."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        file_contents = os.urandom(1000)
+        url = self._create_session(auth_headers)
+
+        resp = self._patch(url, auth_headers, 0, file_contents[:600])
+        assert resp.status_code == 200
+        assert resp.json['offset'] == 600
+
+        resp = self.client.get(url, headers=auth_headers)
+        assert resp.status_code == 200
+        assert resp.json['offset'] == 600
+
+        resp = self._patch(url, auth_headers, 600, file_contents[600:])
+        assert resp.status_code == 200
+        assert resp.json['offset'] == 1000
+
+        resp = self.client.post(url, headers=auth_headers)
+        assert resp.status_code == 201
+        with open(os.path.join(self.storage_dir, 'myuser', resp.json['id']), 'rb') as f:
+            assert f.read() == file_contents
+
+        # The session has gone
+        assert self.client.get(url, headers=auth_headers).status_code == 404
+
+    def test_wrong_offset_conflicts(self):
+        """PATCH-ing at an offset other than the current one is a Conflict
+        (409) which reports the current offset.
+
+        """
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = self._create_session(auth_headers)
+        assert self._patch(url, auth_headers, 0, b'hello').status_code == 200
+
+        resp = self._patch(url, auth_headers, 2, b'llo, world')
+        assert resp.status_code == 409
+        assert resp.json['offset'] == 5
+
+    def test_missing_offset_fails(self):
+        """PATCH-ing without an Upload-Offset is a Bad Request (400)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = self._create_session(auth_headers)
+        assert self.client.patch(url, headers=auth_headers, data=b'x').status_code == 400
+
+    def test_unknown_session(self):
+        """Unknown sessions are Not Found (404)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = '/uploads/' + uuid.uuid4().hex
+        assert self.client.get(url, headers=auth_headers).status_code == 404
+        assert self._patch(url, auth_headers, 0, b'x').status_code == 404
+        assert self.client.post(url, headers=auth_headers).status_code == 404
+
+    def test_sessions_are_per_user(self):
+        """One user cannot see another's sessions."""
+        url = self._create_session(jwt_headers(jwt_payload(user='alice'), self.secret))
+        bob_headers = jwt_headers(jwt_payload(user='bob'), self.secret)
+        assert self.client.get(url, headers=bob_headers).status_code == 404
+
+    def test_delete_session(self):
+        """DELETE-ing a session discards it."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = self._create_session(auth_headers)
+        assert self.client.delete(url, headers=auth_headers).status_code == 204
+        assert self.client.get(url, headers=auth_headers).status_code == 404
+
+    def test_parts_in_any_order(self):
+        """Parts PUT at explicit offsets may arrive in any order."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        file_contents = os.urandom(1000)
+        url = self._create_session(auth_headers)
+
+        for start, end in ((600, 1000), (0, 300), (300, 600)):
+            resp = self.client.put(
+                url + '/' + str(start), headers=auth_headers,
+                data=file_contents[start:end]
+            )
+            assert resp.status_code == 200
+
+        headers = dict(auth_headers)
+        headers['Upload-Length'] = '1000'
+        resp = self.client.post(url, headers=headers)
+        assert resp.status_code == 201
+        with open(os.path.join(self.storage_dir, 'myuser', resp.json['id']), 'rb') as f:
+            assert f.read() == file_contents
+
+    def test_commit_checks_length(self):
+        """Committing with the wrong Upload-Length is a Conflict (409)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = self._create_session(auth_headers)
+        assert self._patch(url, auth_headers, 0, b'hello').status_code == 200
+
+        headers = dict(auth_headers)
+        headers['Upload-Length'] = '10'
+        resp = self.client.post(url, headers=headers)
+        assert resp.status_code == 409
+        assert resp.json['offset'] == 5
+
+    def test_put_checks_digest(self):
+        """PUT-ing a body returns its digest. A body which does not match a
+        Content-Digest or Digest header is a Bad Request (400) and is not
+        stored.
+
+        """
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        digest = hashlib.sha256(b'hello').hexdigest()
+        encoded = base64.b64encode(hashlib.sha256(b'hello').digest()).decode('ascii')
+
+        headers = dict(auth_headers)
+        headers['Content-Digest'] = 'sha-256=:' + encoded + ':'
+        resp = self.client.put('/upload', headers=headers, data=b'hello')
+        assert resp.status_code == 201
+        assert resp.json['sha256'] == digest
+
+        headers = dict(auth_headers)
+        headers['Digest'] = 'sha-256=' + encoded
+        resp = self.client.put('/upload', headers=headers, data=b'HELLO')
+        assert resp.status_code == 400
+        assert resp.json['expected'] == digest
+        assert resp.json['sha256'] == hashlib.sha256(b'HELLO').hexdigest()
+        assert len(os.listdir(os.path.join(self.storage_dir, 'myuser'))) == 4
+
+        headers['Digest'] = 'sha-256=not base64!'
+        assert self.client.put('/upload', headers=headers, data=b'hello').status_code == 400
+
+    def test_commit_checks_digest(self):
+        """Committing a session which does not match its Digest header is a
+        Bad Request (400).
+
+        """
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        url = self._create_session(auth_headers)
+        assert self._patch(url, auth_headers, 0, b'hello').status_code == 200
+
+        headers = dict(auth_headers)
+        headers['Digest'] = 'sha-256=' + base64.b64encode(hashlib.sha256(b'HELLO').digest()).decode('ascii')
+        assert self.client.post(url, headers=headers).status_code == 400
+
+        headers['Digest'] = 'sha-256=' + base64.b64encode(hashlib.sha256(b'hello').digest()).decode('ascii')
+        resp = self.client.post(url, headers=headers)
+        assert resp.status_code == 201
+        assert resp.json['sha256'] == hashlib.sha256(b'hello').hexdigest()
+
+    def test_chunks(self):
+        """Chunks which are uploaded can be assembled into a file."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        chunks = [b'hello, ', b'world']
+        digests = [hashlib.sha256(c).hexdigest() for c in chunks]
+
+        resp = self.client.post('/chunks/missing', headers=auth_headers, data=json.dumps(dict(chunks=digests)))
+        assert resp.status_code == 200
+        assert resp.json['missing'] == digests
+
+        resp = self.client.put('/chunks/' + digests[0], headers=auth_headers, data=chunks[0])
+        assert resp.status_code == 201
+
+        resp = self.client.post('/chunks/assemble', headers=auth_headers, data=json.dumps(dict(chunks=digests)))
+        assert resp.status_code == 409
+        assert resp.json['missing'] == digests[1:]
+
+        resp = self.client.put('/chunks/' + digests[1], headers=auth_headers, data=chunks[1])
+        assert resp.status_code == 201
+
+        resp = self.client.post('/chunks/assemble', headers=auth_headers, data=json.dumps(dict(chunks=digests)))
+        assert resp.status_code == 201
+        assert self._read_stored('myuser', resp.json['id']) == b'hello, world'
+        assert resp.json['sha256'] == hashlib.sha256(b'hello, world').hexdigest()
+
+    def test_chunk_quota(self):
+        """Chunks and sessions count towards the quota."""
+        app.config['QUOTA'] = 100
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        chunks = [os.urandom(40) for _ in range(3)]
+        for chunk in chunks[:2]:
+            resp = self.client.put(
+                '/chunks/' + hashlib.sha256(chunk).hexdigest(), headers=auth_headers, data=chunk)
+            assert resp.status_code == 201
+        resp = self.client.put(
+            '/chunks/' + hashlib.sha256(chunks[2]).hexdigest(), headers=auth_headers, data=chunks[2])
+        assert resp.status_code == 413
+
+        url = self._create_session(auth_headers)
+        assert self._patch(url, auth_headers, 0, b'x' * 20).status_code == 200
+        assert self._patch(url, auth_headers, 20, b'x' * 20).status_code == 413
+        assert Storage(self.storage_dir).usage('myuser') == 100
+
+    def test_bad_chunks(self):
+        """Chunks must match their digest and lists of chunks must be lists of
+        digests.
+
+        """
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        digest = hashlib.sha256(b'hello').hexdigest()
+        assert self.client.put('/chunks/' + digest, headers=auth_headers, data=b'HELLO').status_code == 400
+        assert self.client.put('/chunks/not-a-digest', headers=auth_headers, data=b'hello').status_code == 404
+
+        for body in (b'not json', b'[]', b'{"chunks": "abc"}', b'{"chunks": [1]}', b'{"chunks": ["abc"]}'):
+            assert self.client.post('/chunks/missing', headers=auth_headers, data=body).status_code == 400
+
+    def _read_stored(self, username, file_id):
+        with open(os.path.join(self.storage_dir, username, file_id), 'rb') as f:
+            return f.read()
+
+    def test_batch_multipart(self):
+        """POST-ing many files to /batch stores them all in order."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        contents = [os.urandom(100 * (i + 1)) for i in range(5)]
+
+        resp = self.client.post(
+            '/batch', headers=auth_headers,
+            data=dict(file=[(BytesIO(c), 'file{0}.bin'.format(i)) for i, c in enumerate(contents)]),
+        )
+        assert resp.status_code == 201
+        assert len(resp.json['ids']) == 5
+        for file_id, expected in zip(resp.json['ids'], contents):
+            assert self._read_stored('myuser', file_id) == expected
+        assert resp.json['sha256'] == [hashlib.sha256(c).hexdigest() for c in contents]
+
+    def test_batch_tar(self):
+        """POST-ing a tar archive to /batch stores each regular file in it."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        contents = [os.urandom(100 * (i + 1)) for i in range(5)]
+
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tf:
+            dirinfo = tarfile.TarInfo('a-directory')
+            dirinfo.type = tarfile.DIRTYPE
+            tf.addfile(dirinfo)
+            for i, c in enumerate(contents):
+                info = tarfile.TarInfo('a-directory/file{0}.bin'.format(i))
+                info.size = len(c)
+                tf.addfile(info, BytesIO(c))
+
+        resp = self.client.post(
+            '/batch', headers=auth_headers, data=archive.getvalue(),
+            content_type='application/x-tar',
+        )
+        assert resp.status_code == 201
+        assert len(resp.json['ids']) == 5
+        for file_id, expected in zip(resp.json['ids'], contents):
+            assert self._read_stored('myuser', file_id) == expected
+
+    def test_batch_bad_tar(self):
+        """POST-ing something which is not a tar archive is a Bad Request (400)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        resp = self.client.post(
+            '/batch', headers=auth_headers, data=b'not a tar file' * 100,
+            content_type='application/x-tar',
+        )
+        assert resp.status_code == 400
+
+    def test_empty_batch(self):
+        """POST-ing no files to /batch is a Bad Request (400)."""
+        auth_headers = jwt_headers(jwt_payload(), self.secret)
+        assert self.client.post('/batch', headers=auth_headers).status_code == 400
+
+    def test_post_is_spooled_into_storage(self):
+        """POST-ed files are received into the storage directory and moved,
+        not copied, into place. Nothing is left in the partial directory.
+
+        """
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        file_contents = os.urandom(1000)
+
+        with patch('bdfu.storage.Storage.spool', autospec=True, side_effect=Storage.spool) as spool_mock:
+            resp = self.client.post(
+                '/upload', headers=auth_headers,
+                data=dict(file=(BytesIO(file_contents), 'test_file.bin')),
+            )
+        assert resp.status_code == 201
+        assert spool_mock.call_count == 1
+        assert self._read_stored('myuser', resp.json['id']) == file_contents
+        assert os.listdir(os.path.join(self.storage_dir, 'myuser', PARTIAL_DIR)) == []
+
+    def test_part_length_is_not_trusted(self):
+        """A part's Content-Length header does not change what is stored."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="test.txt"\r\n'
+            b'Content-Type: application/octet-stream\r\n'
+            b'Content-Length: 100000\r\n'
+            b'\r\n'
+            b'hello\r\n'
+            b'--boundary--\r\n'
+        )
+        resp = self.client.post(
+            '/upload', headers=auth_headers, data=body,
+            content_type='multipart/form-data; boundary=boundary',
+        )
+        assert resp.status_code == 201
+        assert resp.json['sha256'] == hashlib.sha256(b'hello').hexdigest()
+        assert self._read_stored('myuser', resp.json['id']) == b'hello'
+        assert Storage(self.storage_dir).usage('myuser') == 5
+
+    def test_unused_spool_is_removed(self):
+        """Files spooled for form fields which are not stored are removed."""
+        auth_headers = jwt_headers(jwt_payload(user='myuser'), self.secret)
+        resp = self.client.post(
+            '/upload', headers=auth_headers,
+            data=dict(notfile=(BytesIO(b'hello'), 'test_file.bin')),
+        )
+        assert resp.status_code == 400
+        assert os.listdir(os.path.join(self.storage_dir, 'myuser', PARTIAL_DIR)) == []
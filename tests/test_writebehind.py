@@ -0,0 +1,126 @@
+"""
+Test write-behind storage.
+
+"""
+from io import BytesIO
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import threading
+import time
+
+import pytest
+
+from bdfu.storage import PARTIAL_DIR, STAGED_PREFIX, Storage
+from bdfu.writebehind import StorageBusyError, WriteBehindStorage
+
+@pytest.fixture
+def storage():
+    destdir = mkdtemp(prefix='writebehindtest')
+    yield Storage(destdir)
+    rmtree(destdir)
+
+class BlockingStorage(object):
+    """Wrap a Storage so that committing staged files waits until the event
+    "release" is set.
+
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.release = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def commit_staged(self, *args, **kwargs):
+        self.release.wait()
+        return self.storage.commit_staged(*args, **kwargs)
+
+def test_store(storage):
+    """Stored files should appear once written by the writers."""
+    wb = WriteBehindStorage(storage, writers=2)
+    contents = [os.urandom(100) for _ in range(10)]
+    stored = [wb.store('testuser', BytesIO(c)) for c in contents]
+    wb.join()
+
+    assert wb.depth() == 0
+    assert wb.stats()['written'] == 10
+    for s, c in zip(stored, contents):
+        with open(storage.path('testuser', s.id), 'rb') as f:
+            assert f.read() == c
+        assert storage.sha256('testuser', s.id) == s.sha256
+    assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == []
+    assert storage.usage('testuser') == 1000
+
+def test_staged_until_written(storage):
+    """Files should be staged on disk until written."""
+    blocking = BlockingStorage(storage)
+    wb = WriteBehindStorage(blocking, writers=1, queue_size=4)
+    stored = wb.store('testuser', BytesIO(b'hello'))
+
+    assert not os.path.exists(storage.path('testuser', stored.id))
+    assert list(storage.iter_staged()) == [('testuser', stored.id)]
+    assert os.listdir(os.path.join(storage.destdir, 'testuser', PARTIAL_DIR)) == \
+        [STAGED_PREFIX + stored.id]
+
+    blocking.release.set()
+    wb.join()
+    assert os.path.isfile(storage.path('testuser', stored.id))
+    assert list(storage.iter_staged()) == []
+
+def test_full_queue_refuses(storage):
+    """Files should be refused without being read once the queue is full."""
+    blocking = BlockingStorage(storage)
+    wb = WriteBehindStorage(blocking, writers=1, queue_size=2)
+
+    # One file is taken by the writer and two wait in the queue
+    wb.store('testuser', BytesIO(b'hello'))
+    while wb.depth() > 0:
+        time.sleep(0.01)
+    wb.store('testuser', BytesIO(b'hello'))
+    wb.store('testuser', BytesIO(b'hello'))
+    assert wb.depth() == 2
+
+    contents = BytesIO(b'hello')
+    with pytest.raises(StorageBusyError):
+        wb.store('testuser', contents)
+    assert contents.tell() == 0
+
+    blocking.release.set()
+    wb.join()
+    assert len(list(storage.iter_files())) == 3
+
+def test_recover(storage):
+    """Files staged by a process which died should be written on recovery."""
+    stored = storage.stage('testuser', BytesIO(b'hello'))
+    wb = WriteBehindStorage(storage, writers=1)
+    assert wb.recover() == 1
+    wb.join()
+
+    with open(storage.path('testuser', stored.id), 'rb') as f:
+        assert f.read() == b'hello'
+    assert storage.sha256('testuser', stored.id) == stored.sha256
+
+    # Committing again does nothing
+    assert storage.commit_staged('testuser', stored.id) is None
+
+def test_from_config(storage):
+    """Configuring writers should give write-behind storage."""
+    config = dict(STORAGE_DIR=storage.destdir)
+    assert isinstance(Storage.from_config(config), Storage)
+    config['STORAGE_WRITERS'] = 2
+    config['STORAGE_QUEUE_SIZE'] = 8
+    wb = Storage.from_config(config)
+    assert isinstance(wb, WriteBehindStorage)
+    assert wb.stats()['capacity'] == 8
+
+def test_from_config_new_directory(storage):
+    """Write-behind storage should start with a directory not yet created."""
+    destdir = os.path.join(storage.destdir, 'not-yet-created')
+    wb = Storage.from_config(dict(STORAGE_DIR=destdir, STORAGE_WRITERS=1))
+    assert wb.recover() == 0
+
+    stored = wb.store('testuser', BytesIO(b'hello'))
+    wb.join()
+    with open(Storage(destdir).path('testuser', stored.id), 'rb') as f:
+        assert f.read() == b'hello'